@@ -0,0 +1,274 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+# Offline micro-benchmarks for the storage and prompt hot paths.
+#
+#   python bench.py                          run everything, print a table
+#   python bench.py --out before.json        also save the results as json
+#   python bench.py --baseline before.json   compare against saved results
+#   python bench.py --storage sqlite         use the SQLite backend
+#   python bench.py --only history           run benchmarks whose name contains "history"
+#
+# import.fractal times importing fractal and toolbox in a fresh interpreter.
+# Runs in a temporary copy of Prompt/, Characters/ and Payloads.json with
+# placeholder credentials, so it never touches Data/ or the network.
+
+repoDir = os.path.dirname(os.path.abspath(__file__))
+historySizes = [10, 1000, 50000]
+userID = 1000
+character = "Kamelle"
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def measure(op, iterations, allocIterations):
+    """Times op() iterations times, then measures its allocations in a
+    separate pass since tracemalloc slows everything down"""
+    op()  # warm up caches and lazy loads
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter_ns()
+        op()
+        samples.append(time.perf_counter_ns() - start)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    for _ in range(allocIterations):
+        op()
+    after, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "iterations": iterations,
+        "meanUs": sum(samples) / len(samples) / 1000,
+        "p50Us": percentile(samples, 0.50) / 1000,
+        "p95Us": percentile(samples, 0.95) / 1000,
+        "retainedBytes": (after - before) // allocIterations,
+        "peakBytes": peak - before,
+    }
+
+
+importScript = """
+import time, tracemalloc, sys
+if sys.argv[1] == "memory":
+    tracemalloc.start()
+start = time.perf_counter()
+import fractal, toolbox
+seconds = time.perf_counter() - start
+print(seconds, tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else 0)
+"""
+
+
+def measureImport(iterations=5):
+    """Times importing fractal and toolbox in fresh interpreters, without
+    credentials or a .env, the way a worker or script would"""
+    env = {k: v for k, v in os.environ.items() if k not in ("TELEGRAM_API_KEY", "OPENAI_API_KEY")}
+    env["PYTHONPATH"] = repoDir
+    emptyDir = tempfile.mkdtemp(prefix="fractal-bench-import-")
+
+    def run(mode):
+        output = subprocess.run(
+            [sys.executable, "-c", importScript, mode],
+            cwd=emptyDir, env=env, capture_output=True, text=True, check=True,
+        ).stdout.split()
+        return float(output[0]), int(output[1])
+
+    try:
+        run("time")  # warm the os file cache and bytecode
+        samples = [run("time")[0] * 1e9 for _ in range(iterations)]
+        peak = run("memory")[1]
+    finally:
+        shutil.rmtree(emptyDir, ignore_errors=True)
+    return {
+        "iterations": iterations,
+        "meanUs": sum(samples) / len(samples) / 1000,
+        "p50Us": percentile(samples, 0.50) / 1000,
+        "p95Us": percentile(samples, 0.95) / 1000,
+        "retainedBytes": peak,
+        "peakBytes": peak,
+    }
+
+
+def prepareWorkdir(storageName):
+    """Copies the files the bot reads into a temp dir and chdirs there"""
+    workdir = tempfile.mkdtemp(prefix="fractal-bench-")
+    for name in ("Prompt", "Characters"):
+        shutil.copytree(f"{repoDir}/{name}", f"{workdir}/{name}")
+    shutil.copy(f"{repoDir}/Payloads.json", workdir)
+    os.chdir(workdir)
+    os.environ.setdefault("TELEGRAM_API_KEY", "bench")
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    os.environ["FRACTAL_EMBEDDER"] = "hash"
+    os.environ["FRACTAL_STORAGE"] = storageName
+    os.environ["FRACTAL_DB"] = f"{workdir}/fractal.db"
+    return workdir
+
+
+def benchmarks(fractal, toolbox, only=None):
+    """Yields (name, op, iterations). Setup happens before each op is yielded,
+    and the history logs are only filled for sizes that will be run"""
+    fractal.genRuntimeVars(userID)
+    fractal.setRuntimeVars(userID, {"userName": "Bench", "character": character})
+    fractal.genCharacterVars(userID, character, useGlobal=True)
+    fractal.storage.setDiffusion(
+        userID, character, {"positive": "portrait, soft light", "negative": "blurry"}
+    )
+
+    for size in historySizes:
+        chat = f"{character}-{size}"
+        names = [f"history.{op}[{size}]" for op in ("update", "getConversation", "budgeted")]
+        if only and not any(only in name for name in names):
+            continue
+        for i in range(size):
+            fractal.updateConversation(
+                userID, chat, {"name": "Bench", "role": "user", "msg": f"Message number {i} about the weather"}
+            )
+        record = {"name": "Bench", "role": "user", "msg": "One more message about the weather"}
+        yield names[0], lambda chat=chat: fractal.updateConversation(
+            userID, chat, dict(record)
+        ), 200
+        yield names[1], lambda chat=chat: fractal.getConversation(
+            userID, chat
+        ), 20 if size >= 50000 else 200
+        yield names[2], lambda chat=chat: fractal.getBudgetedHistory(
+            userID, chat, fractal.getTokenBudget()
+        ), 200
+
+    users = list(range(userID + 1, userID + 101))
+
+    def runtimeChurn():
+        for id in users:
+            fractal.setRuntimeVars(id, {"lastMessageTime": fractal.getTime()})
+            fractal.getRuntimeVars(id)
+
+    yield "runtime.churn[100 users]", runtimeChurn, 50
+
+    card = fractal.getCharacterPrompt(0, character)
+    names = {"user": "Bench", "char": character}
+    history = [{"role": "user", "msg": f"Message number {i}"} for i in range(10)]
+
+    def assemblePrompt():
+        schema = {
+            "system": {
+                "rules": fractal.varInsert(fractal.getSystemPrompt(), names),
+                "characterDetails": fractal.varInsert(fractal.processJsonPrompt(card), names),
+                "userDetails": "",
+            },
+            "assistant": {
+                "firstMessage": fractal.varInsert(fractal.processJsonPrompt(card, get="Greeting"), names)
+            },
+            "history": history,
+            "user": "How are you today?",
+        }
+        return fractal.processMessageSchema(schema)
+
+    yield "prompt.assemble", assemblePrompt, 2000
+    yield "prompt.sections", lambda: fractal.getPromptSections(userID, character, "Bench"), 2000
+    yield "sd.buildPayload", lambda: fractal.buildSDPayload(userID, ["(smiling)"]), 500
+    yield "tools.registryBuild", lambda: toolbox.ToolRegistry(toolbox.registeredTools), 500
+    yield "tools.select", lambda: toolbox.getToolRegistry().select(
+        "remind me to finish my task list and send a selfie", None
+    ), 2000
+
+
+def compare(results, baseline):
+    """Returns {name: {"meanRatio", "retainedDelta"}} for benchmarks in both runs"""
+    comparison = {}
+    for name, result in results.items():
+        old = baseline.get("results", {}).get(name)
+        if not old or not old.get("meanUs"):
+            continue
+        comparison[name] = {
+            "meanRatio": result["meanUs"] / old["meanUs"],
+            "retainedDelta": result["retainedBytes"] - old.get("retainedBytes", 0),
+        }
+    return comparison
+
+
+def printTable(results, comparison):
+    print(f"{'benchmark':34} {'mean us':>10} {'p95 us':>10} {'retained':>10} {'peak':>10} {'vs base':>8}")
+    for name, r in results.items():
+        ratio = comparison.get(name, {}).get("meanRatio")
+        change = f"{(ratio - 1) * 100:+.0f}%" if ratio else ""
+        print(
+            f"{name:34} {r['meanUs']:10.1f} {r['p95Us']:10.1f} "
+            f"{r['retainedBytes']:10d} {r['peakBytes']:10d} {change:>8}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for Fractal's hot paths")
+    parser.add_argument("--out", help="write results as json to this file")
+    parser.add_argument("--baseline", help="json results of an earlier run to compare against")
+    parser.add_argument("--storage", default="json", choices=["json", "sqlite"])
+    parser.add_argument("--only", help="only run benchmarks whose name contains this")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply iteration counts")
+    parser.add_argument(
+        "--max-regression", type=float, default=None,
+        help="exit with status 1 if any mean is this many percent slower than the baseline",
+    )
+    args = parser.parse_args()
+    # Resolved before prepareWorkdir changes directory
+    out = os.path.abspath(args.out) if args.out else None
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    results = {}
+    if not args.only or args.only in "import.fractal":
+        results["import.fractal"] = measureImport(max(1, int(5 * args.scale)))
+
+    workdir = prepareWorkdir(args.storage)
+    sys.path.insert(0, repoDir)
+    import fractal
+    import toolbox
+
+    try:
+        for name, op, iterations in benchmarks(fractal, toolbox, args.only):
+            if args.only and args.only not in name:
+                continue
+            iterations = max(1, int(iterations * args.scale))
+            results[name] = measure(op, iterations, max(1, iterations // 10))
+    finally:
+        fractal.runtimeCache.close()
+        os.chdir(repoDir)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    comparison = compare(results, baseline) if baseline else {}
+    report = {
+        "meta": {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "storage": args.storage,
+        },
+        "results": results,
+        "comparison": comparison,
+    }
+    printTable(results, comparison)
+    if out:
+        with open(out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=4)
+
+    if args.max_regression is not None:
+        limit = 1 + args.max_regression / 100
+        slower = [name for name, c in comparison.items() if c["meanRatio"] > limit]
+        if slower:
+            print("Slower than baseline: " + ", ".join(slower))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
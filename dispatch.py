@@ -0,0 +1,79 @@
+import asyncio
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+class KeyedLocks:
+    """asyncio locks created on demand per key and dropped once nobody holds or
+    waits on them. Waiters are served in the order they arrived"""
+
+    def __init__(self):
+        self.locks = {}  # key -> [lock, users]
+
+    def acquire(self, key):
+        return KeyedLock(self, key)
+
+    def __len__(self):
+        return len(self.locks)
+
+
+class KeyedLock:
+    def __init__(self, owner, key):
+        self.owner = owner
+        self.key = key
+
+    async def __aenter__(self):
+        entry = self.owner.locks.setdefault(self.key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            await entry[0].acquire()
+        except BaseException:
+            self.release(entry, locked=False)
+            raise
+        return self
+
+    async def __aexit__(self, *exc):
+        self.release(self.owner.locks[self.key], locked=True)
+
+    def release(self, entry, locked):
+        if locked:
+            entry[0].release()
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self.owner.locks[self.key]
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates for different chats in parallel and updates for the
+    same chat one at a time, in the order they arrived.
+
+    At most maxConcurrent updates run at once. Updates waiting behind another
+    update from their own chat don't count against that limit, so one chatty
+    user can't use up every slot. maxQueued bounds how many updates may be
+    in flight in total before python-telegram-bot stops handing out more.
+    """
+
+    def __init__(self, maxConcurrent=64, maxQueued=4096):
+        super().__init__(max(maxQueued, maxConcurrent))
+        self.maxConcurrent = maxConcurrent
+        self.chatLocks = KeyedLocks()
+        self.running = None
+
+    async def initialize(self):
+        self.running = asyncio.Semaphore(self.maxConcurrent)
+
+    async def shutdown(self):
+        pass
+
+    async def do_process_update(self, update, coroutine):
+        chatID = None
+        if isinstance(update, Update) and update.effective_chat:
+            chatID = update.effective_chat.id
+        if chatID is None:
+            async with self.running:
+                await coroutine
+            return
+        async with self.chatLocks.acquire(chatID):
+            async with self.running:
+                await coroutine
@@ -0,0 +1,419 @@
+import base64
+import hashlib
+import io
+import json
+import random
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-ins for the services the bot talks to, for testing without the
+# network. Point the bot at them with FRACTAL_TELEGRAM_BASE_URL,
+# OPENAI_BASE_URL and FRACTAL_SD_URL.
+
+
+class FakeServer:
+    """Runs a ThreadingHTTPServer in a background thread. Subclasses implement
+    handle(method, path, headers, body) -> (status, dict or bytes), or
+    (status, bytes, content type) for anything that isn't json"""
+
+    def __init__(self, host="127.0.0.1", port=0):
+        owner = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.respond()
+
+            def do_POST(self):
+                self.respond()
+
+            def respond(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                status, result, *contentType = owner.handle(
+                    self.command, self.path, self.headers, body
+                )
+                data = result if isinstance(result, bytes) else json.dumps(result).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header("Content-Type", contentType[0] if contentType else "application/json")
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # eg. a long poll the bot gave up on while shutting down
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, method, path, headers, body):
+        raise NotImplementedError
+
+
+def parseParams(headers, body):
+    """Decodes python-telegram-bot's form or multipart request bodies. Values
+    are json encoded by the library, uploaded files come back as bytes"""
+    contentType = headers.get("Content-Type", "")
+    params = {}
+    if contentType.startswith("multipart/form-data"):
+        message = BytesParser().parsebytes(
+            b"Content-Type: " + contentType.encode() + b"\r\n\r\n" + body
+        )
+        for part in message.get_payload():
+            name = part.get_param("name", header="content-disposition")
+            value = part.get_payload(decode=True)
+            params[name] = value if part.get_filename() else value.decode()
+    elif contentType.startswith("application/json"):
+        params = json.loads(body or b"{}")
+    else:
+        params = {k: v[-1] for k, v in urllib.parse.parse_qs(body.decode()).items()}
+    for key, value in params.items():
+        if isinstance(value, str):
+            try:
+                params[key] = json.loads(value)
+            except ValueError:
+                pass
+    return params
+
+
+class FakeTelegram(FakeServer):
+    """A minimal Telegram Bot API: getMe, webhooks, getUpdates and the send /
+    edit methods the bot uses. Every call is recorded in calls as
+    (time, method, params). postUpdate() delivers a user message either to the
+    registered webhook (with its secret token header) or to getUpdates"""
+
+    def __init__(self, host="127.0.0.1", port=0):
+        super().__init__(host, port)
+        self.calls = []
+        self.webhook = None
+        self.secret = None
+        self.updates = []
+        self.updateID = 0
+        self.messageID = 0
+        self.lock = threading.Condition()
+        self.onCall = None
+
+    def handle(self, method, path, headers, body):
+        # /bot<token>/<method>
+        apiMethod = path.rstrip("/").rsplit("/", 1)[-1]
+        params = parseParams(headers, body)
+        with self.lock:
+            self.calls.append((time.monotonic(), apiMethod, params))
+            self.lock.notify_all()
+        if self.onCall:
+            self.onCall(apiMethod, params)
+        handler = getattr(self, "api_" + apiMethod, None)
+        if handler is None:
+            return 200, {"ok": True, "result": True}
+        return 200, {"ok": True, "result": handler(params)}
+
+    def api_getMe(self, params):
+        return {
+            "id": 1,
+            "is_bot": True,
+            "first_name": "Fractal",
+            "username": "fractal_test_bot",
+            "can_join_groups": False,
+            "can_read_all_group_messages": False,
+            "supports_inline_queries": False,
+        }
+
+    def api_setWebhook(self, params):
+        self.webhook = params.get("url")
+        self.secret = params.get("secret_token")
+        return True
+
+    def api_deleteWebhook(self, params):
+        self.webhook = None
+        return True
+
+    def api_getWebhookInfo(self, params):
+        return {"url": self.webhook or "", "has_custom_certificate": False, "pending_update_count": 0}
+
+    def api_getUpdates(self, params):
+        offset = int(params.get("offset") or 0)
+        timeout = float(params.get("timeout") or 0)
+        with self.lock:
+            self.updates = [u for u in self.updates if u["update_id"] >= offset]
+            if not self.updates and timeout:
+                self.lock.wait(min(timeout, 1.0))
+            return list(self.updates)
+
+    def newMessage(self, params, **fields):
+        with self.lock:
+            self.messageID += 1
+            messageID = self.messageID
+        chatID = params.get("chat_id")
+        message = {
+            "message_id": messageID,
+            "date": int(time.time()),
+            "chat": {"id": int(chatID) if chatID is not None else 0, "type": "private"},
+            "from": self.api_getMe(params),
+        }
+        message.update(fields)
+        return message
+
+    def api_sendMessage(self, params):
+        return self.newMessage(params, text=params.get("text", ""))
+
+    def api_editMessageText(self, params):
+        return self.newMessage(params, text=params.get("text", ""))
+
+    def api_sendPhoto(self, params):
+        photo = {"file_id": "photo", "file_unique_id": "photo", "width": 1, "height": 1}
+        return self.newMessage(params, photo=[photo])
+
+    def makeUpdate(self, chatID, text, firstName="Tester"):
+        with self.lock:
+            self.updateID += 1
+            self.messageID += 1
+            updateID, messageID = self.updateID, self.messageID
+        message = {
+            "message_id": messageID,
+            "date": int(time.time()),
+            "chat": {"id": chatID, "type": "private", "first_name": firstName},
+            "from": {"id": chatID, "is_bot": False, "first_name": firstName},
+            "text": text,
+        }
+        if text.startswith("/"):
+            command = text.split()[0]
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        return {"update_id": updateID, "message": message}
+
+    def postUpdate(self, chatID, text):
+        """Sends a user message to the bot. Returns the update"""
+        update = self.makeUpdate(chatID, text)
+        if self.webhook:
+            request = urllib.request.Request(
+                self.webhook,
+                data=json.dumps(update).encode(),
+                headers={"Content-Type": "application/json"},
+            )
+            if self.secret:
+                request.add_header("X-Telegram-Bot-Api-Secret-Token", self.secret)
+            urllib.request.urlopen(request, timeout=10).read()
+        else:
+            with self.lock:
+                self.updates.append(update)
+                self.lock.notify_all()
+        return update
+
+    def sentTo(self, chatID, methods=("sendMessage", "editMessageText", "sendPhoto")):
+        with self.lock:
+            return [c for c in self.calls if c[1] in methods and str(c[2].get("chat_id")) == str(chatID)]
+
+    def waitFor(self, match, timeout=30, since=0):
+        """Waits until a call at or after position since in calls satisfies
+        match(method, params). Returns the call or None on timeout"""
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while True:
+                for call in self.calls[since:]:
+                    if match(call[1], call[2]):
+                        return call
+                since = max(since, len(self.calls))
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.lock.wait(remaining)
+
+
+class FakeOpenAI(FakeServer):
+    """An OpenAI-compatible API with chat completions (streamed or not) and
+    embeddings, answering after latency seconds (plus up to jitter more).
+
+    The reply to a chat is replyFor(the last user message). toolRules maps a
+    word to (tool name, arguments): when the user's message contains the word,
+    the request offers that tool and no tool has answered yet this turn, the
+    fake calls the tool instead of replying.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, jitter=0.0, toolRules=None):
+        super().__init__(host, port)
+        self.latency = latency
+        self.jitter = jitter
+        self.toolRules = toolRules or {}
+        self.calls = []
+        self.lock = threading.Lock()
+        self.callID = 0
+
+    @staticmethod
+    def replyFor(userText):
+        return f"Sure thing! You said: {userText}"
+
+    def handle(self, method, path, headers, body):
+        request = json.loads(body or b"{}")
+        endpoint = path.split("?")[0].rstrip("/").rsplit("/", 2)
+        endpoint = "/".join(endpoint[-2:]) if endpoint[-1] == "completions" else endpoint[-1]
+        with self.lock:
+            self.calls.append((time.monotonic(), endpoint, request))
+        time.sleep(self.latency + random.random() * self.jitter)
+        if endpoint == "chat/completions":
+            return self.chat(request)
+        if endpoint == "embeddings":
+            return 200, self.embeddings(request)
+        return 404, {"error": {"message": f"Unknown endpoint {path}"}}
+
+    def pickTool(self, request):
+        messages = request.get("messages", [])
+        if not messages or messages[-1].get("role") != "user":
+            return None
+        offered = {t["function"]["name"] for t in request.get("tools") or []}
+        text = str(messages[-1].get("content", "")).lower()
+        for word, (name, arguments) in self.toolRules.items():
+            if word in text and name in offered:
+                with self.lock:
+                    self.callID += 1
+                    callID = f"call_{self.callID}"
+                return {
+                    "id": callID,
+                    "type": "function",
+                    "function": {"name": name, "arguments": json.dumps(arguments)},
+                }
+        return None
+
+    def chat(self, request):
+        messages = request.get("messages", [])
+        userText = next(
+            (m.get("content") for m in reversed(messages) if m.get("role") == "user"), ""
+        )
+        toolCall = self.pickTool(request)
+        content = None if toolCall else self.replyFor(userText)
+        usage = {
+            "prompt_tokens": len(json.dumps(messages)) // 4,
+            "completion_tokens": len(content or "") // 4 + 1,
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        base = {"id": "chatcmpl-fake", "created": int(time.time()), "model": request.get("model", "fake")}
+        finish = "tool_calls" if toolCall else "stop"
+        if not request.get("stream"):
+            message = {"role": "assistant", "content": content}
+            if toolCall:
+                message["tool_calls"] = [toolCall]
+            return 200, dict(
+                base,
+                object="chat.completion",
+                choices=[{"index": 0, "message": message, "finish_reason": finish}],
+                usage=usage,
+            )
+
+        deltas = [{"role": "assistant", "content": ""}]
+        if toolCall:
+            deltas.append({"tool_calls": [dict(toolCall, index=0)]})
+        else:
+            words = content.split(" ")
+            deltas += [{"content": w if i == 0 else " " + w} for i, w in enumerate(words)]
+        chunks = [
+            dict(base, object="chat.completion.chunk", choices=[{"index": 0, "delta": d, "finish_reason": None}])
+            for d in deltas
+        ]
+        chunks.append(
+            dict(base, object="chat.completion.chunk", choices=[{"index": 0, "delta": {}, "finish_reason": finish}])
+        )
+        if (request.get("stream_options") or {}).get("include_usage"):
+            chunks.append(dict(base, object="chat.completion.chunk", choices=[], usage=usage))
+        body = "".join(f"data: {json.dumps(c)}\n\n" for c in chunks) + "data: [DONE]\n\n"
+        return 200, body.encode(), "text/event-stream"
+
+    def embeddings(self, request):
+        texts = request.get("input", [])
+        texts = [texts] if isinstance(texts, str) else texts
+        dim = request.get("dimensions") or 1536
+        data = []
+        for i, text in enumerate(texts):
+            seed = int.from_bytes(hashlib.blake2b(str(text).encode(), digest_size=8).digest(), "little")
+            rng = random.Random(seed)
+            data.append({"object": "embedding", "index": i, "embedding": [rng.uniform(-1, 1) for _ in range(dim)]})
+        return {
+            "object": "list",
+            "data": data,
+            "model": request.get("model", "fake"),
+            "usage": {"prompt_tokens": 0, "total_tokens": 0},
+        }
+
+
+def makePng(width=64, height=64, color=(200, 120, 160)):
+    """Returns a small solid color PNG as base64"""
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new("RGB", (width, height), color).save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+class FakeSD(FakeServer):
+    """The AUTOMATIC1111 txt2img and png-info endpoints. Every render takes
+    latency seconds and returns batch_size copies of a small PNG"""
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0):
+        super().__init__(host, port)
+        self.latency = latency
+        self.calls = []
+        self.lock = threading.Lock()
+        self.image = makePng()
+
+    def handle(self, method, path, headers, body):
+        request = json.loads(body or b"{}")
+        endpoint = path.split("?")[0].rstrip("/").rsplit("/", 1)[-1]
+        with self.lock:
+            self.calls.append((time.monotonic(), endpoint, request))
+        if endpoint == "txt2img":
+            time.sleep(self.latency)
+            count = int(request.get("batch_size") or 1)
+            seed = request.get("seed", -1)
+            seeds = [seed + i if seed not in (None, -1) else random.randrange(2**32) for i in range(count)]
+            infotexts = [f"{request.get('prompt', '')}\nSteps: {request.get('steps', 20)}, Seed: {s}" for s in seeds]
+            info = {"prompt": request.get("prompt", ""), "all_seeds": seeds, "seed": seeds[0], "infotexts": infotexts}
+            return 200, {"images": [self.image] * count, "parameters": request, "info": json.dumps(info)}
+        if endpoint == "png-info":
+            return 200, {"info": "Steps: 20, Seed: 1", "items": {}}
+        return 404, {"detail": "Not Found"}
+
+
+if __name__ == "__main__":
+    # python fakes.py telegram [port]
+    # Then run the bot with FRACTAL_TELEGRAM_BASE_URL=http://127.0.0.1:<port>/bot
+    # and type "<chatID> <message>" lines to send updates
+    # python fakes.py openai [port] / python fakes.py sd [port]
+    # serve the OpenAI (OPENAI_BASE_URL=http://127.0.0.1:<port>/v1) and SD
+    # (FRACTAL_SD_URL=http://127.0.0.1:<port>) fakes until interrupted
+    if len(sys.argv) > 1 and sys.argv[1] in ("openai", "sd"):
+        fakeClass, defaultPort = (FakeOpenAI, 8082) if sys.argv[1] == "openai" else (FakeSD, 7860)
+        fake = fakeClass(port=int(sys.argv[2]) if len(sys.argv) > 2 else defaultPort).start()
+        print(f"Fake {sys.argv[1]} listening on {fake.url}")
+        try:
+            fake.thread.join()
+        except KeyboardInterrupt:
+            fake.stop()
+    elif len(sys.argv) > 1 and sys.argv[1] == "telegram":
+        fake = FakeTelegram(port=int(sys.argv[2]) if len(sys.argv) > 2 else 8081).start()
+        fake.onCall = lambda method, params: print(f"<- {method} {params}")
+        print(f"Fake Telegram listening on {fake.url}/bot")
+        for line in sys.stdin:
+            chatID, _, text = line.strip().partition(" ")
+            if text:
+                fake.postUpdate(int(chatID), text)
+    else:
+        print("Usage: python fakes.py telegram|openai|sd [port]")
@@ -1,24 +1,34 @@
+# Annotations like Update are only for reading, so telegram isn't imported
+# until the bot is started (see buildApp)
+from __future__ import annotations
+
+import asyncio
+import copy
 import json
+import re
 import os
-import requests
-import io
-import base64
-from PIL import Image, PngImagePlugin
 from random import choice
 from datetime import datetime
-from openai import OpenAI 
+from urllib.parse import urlparse
 from typing import Final
-from telegram import Update
 import toolbox
-from telegram.ext import (
-    Application,
-    CommandHandler,
-    MessageHandler,
-    filters,
-    ContextTypes,
-)
+import history
+from state import UserStateCache
+from storage import openStorage
+from tasks import TaskStore
+from imagequeue import ImageQueue
+from imagecache import ImageCache, payloadKey
+from memory import MemoryCompactor
+from prompts import PromptCache
+from tokens import countTokens, countMessageTokens
+from llmcache import ResponseCache, requestKey
+from metrics import Metrics, MetricsServer
+import time
+
+# openai, telegram, httpx and numpy are imported where they're
+# first needed, so tools, workers and scripts can import this module quickly
+# and without credentials. main() checks the configuration
 
-client = OpenAI()
 
 def loadSystemParameters():
     params = ["TELEGRAM_API_KEY", "OPENAI_API_KEY"]
@@ -39,7 +49,7 @@ def loadSystemParameters():
             print("Please enter in a value for " + param)
             flag = True
     
-    if flag: exit(1)
+    if flag: raise SystemExit(1)
 
 def loadEnv(dotenv_path=".env"):
     """Load key-value pairs from a .env file into the environment."""
@@ -59,9 +69,28 @@ def loadEnv(dotenv_path=".env"):
 # To test the function
 # loadSystemParameters()
 
-loadSystemParameters()
+# Settings below may come from .env. Missing credentials are only reported by
+# main(), importing never fails
+if os.path.exists(".env") and not all(
+    os.environ.get(param) for param in ("TELEGRAM_API_KEY", "OPENAI_API_KEY")
+):
+    loadEnv()
 TOKEN = os.environ.get("TELEGRAM_API_KEY")
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
+# Webhook mode is used when FRACTAL_WEBHOOK_URL (the public https url Telegram
+# posts to) is set, long polling otherwise
+WEBHOOK_URL = os.environ.get("FRACTAL_WEBHOOK_URL")
+WEBHOOK_LISTEN = os.environ.get("FRACTAL_WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("FRACTAL_WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET = os.environ.get("FRACTAL_WEBHOOK_SECRET")
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("FRACTAL_WEBHOOK_MAX_CONNECTIONS", "40"))
+# Lets the bot talk to a local fake Bot API server, eg. fakes.FakeTelegram
+TELEGRAM_BASE_URL = os.environ.get("FRACTAL_TELEGRAM_BASE_URL")
+# AUTOMATIC1111 server used for images
+SD_URL = os.environ.get("FRACTAL_SD_URL", "http://127.0.0.1:7860")
+# Optional Prometheus text endpoint at http://<listen>:<port>/metrics
+METRICS_PORT = os.environ.get("FRACTAL_METRICS_PORT")
+METRICS_LISTEN = os.environ.get("FRACTAL_METRICS_LISTEN", "127.0.0.1")
 ADMIN_ID = 6146500807
 USER_ID = ADMIN_ID
 BOT_USERNAME = "@.bot"
@@ -79,8 +108,114 @@ defaultUserVars = {"tasks": [], "values": [], "interests": []}
 characterTraitsWeight = 1
 characterStartMessageFrequency = 3
 maxTokenSize = 2000
+# Prompt token budget per model. Models not listed use maxTokenSize
+modelTokenBudgets = {"gpt-3.5-turbo": maxTokenSize, "gpt-4o-mini": 8000}
+historyReadChunk = 32
+# Past messages / user facts added to the prompt by semantic recall
+recallResults = 4
+# Upper bound on simultaneous model requests shared by every user
+openaiMaxConnections = 32
+# How many Telegram updates may be processed at once. Updates from the same
+# chat always run one at a time, in order
+concurrentUpdates = 64
+# Rounds of tool calls allowed per message before the model must answer
+maxToolRounds = 3
+# Stream replies into a placeholder message that is edited as tokens arrive
+streamReplies = True
+# Parallel renders sent to the local SD server
+sdWorkers = 1
+# Seconds to wait for one txt2img call, hires renders can take minutes
+sdTimeout = 300.0
+# Most queued selfies rendered back to back as one batch when they share a
+# checkpoint and resolution
+sdMaxBatch = 4
+# Rendered selfies are kept by payload (prompts and settings, not seed). A
+# payload gets up to selfieVariants renders with their own seeds, after that
+# one of them is sent again right away. 0 always renders. Only SendSelfie
+# uses it, /mode sd prompts always render. The size bound is per process: in
+# shard mode every worker tracks its own total for the shared directory
+selfieVariants = 3
+selfieCache = ImageCache(
+    os.environ.get("FRACTAL_SELFIE_CACHE_DIR", "Data/SelfieCache"),
+    maxBytes=512 * 1024 * 1024,
+    variants=selfieVariants,
+)
+# Parsed prompt files and rendered prompt sections, refreshed when files change
+promptCache = PromptCache()
+varPattern = re.compile(r"\{\{(\w+)\}\}")
+# Responses of the helper model calls in toolbox (Agent.Do, evalTask), reused
+# for identical requests. Set FRACTAL_HELPER_CACHE_DIR to keep them on disk too
+helperCache = ResponseCache(
+    maxEntries=1000, ttl=24 * 3600, directory=os.environ.get("FRACTAL_HELPER_CACHE_DIR")
+)
+# Seconds between sweeps of expired helper responses from memory and disk
+helperCachePruneInterval = 3600
+helperCachePruner = None
+# Per-stage latencies and token usage, shown by /stats and the metrics endpoint
+metrics = Metrics()
+metricsServer = None
+# Json files under Data/ by default, or SQLite with FRACTAL_STORAGE=sqlite
+storage = openStorage()
+taskStore = TaskStore(storage.getUser, storage.setUser)
+
+# Built on first use by getClient(), getRecallIndex() and getSDClient()
+client = None
+recallIndex = None
+sdClient = None
+
+
+def getClient():
+    """One async client and connection pool for the whole process, so a slow
+    completion for one user never blocks the event loop for the others"""
+    global client
+    if client is None:
+        import httpx
+        from openai import AsyncOpenAI
+
+        client = AsyncOpenAI(
+            api_key=OPENAI_API_KEY,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=openaiMaxConnections,
+                    max_keepalive_connections=openaiMaxConnections,
+                ),
+                timeout=httpx.Timeout(60.0, connect=10.0),
+            ),
+        )
+    return client
+
+
+def getRecallIndex():
+    """Semantic recall over past messages and user facts. FRACTAL_EMBEDDER=hash
+    uses a deterministic local embedder instead of the OpenAI embeddings endpoint"""
+    global recallIndex
+    if recallIndex is None:
+        from recall import RecallIndex, HashEmbedder, OpenAIEmbedder
+
+        if os.environ.get("FRACTAL_EMBEDDER", "openai") == "hash":
+            recallIndex = RecallIndex(HashEmbedder())
+        else:
+            recallIndex = RecallIndex(OpenAIEmbedder(getClient()))
+    return recallIndex
+
+
+def loadConfig():
+    """Checks the credentials (from the environment or .env) and loads them"""
+    global TOKEN, OPENAI_API_KEY
+    loadSystemParameters()
+    TOKEN = os.environ.get("TELEGRAM_API_KEY")
+    OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
+
 
 def main():
+    loadConfig()
+    toolbox.getToolRegistry()
+    getClient()
+    getRecallIndex()
+    # One-shot conversion of any History.json files left from older versions
+    migrated = history.migrateAll()
+    if migrated:
+        print(f"Migrated {migrated} messages to History.jsonl")
     initComm()
 
 
@@ -96,9 +231,10 @@ def buildSDPayload(userID, parameters, type="default"):
     character = config.get("character")
     nsfwAllowed = config.get("nsfw") == "true"
 
-    SDPrompts = getSDDefault(userID, character)
-    SDNormalPrompt = SDPrompts.get("positive")
-    SDNegativePrompt = SDPrompts.get("negative")
+    # Characters without a Diffusion.json only get the generated parameters
+    SDPrompts = getSDDefault(userID, character) or {}
+    SDNormalPrompt = SDPrompts.get("positive", "")
+    SDNegativePrompt = SDPrompts.get("negative", "")
     SDExplicitPayload = SDPrompts.get("payload")
 
     SDPayload = None
@@ -114,85 +250,51 @@ def buildSDPayload(userID, parameters, type="default"):
     return SDPayload
 
 
-def updateConversation(userID, character, message):
+def updateConversation(userID, character, message, model=OPENAI_MODEL):
     """
-    Updates the conversation history for a given user and character.
+    Appends a message to the conversation history for a given user and character.
+    Only the new record is written, so the cost does not grow with the history.
 
     Parameters:
     - userID (str): The ID of the user.
     - character (str): The name of the character.
     - message (str): The message to be appended to the conversation history.
+    - model (str): The model whose tokenizer counts the message.
     """
-
-    # Define the file path
-    file_path = f"Data/{userID}/Characters/{character}/History.json"
-
-    # Read the old conversation data or initialize it as an empty list if the file is empty
-    try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            old = json.load(f)
-    except json.decoder.JSONDecodeError:
-        old = []
-
-    # Append the new message to the old conversation data
-    old.append(message)
-
-    # Write the updated conversation data back to the file
-    with open(file_path, "w", encoding="utf-8") as f:
-        json.dump(old, f, indent=4)
-
-
-def reduceMemory(userID, character):
-    # Selects all lines up til the fourth history line
-    with open(
-        f"Data/{userID}/Characters/{character}/CHPrompt.txt", "r", encoding="utf-8"
-    ) as f:
-        lines = f.readlines()
-        keepLines = []
-        for i in range(0, len(lines)):
-            if "--- history ---" in lines[i].lower():
-                keepLines.insert(i, lines[i])
-                if len(lines) > i + 3:
-                    keepLines.insert(i + 1, lines[i + 1])
-                    keepLines.insert(i + 2, lines[i + 2])
-                    keepLines.insert(i + 3, lines[i + 3])
-                break
-            keepLines.insert(i, lines[i])
-    # Rewrites files with selected lines
-    with open(f"{character}Prompt.txt", "w", encoding="utf-8") as f:
-        f.writelines(keepLines)
+    # Counted once here so building a prompt never re-tokenizes old messages
+    if "tokens" not in message:
+        message["tokens"] = countTokens(message.get("msg"), model)
+    storage.appendHistory(userID, character, message)
+    memoryCompactor.appended(userID, character)
 
 
 def getAvailableCharacters():
-    """Returns list of character names in global"""
+    """Returns list of character names in global. The folder is only listed
+    again after a character was added or removed"""
     folderToSearch = r"Characters"
-    if not os.path.exists(folderToSearch):
-        return []
-    files = os.listdir(folderToSearch)
-    characters = [
-        os.path.splitext(file)[0]
-        for file in files
-        if os.path.isfile(os.path.join(folderToSearch, file))
-    ]
-    return characters
-
 
-def getFileWordCount(character):
-    with open(f"{character}Prompt.txt", "r", encoding="utf-8") as infile:
-        words = 0
-        characters = 0
-        for lineno, line in enumerate(infile, 1):
-            wordslist = line.split()
-            words += len(wordslist)
-            # characters += sum(len(word) for word in wordslist)
-        return words
+    def build():
+        if not os.path.exists(folderToSearch):
+            return []
+        files = os.listdir(folderToSearch)
+        return [
+            os.path.splitext(file)[0]
+            for file in files
+            if os.path.isfile(os.path.join(folderToSearch, file))
+        ]
+
+    return promptCache.getRendered(
+        ("characters", None), promptCache.fileStamp(folderToSearch), build
+    )
 
 
 def getSDDefault(id, character):
-    with open(
-        f"Data/{id}/Characters/{character}/Diffusion.json", "r+", encoding="utf-8"
-    ) as f:
-        return json.load(f)
+    """The character's diffusion prompts, read again only after they were rewritten"""
+    return promptCache.getRendered(
+        (id, character, "diffusion"),
+        storage.diffusionStamp(id, character),
+        lambda: storage.getDiffusion(id, character),
+    )
 
 
 def insertSDParams(parameters, default, weight):
@@ -207,32 +309,46 @@ def insertSDParams(parameters, default, weight):
 def getCharacterPrompt(userID, character):
     """Returns a json representation of a character"""
     if userID == 0:
-        with open(f"Characters/{character}.json", "r+", encoding="utf-8") as f:
-            return json.load(f)
+        return promptCache.loadFile(f"Characters/{character}.json", json.loads)
     else:
-        with open(
-            f"Data/{userID}/Characters/{character}/CharacterCard.json",
-            "r+",
-            encoding="utf-8",
-        ) as f:
-            return json.load(f)
-
-# Learned something, only use one read() function in a with open f stream
+        return storage.getCard(userID, character)
+
+
 def getConversation(userID, character, chatID=None):
     """Returns a json conversation given userID, character name, and maybe, a chatID (for multiple chats)"""
-    with open(
-        f"Data/{userID}/Characters/{character}/History.json", "r", encoding="utf-8"
-    ) as f:
-        content = f.read()
-        if content == "":
-            return None
-        else:
-            return json.loads(content)
+    records = storage.readHistory(userID, character)
+    if not records:
+        return None
+    return records
 
 
 def getSystemPrompt():
-    with open(f"Prompt/system.txt", "r+", encoding="utf-8") as f:
-        return f.read()
+    return promptCache.loadFile("Prompt/system.txt")
+
+
+def getPromptSections(userID, character, userName):
+    """Returns the rendered system rules, character details and greeting for a
+    user and character. Built once and reused until Prompt/system.txt or the
+    character card changes"""
+    stamp = (
+        promptCache.fileStamp("Prompt/system.txt"),
+        storage.cardStamp(userID, character),
+    )
+
+    def build():
+        vars = {"user": userName, "char": character}
+        characterJson = getCharacterPrompt(userID, character) or {}
+        return {
+            "rules": varInsert(getSystemPrompt(), vars),
+            "characterDetails": varInsert(processJsonPrompt(characterJson), vars),
+            "firstMessage": varInsert(
+                processJsonPrompt(characterJson, get="Greeting"), vars
+            ),
+            # Optional list of tool names the character may use, None for all
+            "tools": characterJson.get("tools"),
+        }
+
+    return promptCache.getRendered((userID, character, userName), stamp, build)
 
 
 def varInsert(prompt: str, replacements: dict):
@@ -245,11 +361,9 @@ def varInsert(prompt: str, replacements: dict):
     returns "Hi, my name is joe. Hey joe, my name is clay
 
     """
-    for key, value in replacements.items():
-        placeholder = "{{" + key + "}}"
-        prompt = prompt.replace(placeholder, value)
-
-    return prompt
+    return varPattern.sub(
+        lambda match: str(replacements.get(match.group(1), match.group(0))), prompt
+    )
 
 
 def processJsonPrompt(obj, get=""):
@@ -267,9 +381,11 @@ def processJsonPrompt(obj, get=""):
         "Personality": ["personality"],
     }
 
+    showTitles = True
     if get != "":
         sepL = ""
         sepR = ""
+        showTitles = False
         include = {"Greeting": ["char_greeting", "greeting", "first_mes"]}
 
     if obj.get("spec") == "chara_card_v2":
@@ -282,10 +398,9 @@ def processJsonPrompt(obj, get=""):
             continue
         for prop in include[title]:
             if obj.get(prop):
-                new += f"{sepL}{title}{sepR}{obj[prop]}"
+                new += f"{sepL}{title if showTitles else ''}{sepR}{obj[prop]}"
                 added_titles.add(title)  # Mark title as added
                 break
-    print(new)
     return new.strip()
 
 
@@ -307,6 +422,12 @@ def processMessageSchema(obj):
         + "\n"
         + obj["system"]["userDetails"]
     )
+    if obj["system"].get("memory"):
+        system_content += "\n---Memory---\n" + obj["system"]["memory"]
+    if obj["system"].get("recall"):
+        system_content += "\n---Related Memories---\n" + "\n".join(
+            "- " + text for text in obj["system"]["recall"]
+        )
     system_message = {"role": "system", "content": system_content}
 
     assistant_message = {
@@ -323,111 +444,322 @@ def processMessageSchema(obj):
     else:
         for entry in obj["history"]:
             message = {"role": entry["role"], "content": entry["msg"]}
-        messages.append(message)
+            messages.append(message)
 
     messages.append(user_message)
 
     return messages  # May return messages with or without history
 
 
-def sendMessage(userID, character, userMessage):
-    """Takes a character name string and message as parameters. Inits the ai model. Decodes response. Returns dict if successfull"""
+def getTokenBudget(model=OPENAI_MODEL):
+    return modelTokenBudgets.get(model, maxTokenSize)
+
+
+def getBudgetedHistory(userID, character, budget, model=OPENAI_MODEL, first=0):
+    """Returns the most recent history records (oldest first) whose stored token
+    counts fit within budget, never reaching back before record first. Reads the
+    log newest-first in small chunks, so the cost depends on the budget and not
+    on how long the chat has run"""
+    selected = []
+    for record in storage.readHistoryBackwards(userID, character, first, historyReadChunk):
+        cost = countMessageTokens(record, model)
+        if cost > budget:
+            break
+        budget -= cost
+        selected.append(record)
+    selected.reverse()
+    return selected or None
+
+
+def buildContext(obj, userID, character, model=OPENAI_MODEL):
+    """Builds the message list from a message schema, adding the character's
+    long-term memory summary and filling obj["history"] with whatever recent
+    messages fit after the system prompt, greeting and new message. Messages
+    already folded into the summary are left out"""
+    memory = memoryCompactor.getMemory(userID, character)
+    obj["system"]["memory"] = memory["summary"]
+    obj["history"] = None
+    fixed = sum(countMessageTokens(m, model) for m in processMessageSchema(obj))
+    obj["history"] = getBudgetedHistory(
+        userID, character, getTokenBudget(model) - fixed, model, memory["covered"]
+    )
+    # Recalled messages that made it into the history anyway are redundant
+    if obj["system"].get("recall") and obj["history"]:
+        shown = {recallText(record) for record in obj["history"]}
+        obj["system"]["recall"] = [t for t in obj["system"]["recall"] if t not in shown]
+    return processMessageSchema(obj)
+
+
+def recallText(record):
+    """How a history record is stored in the recall index"""
+    return f"{record.get('name') or record['role']}: {record['msg']}"
+
+
+async def recallMemories(userID, character, userMessage):
+    """Returns past messages and user facts most similar to userMessage. The
+    facts are re-indexed from the task store's cached user data whenever it
+    changed. Recall failures never block a reply"""
+    try:
+        if not getRecallIndex().factsIndexed(userID, taskStore.revision(userID)):
+            revision, facts = await asyncio.to_thread(taskStore.facts, userID)
+            await getRecallIndex().rememberUserData(userID, facts, revision)
+        return await getRecallIndex().recall(userID, userMessage, character, k=recallResults)
+    except Exception as e:
+        print(f"Recall for {userID} failed: {e}")
+        return []
+
+
+def runInBackground(userID, coro):
+    """Runs coro as a task kept in backgroundTasks until it finishes, so it
+    can't be garbage collected midway and can be waited for"""
+    task = asyncio.create_task(coro)
+    tasks = backgroundTasks.setdefault(userID, set())
+    tasks.add(task)
+
+    def done(task):
+        tasks.discard(task)
+        if not tasks and backgroundTasks.get(userID) is tasks:
+            del backgroundTasks[userID]
+
+    task.add_done_callback(done)
+    return task
+
+
+async def waitForBackground(userID=None):
+    """Waits for userID's (or everyone's) background tasks and memory compactions"""
+    tasks = [
+        task
+        for user, userTasks in list(backgroundTasks.items())
+        if userID is None or user == userID
+        for task in userTasks
+    ]
+    tasks += [
+        task
+        for (user, _), task in list(memoryCompactor.running.items())
+        if userID is None or user == userID
+    ]
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def rememberTurn(userID, character, records):
+    """Indexes a finished turn's messages for later recall"""
+    try:
+        await getRecallIndex().remember(
+            userID,
+            [
+                {"kind": "message", "character": character, "text": recallText(record)}
+                for record in records
+            ],
+        )
+    except Exception as e:
+        print(f"Indexing messages for {userID} failed: {e}")
+
+
+async def summarizeHistory(summary, records):
+    """Folds a segment of history records into the running memory summary"""
+    transcript = "\n".join(f"{r.get('name', r['role'])}: {r['msg']}" for r in records)
+    response = await getClient().chat.completions.create(
+        model=OPENAI_MODEL,
+        messages=[
+            {
+                "role": "system",
+                "content": "You maintain the long-term memory of a chat. Update the summary with "
+                "the new messages. Keep names, facts about the user, plans, promises and "
+                "feelings. Write in third person, at most 200 words.",
+            },
+            {
+                "role": "user",
+                "content": f"Summary so far:\n{summary or '(empty)'}\n\nNew messages:\n{transcript}",
+            },
+        ],
+        temperature=0.3,
+    )
+    metrics.addUsage(OPENAI_MODEL, response.usage)
+    return response.choices[0].message.content or summary
+
+
+async def sendMessage(userID, character, userMessage, onText=None):
+    """Takes a character name string and message as parameters. Inits the ai model. Decodes response. Returns dict if successfull.
+    If onText is given the reply is streamed to it as it's generated"""
 
     config = getRuntimeVars(userID)
     user = config["userName"]
 
-    # May want to be changed later for more complexity
-    vars = {"user": user, "char": character}
-
-    systemPrompt = getSystemPrompt()
-    characterJson = getCharacterPrompt(userID, character)
+    with metrics.span("prompt.sections"):
+        sections = getPromptSections(userID, character, user)
     # Def needs to be changed
     userPrompt = ""
 
-    historyJson = getConversation(userID, character)  # May be none
-
-    # exit()
     messageSchema = {
         "system": {
-            "rules": varInsert(systemPrompt, vars),
-            "characterDetails": varInsert(processJsonPrompt(characterJson), vars),
-            "userDetails": varInsert(userPrompt, vars),
+            "rules": sections["rules"],
+            "characterDetails": sections["characterDetails"],
+            "userDetails": userPrompt,
         },
-        "assistant": {
-            "firstMessage": varInsert(
-                processJsonPrompt(characterJson, get="Greeting"), vars
-            )
-        },
-        "history": historyJson,
+        "assistant": {"firstMessage": sections["firstMessage"]},
+        "history": None,
         "user": userMessage,
     }
-    print(messageSchema)
-
-    messages = processMessageSchema(messageSchema)
 
-    availableTools = toolbox.getAvailableTools()
+    with metrics.span("recall"):
+        messageSchema["system"]["recall"] = await recallMemories(userID, character, userMessage)
+    with metrics.span("prompt.context"):
+        messages = buildContext(messageSchema, userID, character)
 
-    toolInstances = {tool.__name__: tool() for tool in availableTools}
-    toolSchemas = [instance.schema for instance in toolInstances.values()]
-    functions = toolSchemas
-
-    client.api_key = OPENAI_API_KEY
-    
-    response = client.chat.completions.create(
-        model=OPENAI_MODEL,
-        messages=messages,
-        temperature=1,
-        frequency_penalty=0.7,
-        presence_penalty=0,
-        top_p=1,
-        functions=functions,
-        function_call="auto",
-    )
+    # Only the tools relevant to this message are sent, to keep the prompt small
+    registry = toolbox.getToolRegistry()
+    # Task tools are offered from the task store, which may load from disk
+    tools = await asyncio.to_thread(registry.select, userMessage, sections["tools"], userID)
+    toolArgs = {"tools": tools, "tool_choice": "auto"} if tools else {}
 
     replyText = ""
-    secondResponse = None
-    secondResponseMsg = None
-    responseMsg = response.choices[0].message
-    if responseMsg.content:
-        replyText = characterMessageClean(responseMsg.content, character)
-
-    if responseMsg.function_call:
-        chosenTool = toolInstances.get(responseMsg.function_call.name)
-        functionToCall = chosenTool.func
-
-        functionJsonArgs = json.loads(responseMsg.function_call.arguments)
+    for toolRound in range(maxToolRounds + 1):
+        # The last round offers no tools so the model has to answer in text
+        responseMsg = await getCompletion(
+            messages,
+            character,
+            onText,
+            span="completion.first" if toolRound == 0 else "completion.followup",
+            **(toolArgs if toolRound < maxToolRounds else {}),
+        )
+        if responseMsg["content"]:
+            replyText = characterMessageClean(responseMsg["content"], character)
 
-        functionResponse = None
-        if chosenTool.needID:
-            functionResponse = functionToCall(userID, functionJsonArgs)
-        else:
-            functionResponse = functionToCall(functionJsonArgs)
+        toolCalls = responseMsg["tool_calls"]
+        if not toolCalls:
+            break
 
-        messages.append(responseMsg)
         messages.append(
             {
-                "role": "function",
-                "name": responseMsg["function_call"]["name"],
-                "content": str(functionResponse),
+                "role": "assistant",
+                "content": responseMsg["content"],
+                "tool_calls": [
+                    {"id": call["id"], "type": "function", "function": call["function"]}
+                    for call in toolCalls
+                ],
             }
         )
-        secondResponse = client.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=messages,
-            temperature=1,
-            frequency_penalty=0.7,
-            presence_penalty=0,
-            top_p=1,
-        )
-
-    if secondResponse:
-        secondResponseMsg = secondResponse["choices"][0]["message"]
-        replyText = characterMessageClean(secondResponseMsg["content"], character)
+        # Every call from this round runs at once and all results go back in one request
+        results = await toolbox.callTools(registry, userID, toolCalls)
+        for call, result in zip(toolCalls, results):
+            messages.append(
+                {"role": "tool", "tool_call_id": call["id"], "content": str(result)}
+            )
 
-    print(response)
     return replyText
 
 
+async def getCachedCompletion(**kwargs):
+    """chat.completions.create for deterministic helper calls. Identical
+    requests (same model, messages, tools, ...) are answered from helperCache"""
+    key = requestKey(**kwargs)
+    cached = helperCache.get(key)
+    if cached is not None:
+        from openai.types.chat import ChatCompletion
+
+        return ChatCompletion.model_validate(cached)
+    response = await getClient().chat.completions.create(**kwargs)
+    metrics.addUsage(kwargs.get("model"), response.usage)
+    helperCache.put(key, response.model_dump(mode="json", exclude_unset=True))
+    return response
+
+
+async def getCompletion(messages, character, onText=None, span="completion", **kwargs):
+    """Runs one chat completion and returns {"content", "tool_calls"}, where
+    tool_calls is a list of {"id", "function": {"name", "arguments"}} or None.
+    The model call is timed as span.
+
+    When onText is given the completion is streamed and onText(text) gets the
+    cleaned reply so far as content arrives. It runs in its own task, one call
+    at a time with the newest text, so the stream (and span) never waits for
+    Telegram. Tool calls arriving mid-stream are assembled from their deltas
+    and returned like normal ones, with any text streamed before them kept in
+    content.
+    """
+    params = dict(
+        model=OPENAI_MODEL,
+        messages=messages,
+        temperature=1,
+        frequency_penalty=0.7,
+        presence_penalty=0,
+        top_p=1,
+        **kwargs,
+    )
+    if onText is None:
+        with metrics.span(span):
+            response = await getClient().chat.completions.create(**params)
+        metrics.addUsage(params["model"], response.usage)
+        message = response.choices[0].message
+        toolCalls = None
+        if message.tool_calls:
+            toolCalls = [
+                {
+                    "id": call.id,
+                    "function": {
+                        "name": call.function.name,
+                        "arguments": call.function.arguments,
+                    },
+                }
+                for call in message.tool_calls
+            ]
+        return {"content": message.content, "tool_calls": toolCalls}
+
+    content = ""
+    toolCalls = {}  # index -> call, filled in from deltas
+    latest = None  # newest text not passed to onText yet
+    editing = None  # task passing it on
+
+    async def passOn():
+        nonlocal latest
+        while latest is not None:
+            text, latest = latest, None
+            await onText(text)
+
+    try:
+        with metrics.span(span):
+            started = time.perf_counter()
+            firstToken = True
+            stream = await getClient().chat.completions.create(
+                stream=True, stream_options={"include_usage": True}, **params
+            )
+            async for chunk in stream:
+                # Usage arrives in a last chunk without choices
+                if chunk.usage:
+                    metrics.addUsage(params["model"], chunk.usage)
+                if not chunk.choices:
+                    continue
+                if firstToken:
+                    metrics.observe("completion.firstToken", time.perf_counter() - started)
+                    firstToken = False
+                delta = chunk.choices[0].delta
+                for part in delta.tool_calls or []:
+                    call = toolCalls.setdefault(
+                        part.index, {"id": "", "function": {"name": "", "arguments": ""}}
+                    )
+                    call["id"] += part.id or ""
+                    if part.function:
+                        call["function"]["name"] += part.function.name or ""
+                        call["function"]["arguments"] += part.function.arguments or ""
+                if delta.content:
+                    content += delta.content
+                    latest = characterMessageClean(content, character)
+                    if editing is None or editing.done():
+                        if editing is not None:
+                            editing.result()  # raises what onText raised
+                        editing = asyncio.create_task(passOn())
+        # The last edit lands before the caller finishes the reply
+        if editing is not None:
+            await editing
+    finally:
+        if editing is not None and not editing.done():
+            editing.cancel()
+    return {
+        "content": content or None,
+        "tool_calls": [toolCalls[i] for i in sorted(toolCalls)] or None,
+    }
+
+
 def characterMessageClean(text, character):
     useTelegram = False
     if useTelegram:
@@ -438,23 +770,193 @@ def characterMessageClean(text, character):
         return text
 
 
-def getImage(payload):
-    config = getRuntimeVars(USER_ID)
-    url = "http://127.0.0.1:7860"
-    response = requests.post(url=f"{url}/sdapi/v1/txt2img", json=payload)
-    r = response.json()
+async def getImage(payload, userID=USER_ID):
+    return (await getImages(payload, [userID]))[0]
+
+
+async def getImages(payload, userIDs):
+    """Renders one image per user in userIDs with a single txt2img call
+    (batch_size). Returns {"png", "info", "userID", "character"} dicts with the
+    PNG bytes and the generation parameters from the response's info"""
+    import base64
+
+    if len(userIDs) > 1:
+        payload = dict(payload, batch_size=len(userIDs))
+    with metrics.span("sd.render"):
+        response = await getSDClient().post(f"{SD_URL}/sdapi/v1/txt2img", json=payload)
+        response.raise_for_status()
+        r = response.json()
+
+    # info is a json string, with one infotext (the text A1111 writes into
+    # saved PNGs) per image
+    try:
+        info = json.loads(r.get("info") or "{}")
+    except ValueError:
+        info = {}
+    infotexts = info.get("infotexts") or []
+    images = []
+    for n, (userID, encoded) in enumerate(zip(userIDs, r["images"])):
+        images.append({
+            "png": base64.b64decode(encoded.split(",", 1)[-1]),
+            "info": infotexts[n] if n < len(infotexts) else "",
+            "userID": userID,
+            "character": getRuntimeVars(userID).get("character"),
+        })
+    if len(images) < len(userIDs):
+        raise ValueError(f"SD server returned {len(images)} of {len(userIDs)} images")
+    return images
+
+
+def getSDClient():
+    """One async connection pool to the SD server, created on first render"""
+    global sdClient
+    if sdClient is None:
+        import httpx
+
+        sdClient = httpx.AsyncClient(timeout=httpx.Timeout(sdTimeout, connect=10.0))
+    return sdClient
+
+
+def addPngText(png, key, text):
+    """Returns png with a tEXt chunk after the header, the way PIL's PngInfo
+    would store it, without decoding the image"""
+    import struct
+    import zlib
+
+    data = key.encode("latin-1") + b"\0" + text.encode("latin-1", "replace")
+    chunk = struct.pack(">I", len(data)) + b"tEXt" + data
+    chunk += struct.pack(">I", zlib.crc32(b"tEXt" + data))
+    # 8 byte signature, then IHDR: length, type, 13 bytes of data and crc
+    headerEnd = 8 + 4 + 4 + 13 + 4
+    return png[:headerEnd] + chunk + png[headerEnd:]
+
+
+def archiveImage(image):
+    """Saves a delivered image with its parameters to the user's Output
+    folder, and new renders to the selfie cache. Cached images already carry
+    their parameters (info is None)"""
+    png = image["png"]
+    if image["info"] is not None:
+        png = addPngText(png, "parameters", image["info"])
+    directory = f"Data/{image['userID']}/Characters/{image['character']}/Output"
+    os.makedirs(directory, exist_ok=True)
+    date = datetime.now().strftime("%m-%d-%H-%M-%S-%f")
+    path = f"{directory}/output{date}.png"
+    with open(path, "wb") as f:
+        f.write(png)
+    if image.get("cacheKey"):
+        selfieCache.put(image["cacheKey"], png)
+    return path
+
+
+async def renderImage(job):
+    image = await getImage(job["payload"], job["userID"])
+    image["cacheKey"] = job.get("cacheKey")
+    return image
+
+
+def sdBatchKey(job):
+    """Jobs with the same checkpoint and resolution are rendered together, so
+    the SD server doesn't switch models between them"""
+    payload = job["payload"]
+    return (
+        (payload.get("override_settings") or {}).get("sd_model_checkpoint"),
+        payload.get("width"),
+        payload.get("height"),
+        payload.get("hr_scale"),
+    )
 
-    for i in r["images"]:
-        image = Image.open(io.BytesIO(base64.b64decode(i.split(",", 1)[0])))
-        png_payload = {"image": "data:image/png;base64," + i}
-        response2 = requests.post(url=f"{url}/sdapi/v1/png-info", json=png_payload)
-        pnginfo = PngImagePlugin.PngInfo()
-        pnginfo.add_text("parameters", response2.json().get("info"))
-        now = datetime.now()
-        date = now.strftime("%m-%d-%H-%M")
-        path = f"C:/Users/cw1a/AI/Fractal/Data/{USER_ID}/Characters/{config.get('character')}/output/output{date}.png"
-        image.save(path, pnginfo=pnginfo)
-        return path
+
+async def renderImages(jobs):
+    """Renders a batch from the image queue. The SD API takes one prompt per
+    call, so jobs whose payloads only differ by seed share one batch_size call
+    and the rest follow back to back on the already loaded checkpoint"""
+    groups = {}
+    for i, job in enumerate(jobs):
+        groups.setdefault(job.get("cacheKey") or payloadKey(job["payload"]), []).append(i)
+    images = [None] * len(jobs)
+    for indexes in groups.values():
+        first = jobs[indexes[0]]["payload"]
+        try:
+            rendered = await getImages(first, [jobs[i]["userID"] for i in indexes])
+        except Exception as e:
+            rendered = [e] * len(indexes)
+        for i, image in zip(indexes, rendered):
+            if isinstance(image, dict):
+                image["cacheKey"] = jobs[i].get("cacheKey")
+            images[i] = image
+    return images
+
+
+async def deliverImage(userID, image):
+    """Sends the image from memory, then archives it. A failed save is only
+    logged since the user already has their picture"""
+    with metrics.span("telegram.sendPhoto"):
+        await telegramBot.send_photo(chat_id=userID, photo=image["png"])
+    try:
+        with metrics.span("sd.archive"):
+            await asyncio.to_thread(archiveImage, image)
+    except OSError as e:
+        print(f"Could not archive image for {userID}: {e}")
+
+
+async def failImage(userID, error):
+    await telegramBot.send_message(chat_id=userID, text="Couldn't take that picture :(")
+
+
+# Long conversations are summarized in the background once they pass the threshold
+memoryCompactor = MemoryCompactor(storage, summarizeHistory)
+# userID -> tasks started by runInBackground that are still running
+backgroundTasks = {}
+
+# Renders run in the background so replies never wait on the SD server
+imageQueue = ImageQueue(
+    renderImage, deliverImage, failImage, workers=sdWorkers,
+    batchKey=sdBatchKey, renderBatch=renderImages, maxBatch=sdMaxBatch,
+)
+telegramBot = None
+
+
+def queueImage(userID, payload, cached=False):
+    """Queues a render for userID. Returns its position or None if they have
+    too many pending. With cached (selfies), an image already in selfieCache is
+    sent right away (position 0) and new renders are added to it"""
+    if not cached:
+        return imageQueue.submit(userID, {"userID": userID, "payload": payload})
+    key = payloadKey(payload)
+    path = selfieCache.pick(key)
+    job = {"userID": userID, "payload": payload, "cacheKey": key}
+    if path is not None:
+        runInBackground(userID, deliverCachedImage(job, path))
+        return 0
+    return imageQueue.submit(userID, job)
+
+
+async def deliverCachedImage(job, path):
+    def read():
+        with open(path, "rb") as f:
+            return f.read()
+
+    userID = job["userID"]
+    try:
+        with metrics.span("sd.cached"):
+            png = await asyncio.to_thread(read)
+    except FileNotFoundError:
+        # Evicted in the meantime, render it after all
+        if imageQueue.submit(userID, job) is None:
+            await failImage(userID, None)
+        return
+    try:
+        image = {
+            "png": png,
+            "info": None,
+            "userID": userID,
+            "character": getRuntimeVars(userID).get("character"),
+        }
+        await deliverImage(userID, image)
+    except Exception as e:
+        print(f"Cached image for {userID} failed: {e}")
+        await failImage(userID, e)
 
 
 def getTime():
@@ -464,20 +966,94 @@ def getTime():
 
 
 # [1] Entry
-def initComm():
-    app = Application.builder().token(TOKEN).build()
+def buildApp(withUpdater=True):
+    """Builds the Application. Shard workers (shard.py) are handed their
+    updates by the dispatcher and build it without an updater"""
+    from telegram.ext import Application, CommandHandler, MessageHandler, filters
+    from dispatch import PerUserUpdateProcessor
+
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor(concurrentUpdates))
+        .post_init(postInit)
+        .post_shutdown(postShutdown)
+    )
+    if not withUpdater:
+        builder = builder.updater(None)
+    if TELEGRAM_BASE_URL:
+        builder = builder.base_url(TELEGRAM_BASE_URL).base_file_url(TELEGRAM_BASE_URL)
+    app = builder.build()
     app.add_handler(CommandHandler("start", start_command))
     app.add_handler(CommandHandler("mode", mode_command))
     app.add_handler(CommandHandler("clear", clear_command))
+    app.add_handler(CommandHandler("queue", queue_command))
+    app.add_handler(CommandHandler("stats", stats_command))
     app.add_handler(MessageHandler(filters.TEXT, handleMessage))
     app.add_error_handler(error)
+    return app
 
-    print("Polling...")
-    app.run_polling(poll_interval=5)
+
+def initComm():
+    app = buildApp()
+
+    if WEBHOOK_URL:
+        # Telegram pushes updates to the built-in listener. The url path is
+        # taken from the public url so a reverse proxy can forward it as is
+        print(f"Listening for webhooks on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}...")
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=urlparse(WEBHOOK_URL).path.lstrip("/"),
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+    else:
+        print("Polling...")
+        # Long polling already returns as soon as an update arrives, so no
+        # extra sleep between requests
+        app.run_polling(poll_interval=0)
+
+
+async def postInit(app: Application):
+    global telegramBot, metricsServer, helperCachePruner
+    telegramBot = app.bot
+    imageQueue.start()
+    helperCachePruner = asyncio.create_task(pruneHelperCache())
+    if METRICS_PORT:
+        metricsServer = MetricsServer(metrics, METRICS_LISTEN, int(METRICS_PORT)).start()
+        print(f"Metrics at http://{METRICS_LISTEN}:{METRICS_PORT}/metrics")
+
+
+async def postShutdown(app: Application):
+    # Memories of the last turns are written before stopping
+    await waitForBackground()
+    await imageQueue.stop()
+    if helperCachePruner:
+        helperCachePruner.cancel()
+    if sdClient:
+        await sdClient.aclose()
+    if metricsServer:
+        metricsServer.stop()
+
+
+async def pruneHelperCache():
+    """Drops expired helper responses every helperCachePruneInterval seconds,
+    in a worker thread since it lists the cache directory"""
+    while True:
+        await asyncio.sleep(helperCachePruneInterval)
+        try:
+            removed = await asyncio.to_thread(helperCache.prune)
+        except Exception as e:
+            print(f"Pruning the helper cache failed: {e}")
+            continue
+        if removed:
+            print(f"Pruned {removed} expired helper responses")
 
 
 def checkUserExists(userID):
-    return os.path.exists(f"Data/{userID}")
+    return storage.userExists(userID)
 
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -498,6 +1074,31 @@ async def clear_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(f"Erased {character}'s memory :(")
 
 
+async def queue_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    stats = imageQueue.stats()
+    await update.message.reply_text(
+        f"Images waiting: {stats['depth']} | rendering: {stats['running']}\n"
+        f"Avg wait: {stats['avgWait']:.1f}s | max wait: {stats['maxWait']:.1f}s"
+    )
+
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Admin only, everyone else gets no answer
+    if update.message.chat.id != ADMIN_ID:
+        return
+    queue = imageQueue.stats()
+    cache = helperCache.stats()
+    selfies = selfieCache.stats()
+    await update.message.reply_text(
+        metrics.summary()
+        + f"\nImages waiting: {queue['depth']} | rendering: {queue['running']}"
+        + f" | batched renders: {queue['batches']}"
+        + f"\nSelfie cache: {selfies['hits']} hits, {selfies['misses']} misses, "
+        + f"{selfies['bytes'] // 1024} KB"
+        + f"\nHelper cache: {cache['hits']} hits, {cache['misses']} misses"
+    )
+
+
 async def mode_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text
     userID = update.message.chat.id
@@ -518,8 +1119,29 @@ async def mode_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 def clearConversation(userID, character):
-    with open(f"Data/{userID}/Characters/{character}/History.json", "w") as f:
-        f.write("")
+    storage.clearHistory(userID, character)
+    memoryCompactor.clearMemory(userID, character)
+    getRecallIndex().forget(userID, character)
+
+
+def cachedUsers():
+    """Users with anything cached in this process's memory"""
+    users = set(runtimeCache.entries) | set(taskStore.loaded)
+    users |= {userID for userID, _ in list(memoryCompactor.memories) + list(memoryCompactor.counts)}
+    if recallIndex is not None:
+        users |= set(recallIndex.store.items)
+    return users
+
+
+async def releaseUser(userID):
+    """Writes out and forgets everything cached in memory for a user, before
+    another process takes over their chat. Their background work finishes first"""
+    await waitForBackground(userID)
+    runtimeCache.drop([userID])
+    taskStore.invalidate(userID)
+    memoryCompactor.release(userID)
+    if recallIndex is not None:
+        recallIndex.release(userID)
 
 
 def characterSelect(text, userID):
@@ -552,11 +1174,13 @@ def processUserInit(text: str, userID):
 
 
 # [2] Incoming messages come here
+@metrics.timed("message")
 async def handleMessage(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text
     userID = update.message.chat.id
     USER_ID = userID
-    config = getRuntimeVars(userID)
+    with metrics.span("runtime.read"):
+        config = getRuntimeVars(userID)
     response = ""
 
     canChat = config.get("userName") != "Guest" and config.get("character") != None
@@ -571,33 +1195,49 @@ async def handleMessage(update: Update, context: ContextTypes.DEFAULT_TYPE):
         setRuntimeVars(userID, {"lastMessageTime": getTime()})
 
         if doStableDiffusion:
-            imagePath = getImage(buildSDPayload(userID, "(" + text + ")"))
-            sendPhoto(imagePath, userID)
+            position = queueImage(userID, buildSDPayload(userID, ["(" + text + ")"]))
+            if position is None:
+                await update.message.reply_text("Slow down, still working on your last ones")
+            else:
+                await update.message.reply_text(f"Painting... (#{position} in line)")
 
         else:
             feedback = ""
             parameters = ""
 
-            characterMessage = sendMessage(userID, config["character"], text)
+            reply = None
+            if streamReplies:
+                from streaming import StreamingReply
+
+                reply = StreamingReply(update.message)
+                await reply.start()
+                characterMessage = await sendMessage(
+                    userID, config["character"], text, onText=reply.update
+                )
+            else:
+                characterMessage = await sendMessage(userID, config["character"], text)
             print(f"{config['character']}: {characterMessage}")
-            updateConversation(
-                userID,
-                config["character"],
-                {"name": config["userName"], "role": "user", "msg": text},
-            )
-            updateConversation(
-                userID,
-                config["character"],
-                {
-                    "name": config["character"],
-                    "role": "assistant",
-                    "msg": characterMessage,
-                },
-            )
+            userRecord = {"name": config["userName"], "role": "user", "msg": text}
+            characterRecord = {
+                "name": config["character"],
+                "role": "assistant",
+                "msg": characterMessage,
+            }
+            with metrics.span("history.write"):
+                updateConversation(userID, config["character"], userRecord)
+                updateConversation(userID, config["character"], characterRecord)
 
-            # sendPhoto(getImage(buildSDPayload(userID, parameters)), userID)
+            with metrics.span("telegram.reply"):
+                if reply:
+                    await reply.finish(characterMessage)
+                else:
+                    await update.message.reply_text(characterMessage)
 
-            await update.message.reply_text(characterMessage)
+            # Folds old messages into long-term memory after the reply went out
+            memoryCompactor.schedule(userID, config["character"])
+            runInBackground(
+                userID, rememberTurn(userID, config["character"], [userRecord, characterRecord])
+            )
 
     # Still choosing their config
     else:
@@ -611,35 +1251,24 @@ async def error(update: Update, context: ContextTypes.DEFAULT_TYPE):
     print(f"Update {update} caused error {context.error}")
 
 
-def sendPhoto(file, chatID):
-    url = f"https://api.telegram.org/bot{TOKEN}/sendPhoto?chat_id={chatID}"
-    img = open(file, "rb")
-    requests.post(url, files={"photo": img})
-
-
 def setRuntimeVars(id: int, data: dict):
     """Appends new dictionary items to existing or non-existing config"""
-    old = getRuntimeVars(id)
-    old.update(data)
-    with open(f"Data/{id}/Runtime.json", "w") as f:
-        json.dump(old, f)
-
-    """Creates a new folder tree and associated files for a user | Overwrites runtime if called"""
+    runtimeCache.update(id, data)
 
 
 def genRuntimeVars(id):
+    """Creates a new folder tree and associated files for a user | Overwrites runtime if called"""
     if id == 0:
         id = 6146500807
     os.makedirs(f"Data/{id}/Characters", exist_ok=True)
-    with open(f"Data/{id}/Runtime.json", "w") as f:
-        data = defaultRuntimeVars
-        data["id"] = id
-        json.dump(data, f)
+    runtime = dict(defaultRuntimeVars)
+    runtime["id"] = id
+    storage.storeRuntime(id, runtime)
+    runtimeCache.discard(id)
     # Will not ever overwrite User storage
-    if not os.path.exists(f"Data/{id}/User.json"):
-        with open(f"Data/{id}/User.json", "w") as f:
-            data = defaultUserVars
-            json.dump(data, f)
+    if storage.getUser(id) is None:
+        storage.setUser(id, defaultUserVars)
+    return runtime
 
 
 def genCharacterVars(
@@ -647,58 +1276,61 @@ def genCharacterVars(
     character,
     useGlobal=False,
     overWrite=False,
-    targets=["History.json", "CharacterCard.json"],
+    targets=["CharacterCard.json"],
 ):
     newDir = f"Data/{id}/Characters/{character}"
     print(newDir)
     os.makedirs(newDir + "/Output", exist_ok=True)
     for target in targets:
-        if not os.path.exists(newDir + "/" + target):
-            with open(f"{newDir}/{target}", "w") as f:
-                if useGlobal and target == "CharacterCard.json":
-                    json.dump(getCharacterPrompt(0, character), f)
-                else:
-                    f.write("")
-        if overWrite:
+        if target == "CharacterCard.json":
+            if overWrite or storage.getCard(id, character) is None:
+                card = getCharacterPrompt(0, character) if useGlobal else {}
+                storage.setCard(id, character, card)
+                promptCache.invalidate(id, character)
+        elif not os.path.exists(newDir + "/" + target) or overWrite:
             with open(f"{newDir}/{target}", "w") as f:
-                if useGlobal:
-                    json.dump(getCharacterPrompt(0, character), f)
-                else:
-                    f.write("")
+                f.write("")
 
 
 def getRuntimeVars(id):
     """Returns a dict of id's config. Creates a blank config if none found"""
-    if not os.path.exists(f"Data/{id}/Runtime.json"):
-        genRuntimeVars(id)
-    with open(f"Data/{id}/Runtime.json", "r") as f:
-        return json.load(f)
+    return runtimeCache.get(id)
+
+
+def loadRuntimeVars(id):
+    runtime = storage.loadRuntime(id)
+    if runtime is None:
+        return genRuntimeVars(id)
+    return runtime
+
+
+# Runtime.json is read several times per message, so it is served from memory
+# and written back in the background
+runtimeCache = UserStateCache(loadRuntimeVars, lambda id, data: storage.storeRuntime(id, data))
 
 
 def clearRuntimeVars(id):
     """Replaces runtime vars with default"""
-    data = defaultRuntimeVars
+    data = dict(defaultRuntimeVars)
     data["id"] = id
-    if not os.path.exists(f"Data/{id}/Runtime.json"):
+    if storage.loadRuntime(id) is None:
         genRuntimeVars(id)
-    with open(f"Data/{id}/Runtime.json", "w") as f:
-        json.dump(data, f)
+    runtimeCache.put(id, data)
 
 
 def getSDPayload(type):
-    with open(f"Payloads.json", "r") as f:
-        return json.load(f)[type]
+    """A copy of the named payload template. Payloads.json is parsed again only after it changes"""
+    return copy.deepcopy(promptCache.loadFile("Payloads.json", json.loads)[type])
 
 
 def getUserData(userID):
-    with open(f"Data/{userID}/User.json", "r", encoding="utf-8") as f:
-        return json.load(f)
+    return storage.getUser(userID)
 
 
 def setUserData(userID, new):
-    if os.path.exists(f"Data/{userID}/User.json"):
-        with open(f"Data/{userID}/User.json", "w+", encoding="utf-8") as f:
-            json.dump(new, f, indent=4)
+    if storage.getUser(userID) is not None:
+        storage.setUser(userID, new)
+        taskStore.invalidate(userID)
 
 
 # vars = {"user": "Clay", "char": "Loona"}
@@ -0,0 +1,187 @@
+import json
+import os
+import struct
+import sys
+
+# Each character's conversation lives in History.jsonl, one JSON record per line.
+# History.idx holds the byte offset of every record as a little-endian uint64, so
+# appending costs one write per file and any slice of records is one seek away.
+logName = "History.jsonl"
+indexName = "History.idx"
+legacyName = "History.json"
+offsetStruct = struct.Struct("<Q")
+
+
+def logPaths(directory):
+    return os.path.join(directory, logName), os.path.join(directory, indexName)
+
+
+def appendRecord(directory, record):
+    """Appends a single record to the log and its offset to the index"""
+    logPath, indexPath = logPaths(directory)
+    line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+    offset = recoverTail(directory)
+    with open(logPath, "ab") as log:
+        log.write(line)
+    with open(indexPath, "ab") as index:
+        index.write(offsetStruct.pack(offset))
+    return offset
+
+
+def recoverTail(directory):
+    """Makes the log end right after its last indexed record and returns that
+    size. Only the last record is read. After an interrupted append, whole
+    lines that never made it into the index are indexed and a torn partial
+    line is cut off, so the next record starts on its own line"""
+    logPath, indexPath = logPaths(directory)
+    if not os.path.exists(logPath):
+        return 0
+    count = countRecords(directory)
+    start = 0
+    if count:
+        with open(indexPath, "rb") as index:
+            index.seek((count - 1) * offsetStruct.size)
+            start = offsetStruct.unpack(index.read(offsetStruct.size))[0]
+    with open(logPath, "rb") as log:
+        log.seek(start)
+        tail = log.read()
+
+    position = start
+    rest = tail
+    if count:
+        newline = tail.find(b"\n")
+        if newline == -1:
+            # The last indexed record itself is torn
+            count -= 1
+        else:
+            position += newline + 1
+            rest = tail[newline + 1 :]
+    # Whole lines end with a newline, torn is whatever follows the last one
+    *complete, torn = rest.split(b"\n")
+    offsets = bytearray()
+    for line in complete:
+        if line.strip():
+            offsets += offsetStruct.pack(position)
+        position += len(line) + 1
+    if torn:
+        print(f"Dropping {len(torn)} bytes of a torn record in {logPath}")
+        with open(logPath, "r+b") as log:
+            log.truncate(position)
+    if offsets or countRecords(directory) != count:
+        with open(indexPath, "ab") as index:
+            index.truncate(count * offsetStruct.size)
+            index.write(offsets)
+    return position
+
+
+def countRecords(directory):
+    """Returns the number of records in the log without reading it"""
+    try:
+        return os.path.getsize(logPaths(directory)[1]) // offsetStruct.size
+    except FileNotFoundError:
+        return 0
+
+
+def readRecords(directory, start=0, end=None):
+    """Returns records[start:end] (slice semantics, negatives allowed) using the
+    index to seek straight to the first record instead of parsing the whole log"""
+    logPath, indexPath = logPaths(directory)
+    count = countRecords(directory)
+    start, end, _ = slice(start, end).indices(count)
+    if start >= end:
+        return []
+
+    with open(indexPath, "rb") as index:
+        index.seek(start * offsetStruct.size)
+        first = offsetStruct.unpack(index.read(offsetStruct.size))[0]
+        last = None
+        if end < count:
+            index.seek(end * offsetStruct.size)
+            last = offsetStruct.unpack(index.read(offsetStruct.size))[0]
+
+    with open(logPath, "rb") as log:
+        log.seek(first)
+        data = log.read() if last is None else log.read(last - first)
+
+    # Anything after the last indexed record is left for recoverTail, and a
+    # line that doesn't decode (torn by an older version) is skipped
+    records = []
+    lines = [line for line in data.split(b"\n") if line.strip()]
+    for line in lines[: end - start]:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            print(f"Skipping an unreadable record in {logPath}")
+    return records
+
+
+def clearRecords(directory):
+    """Truncates the log and its index"""
+    for path in logPaths(directory):
+        if os.path.exists(path):
+            with open(path, "wb"):
+                pass
+
+
+def rebuildIndex(directory):
+    """Regenerates History.idx from History.jsonl, eg. after an interrupted append"""
+    logPath, indexPath = logPaths(directory)
+    offsets = bytearray()
+    if os.path.exists(logPath):
+        with open(logPath, "rb") as log:
+            offset = 0
+            for line in log:
+                # A last line without a newline is a torn append
+                if line.strip() and line.endswith(b"\n"):
+                    offsets += offsetStruct.pack(offset)
+                offset += len(line)
+    with open(indexPath, "wb") as index:
+        index.write(offsets)
+
+
+def migrateHistoryJson(directory):
+    """Converts a legacy History.json list into the append-only log.
+    The old file is kept as History.json.bak. Returns the number of records moved"""
+    legacyPath = os.path.join(directory, legacyName)
+    if not os.path.exists(legacyPath):
+        return 0
+
+    with open(legacyPath, "r", encoding="utf-8") as f:
+        content = f.read()
+    old = json.loads(content) if content.strip() else []
+
+    if countRecords(directory) == 0:
+        clearRecords(directory)
+        for record in old:
+            appendRecord(directory, record)
+    else:
+        # A log already exists, so the legacy file is stale and only archived
+        old = []
+
+    os.replace(legacyPath, legacyPath + ".bak")
+    return len(old)
+
+
+def migrateAll(root="Data"):
+    """Migrates every Data/{userID}/Characters/{character}/History.json under root"""
+    moved = 0
+    if not os.path.exists(root):
+        return moved
+    for userID in os.listdir(root):
+        charactersDir = os.path.join(root, userID, "Characters")
+        if not os.path.isdir(charactersDir):
+            continue
+        for character in os.listdir(charactersDir):
+            directory = os.path.join(charactersDir, character)
+            if os.path.isdir(directory):
+                moved += migrateHistoryJson(directory)
+    return moved
+
+
+if __name__ == "__main__":
+    # python history.py migrate [Data]
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate":
+        root = sys.argv[2] if len(sys.argv) > 2 else "Data"
+        print(f"Migrated {migrateAll(root)} messages")
+    else:
+        print("Usage: python history.py migrate [Data]")
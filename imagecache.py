@@ -0,0 +1,139 @@
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+from collections import OrderedDict
+
+# Payload fields that only pick which of the possible images comes out
+variationFields = ("seed", "subseed", "batch_size", "n_iter")
+
+
+def normalizePrompt(prompt):
+    """Lowercases a prompt and tidies its whitespace and commas, so prompts
+    that only differ in spelling render the same key"""
+    terms = [re.sub(r"\s+", " ", term).strip() for term in (prompt or "").lower().split(",")]
+    return ", ".join(term for term in terms if term)
+
+
+def payloadKey(payload):
+    """Hash of everything in a txt2img payload that shapes the picture,
+    ignoring the seed and batch settings"""
+    normalized = {k: v for k, v in payload.items() if k not in variationFields}
+    for field in ("prompt", "negative_prompt"):
+        if field in normalized:
+            normalized[field] = normalizePrompt(normalized[field])
+    encoded = json.dumps(normalized, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+class ImageCache:
+    """Content addressed store of rendered images, as {key}-{variant}.png
+    files in directory.
+
+    Up to variants images (each from its own seed) are kept per key. pick()
+    returns None while a key has fewer, so the caller renders and put()s
+    another one, then returns one of them at random. The least recently used
+    keys are deleted once the files pass maxBytes. The directory is only
+    created and scanned on first use.
+
+    The index and size are per instance: processes sharing a directory (shard
+    workers) each enforce maxBytes against what they indexed and stored, so
+    the directory can grow to about maxBytes times the number of processes.
+    """
+
+    def __init__(self, directory, maxBytes=512 * 1024 * 1024, variants=3):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.variants = variants
+        self.entries = None  # key -> list of (path, size), least recently used first
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        """Indexes the files already on disk, oldest access first"""
+        if self.entries is not None:
+            return
+        self.entries = OrderedDict()
+        self.size = 0
+        if not os.path.isdir(self.directory):
+            return
+        files = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".png") or "-" not in name:
+                continue
+            path = f"{self.directory}/{name}"
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, name.split("-", 1)[0], path, stat.st_size))
+        for _, key, path, size in sorted(files):
+            self.entries.setdefault(key, []).append((path, size))
+            self.entries.move_to_end(key)
+            self.size += size
+
+    def pick(self, key):
+        """Returns the path of a cached image for key, or None if a new
+        variant should be rendered"""
+        with self.lock:
+            self.load()
+            images = self.entries.get(key)
+            if not images or len(images) < self.variants:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            path = random.choice(images)[0]
+        try:
+            # The mtime carries the recency over to the next start
+            os.utime(path)
+        except FileNotFoundError:
+            # Evicted by another process sharing the directory
+            with self.lock:
+                self.drop(key)
+                self.hits -= 1
+                self.misses += 1
+            return None
+        return path
+
+    def put(self, key, png):
+        """Stores a rendered variant for key and evicts old keys if needed"""
+        with self.lock:
+            self.load()
+            images = self.entries.setdefault(key, [])
+            if len(images) >= self.variants:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            path = f"{self.directory}/{key}-{len(images)}.png"
+            temp = f"{path}.{os.getpid()}.tmp"
+            with open(temp, "wb") as f:
+                f.write(png)
+            os.replace(temp, path)
+            images.append((path, len(png)))
+            self.entries.move_to_end(key)
+            self.size += len(png)
+            while self.size > self.maxBytes and len(self.entries) > 1:
+                self.drop(next(iter(self.entries)))
+
+    def drop(self, key):
+        for path, size in self.entries.pop(key, []):
+            self.size -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "keys": len(self.entries or ()),
+                "bytes": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": self.hits / lookups if lookups else 0.0,
+            }
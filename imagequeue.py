@@ -0,0 +1,179 @@
+import asyncio
+import time
+from collections import deque
+
+
+class ImageJob:
+    def __init__(self, userID, payload):
+        self.userID = userID
+        self.payload = payload
+        self.queued = time.monotonic()
+        self.started = None
+
+
+class ImageQueue:
+    """Runs Stable Diffusion renders as background jobs.
+
+    A fixed number of workers pull jobs round-robin across users, so one user
+    asking for ten pictures can't starve everyone else. render(payload) is
+    awaited for the image, then deliver(userID, image) sends it. If rendering
+    or delivery raises, fail(userID, error) is awaited instead when given.
+
+    With batchKey(payload) and renderBatch(payloads) given, a worker also takes
+    the next job of other users whose batchKey matches (up to maxBatch jobs)
+    and renders them together. renderBatch returns one image per payload.
+    """
+
+    def __init__(
+        self, render, deliver, fail=None, workers=1, maxPerUser=3, maxPending=100,
+        batchKey=None, renderBatch=None, maxBatch=4,
+    ):
+        self.render = render
+        self.deliver = deliver
+        self.fail = fail
+        self.batchKey = batchKey
+        self.renderBatch = renderBatch
+        self.maxBatch = maxBatch
+        self.workerCount = workers
+        self.maxPerUser = maxPerUser
+        self.maxPending = maxPending
+        self.pending = {}  # userID -> deque of jobs
+        self.turns = deque()  # userIDs with pending jobs, in serving order
+        self.available = None
+        self.workers = []
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.batches = 0  # renders that served more than one job
+        self.waits = deque(maxlen=200)
+
+    def start(self):
+        """Starts the workers. Must be called from the running event loop"""
+        self.available = asyncio.Semaphore(0)
+        self.workers = [
+            asyncio.create_task(self.work(), name=f"ImageQueue-{i}")
+            for i in range(self.workerCount)
+        ]
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def depth(self):
+        return sum(len(jobs) for jobs in self.pending.values())
+
+    def submit(self, userID, payload):
+        """Queues a render. Returns the job's position in the user's queue, or
+        None if the user or the whole queue already has too many jobs waiting"""
+        jobs = self.pending.get(userID)
+        if jobs is not None and len(jobs) >= self.maxPerUser:
+            return None
+        if self.depth() >= self.maxPending:
+            return None
+        if jobs is None:
+            jobs = self.pending[userID] = deque()
+            self.turns.append(userID)
+        jobs.append(ImageJob(userID, payload))
+        self.available.release()
+        return len(jobs)
+
+    def next(self):
+        """Returns the next user's next job, or None if another worker's batch
+        already took it"""
+        if not self.turns:
+            return None
+        userID = self.turns.popleft()
+        return self.take(userID)
+
+    def take(self, userID):
+        """Pops userID's oldest job and moves them to the back of the turns"""
+        jobs = self.pending[userID]
+        job = jobs.popleft()
+        if userID in self.turns:
+            self.turns.remove(userID)
+        if jobs:
+            self.turns.append(userID)
+        else:
+            del self.pending[userID]
+        return job
+
+    def nextBatch(self):
+        """Returns the next job plus the next jobs of other users that can be
+        rendered with it. Only a user's oldest job is taken, so each user's
+        pictures still arrive in order"""
+        job = self.next()
+        if job is None or not self.renderBatch:
+            return [job] if job else []
+        key = self.batchKey(job.payload)
+        batch = [job]
+        for userID in list(self.turns):
+            if len(batch) >= self.maxBatch:
+                break
+            if userID != job.userID and self.batchKey(self.pending[userID][0].payload) == key:
+                batch.append(self.take(userID))
+        # Jobs taken here leave their semaphore permits behind, which only
+        # wake a worker to find nothing (next() returns None)
+        return batch
+
+    async def work(self):
+        while True:
+            await self.available.acquire()
+            batch = self.nextBatch()
+            if not batch:
+                continue
+            started = time.monotonic()
+            for job in batch:
+                job.started = started
+                self.waits.append(started - job.queued)
+            self.running += len(batch)
+            try:
+                if len(batch) == 1:
+                    images = [await self.render(batch[0].payload)]
+                else:
+                    self.batches += 1
+                    images = await self.renderBatch([job.payload for job in batch])
+            except asyncio.CancelledError:
+                self.running -= len(batch)
+                raise
+            except Exception as e:
+                images = [e] * len(batch)
+            try:
+                await asyncio.gather(*(self.finish(job, image) for job, image in zip(batch, images)))
+            finally:
+                self.running -= len(batch)
+
+    async def finish(self, job, image):
+        """Delivers a rendered image, or reports the error it failed with"""
+        try:
+            if isinstance(image, Exception):
+                raise image
+            await self.deliver(job.userID, image)
+            self.completed += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.failed += 1
+            print(f"Image job for {job.userID} failed: {e}")
+            if self.fail:
+                try:
+                    await self.fail(job.userID, e)
+                except Exception as e:
+                    print(f"Could not report failed image job to {job.userID}: {e}")
+
+    def stats(self):
+        waits = sorted(self.waits)
+        return {
+            "depth": self.depth(),
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+            "batches": self.batches,
+            "avgWait": sum(waits) / len(waits) if waits else 0.0,
+            "maxWait": waits[-1] if waits else 0.0,
+            "oldestWaiting": max(
+                (time.monotonic() - jobs[0].queued for jobs in self.pending.values()),
+                default=0.0,
+            ),
+        }
@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from state import writeJsonAtomic
+
+
+def requestKey(**request):
+    """Hash of everything that shapes a completion: model, messages, tools and
+    any other arguments. Key order in the dicts doesn't matter"""
+    encoded = json.dumps(request, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+class ResponseCache:
+    """LRU cache of model responses with a time to live.
+
+    Values must be JSON serializable. Entries live in memory (up to
+    maxEntries) and, when directory is set, also as one JSON file per key so
+    they survive restarts. hits, misses and diskHits count lookups.
+    """
+
+    def __init__(self, maxEntries=1000, ttl=24 * 3600, directory=None):
+        self.maxEntries = maxEntries
+        self.ttl = ttl
+        self.directory = directory
+        self.entries = OrderedDict()  # key -> (expires, value)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.diskHits = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def diskPath(self, key):
+        return f"{self.directory}/{key}.json"
+
+    def get(self, key):
+        """Returns the cached value or None"""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self.entries[key]
+        entry = self.readDisk(key, now)
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.diskHits += 1
+            self.remember(key, entry)
+        return entry[1]
+
+    def put(self, key, value):
+        entry = (time.time() + self.ttl, value)
+        with self.lock:
+            self.remember(key, entry)
+        if self.directory:
+            writeJsonAtomic(self.diskPath(key), {"expires": entry[0], "value": value})
+
+    def remember(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxEntries:
+            self.entries.popitem(last=False)
+
+    def readDisk(self, key, now):
+        if not self.directory:
+            return None
+        path = self.diskPath(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                stored = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if stored.get("expires", 0) <= now:
+            self.removeFile(path)
+            return None
+        return (stored["expires"], stored["value"])
+
+    def removeFile(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def prune(self):
+        """Drops expired entries from memory and disk. Returns how many files were removed"""
+        now = time.time()
+        with self.lock:
+            for key in [k for k, (expires, _) in self.entries.items() if expires <= now]:
+                del self.entries[key]
+        removed = 0
+        if self.directory:
+            for name in os.listdir(self.directory):
+                path = f"{self.directory}/{name}"
+                if name.endswith(".json") and self.readDisk(name[:-5], now) is None:
+                    removed += not os.path.exists(path)
+        return removed
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+        if self.directory:
+            for name in os.listdir(self.directory):
+                if name.endswith(".json"):
+                    self.removeFile(f"{self.directory}/{name}")
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "diskHits": self.diskHits,
+                "hitRate": self.hits / lookups if lookups else 0.0,
+            }
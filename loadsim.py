@@ -0,0 +1,360 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+from fakes import FakeOpenAI, FakeSD, FakeTelegram
+
+# End-to-end load test. Starts fake Telegram, OpenAI and SD servers, runs the
+# bot against them in a subprocess and has N simulated users talk to it at the
+# same time, each waiting for a reply before sending the next message.
+#
+#   python loadsim.py --users 50 --messages 10
+#   python loadsim.py --users 200 --mix chat=6,task=3,selfie=1 --llm-latency 0.8 --webhook
+#
+# Reports throughput, latency percentiles per message kind and error counts,
+# plus the bot's own per-stage metrics.
+
+repoDir = os.path.dirname(os.path.abspath(__file__))
+
+# What each kind of message says. The task and selfie texts contain the
+# keywords that make the bot offer those tools and the fake call them
+messageTexts = {
+    "chat": "how was your day?",
+    "task": "remind me to water the plants, add it to my task list",
+    "selfie": "send me a selfie please",
+}
+toolRules = {
+    "selfie": (
+        "SendSelfie",
+        {"emotion": "happy", "verb": "smiling", "place": "cafe", "condition": "day"},
+    ),
+    "remind": (
+        "AddNewTask",
+        {"name": "Water the plants", "description": "Water the plants", "status": "unstarted"},
+    ),
+}
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def freePort():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def parseMix(text):
+    """ "chat=6,task=3,selfie=1" -> {"chat": 6.0, ...} """
+    mix = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        if kind not in messageTexts:
+            raise ValueError(f"Unknown message kind {kind}, use one of {', '.join(messageTexts)}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+class SimulatedUser(threading.Thread):
+    """Goes through /start, name and character selection, then sends messages
+    one at a time, timing each until its reply is complete"""
+
+    def __init__(self, sim, chatID, messages, rng):
+        super().__init__(daemon=True)
+        self.sim = sim
+        self.chatID = chatID
+        self.messages = messages
+        self.rng = rng
+        self.results = []  # (kind, seconds or None, error)
+        self.selfies = 0
+        self.setUp = threading.Event()  # set once setup finished or failed
+
+    def send(self, text, match):
+        """Posts text and waits for a bot message to this chat passing match(text)"""
+        telegram = self.sim.telegram
+        since = len(telegram.calls)
+        start = time.monotonic()
+        telegram.postUpdate(self.chatID, text)
+        call = telegram.waitFor(
+            lambda method, params: method in ("sendMessage", "editMessageText")
+            and str(params.get("chat_id")) == str(self.chatID)
+            and match(str(params.get("text", ""))),
+            timeout=self.sim.timeout,
+            since=since,
+        )
+        return None if call is None else call[0] - start
+
+    def run(self):
+        steps = [
+            ("/start", lambda text: "Who am I speaking to" in text or "who would you like" in text),
+            (f"User{self.chatID}", lambda text: True),
+            (self.sim.character.lower(), lambda text: "joined" in text),
+            ("/mode chat", lambda text: "Chat mode" in text),
+        ]
+        for text, match in steps:
+            if self.send(text, match) is None:
+                self.results.append(("setup", None, f"no reply to {text!r}"))
+                self.setUp.set()
+                return
+        self.setUp.set()
+        kinds = list(self.sim.mix)
+        weights = [self.sim.mix[k] for k in kinds]
+        self.sim.ready.wait()
+        for i in range(self.messages):
+            kind = self.rng.choices(kinds, weights)[0]
+            text = f"[{self.chatID}-{i}] {messageTexts[kind]}"
+            expected = FakeOpenAI.replyFor(text)
+            try:
+                seconds = self.send(text, lambda reply: reply == expected)
+            except Exception as e:
+                self.results.append((kind, None, str(e)))
+                continue
+            self.results.append((kind, seconds, None if seconds is not None else "timeout"))
+            if kind == "selfie":
+                self.selfies += 1
+
+
+class LoadSimulation:
+    def __init__(self, args):
+        self.args = args
+        self.users = args.users
+        self.messages = args.messages
+        self.mix = parseMix(args.mix)
+        self.timeout = args.timeout
+        self.character = args.character
+        self.ready = threading.Event()
+        self.telegram = FakeTelegram().start()
+        self.openai = FakeOpenAI(latency=args.llm_latency, jitter=args.llm_jitter, toolRules=toolRules).start()
+        self.sd = FakeSD(latency=args.sd_latency).start()
+        self.metricsPort = freePort()
+        self.workdir = None
+        self.bot = None
+
+    def startBot(self):
+        self.workdir = tempfile.mkdtemp(prefix="fractal-loadsim-")
+        for name in ("Prompt", "Characters"):
+            shutil.copytree(f"{repoDir}/{name}", f"{self.workdir}/{name}")
+        shutil.copy(f"{repoDir}/Payloads.json", self.workdir)
+        env = dict(
+            os.environ,
+            PYTHONPATH=repoDir,
+            TELEGRAM_API_KEY="123456:loadsim",
+            OPENAI_API_KEY="loadsim",
+            OPENAI_BASE_URL=self.openai.url + "/v1",
+            FRACTAL_TELEGRAM_BASE_URL=self.telegram.url + "/bot",
+            FRACTAL_SD_URL=self.sd.url,
+            FRACTAL_EMBEDDER=self.args.embedder,
+            FRACTAL_STORAGE=self.args.storage,
+            FRACTAL_DB=f"{self.workdir}/fractal.db",
+            FRACTAL_METRICS_PORT=str(self.metricsPort),
+        )
+        if self.args.webhook:
+            port = freePort()
+            env.update(
+                FRACTAL_WEBHOOK_URL=f"http://127.0.0.1:{port}/telegram",
+                FRACTAL_WEBHOOK_LISTEN="127.0.0.1",
+                FRACTAL_WEBHOOK_PORT=str(port),
+                FRACTAL_WEBHOOK_SECRET="loadsim",
+            )
+        self.log = open(f"{self.workdir}/bot.log", "w+")
+        if self.args.shards:
+            command = [sys.executable, f"{repoDir}/shard.py", str(self.args.shards)]
+        else:
+            command = [sys.executable, "-c", "import fractal; fractal.main()"]
+        self.bot = subprocess.Popen(
+            command,
+            cwd=self.workdir,
+            env=env,
+            stdout=self.log,
+            stderr=subprocess.STDOUT,
+        )
+        # Ready once it listens for updates
+        started = self.telegram.waitFor(
+            lambda method, params: method in ("getUpdates", "setWebhook"), timeout=60
+        )
+        if started is None or self.bot.poll() is not None:
+            raise RuntimeError("Bot didn't start:\n" + self.botLog())
+        if self.args.webhook:
+            time.sleep(0.5)  # setWebhook is called just before the listener is up
+
+    def botLog(self, lines=30):
+        self.log.flush()
+        self.log.seek(0)
+        return "".join(self.log.readlines()[-lines:])
+
+    def stopBot(self):
+        if self.bot and self.bot.poll() is None:
+            self.bot.send_signal(signal.SIGINT)
+            try:
+                self.bot.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                self.bot.kill()
+
+    def botMetrics(self):
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{self.metricsPort}/metrics", timeout=5) as r:
+                text = r.read().decode()
+        except OSError:
+            return {}
+        stages = {}
+        for line in text.splitlines():
+            if line.startswith("fractal_stage_seconds_sum") or line.startswith("fractal_stage_seconds_count"):
+                name, value = line.rsplit(" ", 1)
+                stage = name.split('stage="', 1)[1].split('"', 1)[0]
+                field = "sum" if "_sum" in name else "count"
+                stages.setdefault(stage, {})[field] = float(value)
+        return {
+            stage: {"count": int(v.get("count", 0)), "meanSeconds": v.get("sum", 0) / v["count"]}
+            for stage, v in sorted(stages.items())
+            if v.get("count")
+        }
+
+    def run(self):
+        self.startBot()
+        rng = random.Random(self.args.seed)
+        users = [
+            SimulatedUser(self, 100000 + i, self.messages, random.Random(rng.random()))
+            for i in range(self.users)
+        ]
+        try:
+            for user in users:
+                user.start()
+            # Everyone finishes setting up before the timed part begins
+            for user in users:
+                user.setUp.wait()
+            started = time.monotonic()
+            self.ready.set()
+            for user in users:
+                user.join()
+            elapsed = time.monotonic() - started
+            expectedPhotos = sum(u.selfies for u in users)
+            photos = self.waitForPhotos(users, expectedPhotos)
+            return self.report(users, elapsed, expectedPhotos, photos)
+        finally:
+            self.stopBot()
+            for fake in (self.telegram, self.openai, self.sd):
+                fake.stop()
+            if self.bot and self.bot.returncode not in (0, None, -signal.SIGINT) and not self.args.keep:
+                print(self.botLog())
+            if self.args.keep:
+                print(f"Bot files kept in {self.workdir}")
+            else:
+                self.log.close()
+                shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def waitForPhotos(self, users, expected):
+        deadline = time.monotonic() + self.timeout
+        while time.monotonic() < deadline:
+            photos = sum(len(self.telegram.sentTo(u.chatID, ("sendPhoto",))) for u in users)
+            if photos >= expected:
+                return photos
+            time.sleep(0.1)
+        return sum(len(self.telegram.sentTo(u.chatID, ("sendPhoto",))) for u in users)
+
+    def report(self, users, elapsed, expectedPhotos, photos):
+        results = [r for u in users for r in u.results]
+        byKind = {}
+        for kind, seconds, error in results:
+            entry = byKind.setdefault(kind, {"latencies": [], "errors": 0})
+            if error:
+                entry["errors"] += 1
+            else:
+                entry["latencies"].append(seconds)
+        completed = sum(len(e["latencies"]) for k, e in byKind.items() if k != "setup")
+        errors = sum(e["errors"] for e in byKind.values())
+        kinds = {}
+        for kind, entry in sorted(byKind.items()):
+            latencies = entry["latencies"]
+            kinds[kind] = {
+                "completed": len(latencies),
+                "errors": entry["errors"],
+                "p50": percentile(latencies, 0.50),
+                "p95": percentile(latencies, 0.95),
+                "p99": percentile(latencies, 0.99),
+                "max": max(latencies) if latencies else None,
+            }
+        return {
+            "config": {
+                "users": self.users,
+                "messages": self.messages,
+                "mix": self.mix,
+                "llmLatency": self.args.llm_latency,
+                "sdLatency": self.args.sd_latency,
+                "webhook": self.args.webhook,
+                "storage": self.args.storage,
+                "shards": self.args.shards,
+            },
+            "elapsedSeconds": elapsed,
+            "completed": completed,
+            "errors": errors,
+            "errorRate": errors / max(1, len(results)),
+            "throughput": completed / elapsed if elapsed else 0.0,
+            "kinds": kinds,
+            "photos": {"expected": expectedPhotos, "delivered": photos},
+            "llmRequests": len(self.openai.calls),
+            "sdRenders": sum(1 for call in self.sd.calls if call[1] == "txt2img"),
+            "botStages": self.botMetrics(),
+        }
+
+
+def printReport(report):
+    print(
+        f"{report['completed']} replies in {report['elapsedSeconds']:.1f}s "
+        f"({report['throughput']:.1f}/s), {report['errors']} errors "
+        f"({report['errorRate'] * 100:.1f}%)"
+    )
+    print(f"{'kind':8} {'done':>6} {'errors':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for kind, k in report["kinds"].items():
+        cells = [f"{k[q] * 1000:8.0f}" if k[q] is not None else f"{'-':>8}" for q in ("p50", "p95", "p99", "max")]
+        print(f"{kind:8} {k['completed']:6d} {k['errors']:6d} " + " ".join(cells))
+    photos = report["photos"]
+    print(f"Selfies delivered: {photos['delivered']}/{photos['expected']}")
+    print(f"Model requests: {report['llmRequests']}, SD renders: {report['sdRenders']}")
+    if report["botStages"]:
+        print("Bot stages (mean ms): " + ", ".join(
+            f"{stage} {s['meanSeconds'] * 1000:.1f}" for stage, s in report["botStages"].items()
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the bot against local fakes")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=5, help="messages per user after setup")
+    parser.add_argument("--mix", default="chat=7,task=2,selfie=1", help="weights per message kind")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="seconds per fake completion")
+    parser.add_argument("--llm-jitter", type=float, default=0.2, help="extra random seconds per completion")
+    parser.add_argument("--sd-latency", type=float, default=1.0, help="seconds per fake render")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for each reply")
+    parser.add_argument("--webhook", action="store_true", help="receive updates by webhook instead of polling")
+    parser.add_argument("--storage", default="json", choices=["json", "sqlite"])
+    parser.add_argument("--shards", type=int, default=0, help="run shard.py with this many workers")
+    parser.add_argument("--embedder", default="hash", choices=["hash", "openai"])
+    parser.add_argument("--character", default="Kamelle")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="write the report as json to this file")
+    parser.add_argument("--keep", action="store_true", help="keep the bot's files and log")
+    args = parser.parse_args()
+
+    report = LoadSimulation(args).run()
+    printReport(report)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
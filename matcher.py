@@ -0,0 +1,77 @@
+import re
+
+wordPattern = re.compile(r"[a-z0-9]+")
+stopWords = {
+    "a", "an", "the", "my", "to", "of", "and", "or", "for", "on", "in", "at",
+    "that", "this", "task", "one", "i", "did", "done", "finished", "complete",
+}
+
+
+def tokenize(text):
+    return [w for w in wordPattern.findall(text.lower()) if w not in stopWords]
+
+
+def trigrams(text):
+    text = " " + " ".join(wordPattern.findall(text.lower())) + " "
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+def stem(word):
+    """Very light suffix stripping so 'washed the dishes' meets 'wash dish'"""
+    for suffix in ("ing", "ed", "es", "s"):
+        if len(word) > len(suffix) + 2 and word.endswith(suffix):
+            return word[: -len(suffix)]
+    return word
+
+
+class FuzzyIndex:
+    """Token and character trigram index over a short list of names.
+
+    Candidates are found through the trigram inverted index, then scored as a
+    blend of trigram Dice similarity and the share of the name's (stemmed)
+    words that appear in the query, both between 0 and 1.
+    """
+
+    def __init__(self, names):
+        self.names = list(names)
+        self.grams = [trigrams(name) for name in self.names]
+        self.words = [{stem(w) for w in tokenize(name)} for name in self.names]
+        self.postings = {}
+        for i, grams in enumerate(self.grams):
+            for gram in grams:
+                self.postings.setdefault(gram, set()).add(i)
+
+    def search(self, query, limit=5):
+        """Returns up to limit (score, index) pairs, best first"""
+        queryGrams = trigrams(query)
+        queryWords = {stem(w) for w in tokenize(query)}
+        candidates = set()
+        for gram in queryGrams:
+            candidates |= self.postings.get(gram, set())
+        scored = []
+        for i in candidates:
+            grams = self.grams[i]
+            dice = 2 * len(grams & queryGrams) / (len(grams) + len(queryGrams) or 1)
+            words = self.words[i]
+            overlap = len(words & queryWords) / len(words) if words else 0.0
+            scored.append((0.5 * dice + 0.5 * overlap, i))
+        scored.sort(key=lambda pair: (-pair[0], pair[1]))
+        return scored[:limit]
+
+
+def matchName(query, names, minScore=0.6, margin=0.15, floor=0.15):
+    """Picks the name query refers to.
+
+    Returns (index, shortlist). index is set only when the best match scores
+    at least minScore and beats the runner-up by margin, even if it is the
+    only candidate, since one shared word ("paid rent" / "Rent a car") isn't
+    enough. Otherwise it is None and shortlist holds the indexes worth asking
+    the model about (every name if nothing scored above floor)"""
+    results = FuzzyIndex(names).search(query)
+    if results:
+        best = results[0][0]
+        second = results[1][0] if len(results) > 1 else 0.0
+        if best >= minScore and best - second >= margin:
+            return results[0][1], [results[0][1]]
+    shortlist = [i for score, i in results if score >= floor]
+    return None, shortlist or list(range(len(names)))
@@ -0,0 +1,113 @@
+import asyncio
+
+
+class MemoryCompactor:
+    """Rolling long-term memory for each user and character.
+
+    Once a conversation has more than compactThreshold messages that aren't
+    covered by the stored summary, the oldest segmentSize of them (never any of
+    the newest keepRecent) are folded into the summary by summarize(summary,
+    records). The memory record remembers how many history records it covers,
+    so each segment is summarized exactly once.
+
+    Memory records and history counts are cached for up to maxKeys chats, as
+    this class writes every memory change and is told of every appended
+    record (appended()). Call release() before another process takes a user.
+    """
+
+    def __init__(
+        self, storage, summarize, compactThreshold=40, segmentSize=20, keepRecent=20, maxKeys=5000
+    ):
+        self.storage = storage
+        self.summarize = summarize
+        self.compactThreshold = compactThreshold
+        self.segmentSize = segmentSize
+        self.keepRecent = keepRecent
+        self.maxKeys = maxKeys
+        self.running = {}
+        self.memories = {}  # (userID, character) -> memory record
+        self.counts = {}  # (userID, character) -> number of history records
+
+    def cache(self, cache, key, value):
+        if key not in cache and len(cache) >= self.maxKeys:
+            del cache[next(iter(cache))]
+        cache[key] = value
+
+    def getMemory(self, userID, character):
+        """Returns {"summary": str, "covered": int, "epoch": int}. covered is the
+        number of history records already folded into summary, epoch changes
+        every time the memory is cleared"""
+        key = (userID, character)
+        if key not in self.memories:
+            memory = self.storage.getMemory(userID, character)
+            self.cache(self.memories, key, memory or {"summary": "", "covered": 0, "epoch": 0})
+        return dict(self.memories[key])
+
+    def setMemory(self, userID, character, memory):
+        self.storage.setMemory(userID, character, memory)
+        self.cache(self.memories, (userID, character), dict(memory))
+
+    def clearMemory(self, userID, character):
+        epoch = self.getMemory(userID, character).get("epoch", 0) + 1
+        self.setMemory(userID, character, {"summary": "", "covered": 0, "epoch": epoch})
+        # Cleared along with the history, counted again on next use
+        self.counts.pop((userID, character), None)
+
+    def countHistory(self, userID, character):
+        key = (userID, character)
+        if key not in self.counts:
+            self.cache(self.counts, key, self.storage.countHistory(userID, character))
+        return self.counts[key]
+
+    def appended(self, userID, character, count=1):
+        """Records that count history records were stored for the chat"""
+        key = (userID, character)
+        if key in self.counts:
+            self.counts[key] += count
+
+    def release(self, userID):
+        """Forgets everything cached for userID"""
+        for cache in (self.memories, self.counts):
+            for key in [key for key in cache if key[0] == userID]:
+                del cache[key]
+
+    def needsCompaction(self, userID, character, memory=None):
+        memory = memory or self.getMemory(userID, character)
+        uncovered = self.countHistory(userID, character) - memory["covered"]
+        return uncovered - self.keepRecent >= self.compactThreshold
+
+    def schedule(self, userID, character):
+        """Starts a background compaction if one is due and none is running.
+        Returns the task, or None"""
+        key = (userID, character)
+        if key in self.running or not self.needsCompaction(userID, character):
+            return None
+        task = asyncio.create_task(self.compact(userID, character))
+        self.running[key] = task
+        task.add_done_callback(lambda t: self.running.pop(key, None))
+        return task
+
+    async def compact(self, userID, character):
+        """Summarizes uncovered segments until the backlog is under the threshold"""
+        try:
+            memory = self.getMemory(userID, character)
+            while self.needsCompaction(userID, character, memory):
+                start = memory["covered"]
+                records = self.storage.readHistory(
+                    userID, character, start, start + self.segmentSize
+                )
+                if not records:
+                    break
+                summary = await self.summarize(memory["summary"], records)
+                # The chat may have been cleared while the model was summarizing
+                current = self.getMemory(userID, character)
+                if current["covered"] != start or current.get("epoch", 0) != memory.get("epoch", 0):
+                    break
+                memory = {
+                    "summary": summary,
+                    "covered": start + len(records),
+                    "epoch": memory.get("epoch", 0),
+                }
+                self.setMemory(userID, character, memory)
+        except Exception as e:
+            print(f"Memory compaction for {userID}/{character} failed: {e}")
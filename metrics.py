@@ -0,0 +1,197 @@
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds, from a fast file read up to a slow SD render
+defaultBuckets = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 25.0, 60.0, 120.0,
+)
+
+
+class Histogram:
+    """Cumulative-style latency histogram with fixed buckets. Quantiles are
+    estimated by interpolating inside the bucket they fall in"""
+
+    def __init__(self, buckets=defaultBuckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / n, self.max)
+            seen += n
+        return self.max
+
+
+class Metrics:
+    """Process-wide stage timings and counters.
+
+    span(stage) times a block into the stage's histogram and counts it as an
+    error if it raises, timed(stage) does the same for a whole async function.
+    addUsage() accumulates token usage per model. Both summary() (for /stats)
+    and prometheus() read the same data.
+    """
+
+    def __init__(self, buckets=defaultBuckets):
+        self.buckets = buckets
+        self.histograms = {}  # stage -> Histogram
+        self.errors = {}  # stage -> count
+        self.tokens = {}  # (model, kind) -> count
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            with self.lock:
+                self.errors[stage] = self.errors.get(stage, 0) + 1
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def timed(self, stage):
+        """Decorator timing every call of an async function as stage"""
+
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with self.span(stage):
+                    return await func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def addUsage(self, model, usage):
+        """Adds a completion's usage (an openai usage object or dict) to the token counters"""
+        if usage is None:
+            return
+        if not isinstance(usage, dict):
+            usage = {k: getattr(usage, k, 0) for k in ("prompt_tokens", "completion_tokens")}
+        with self.lock:
+            for kind in ("prompt", "completion"):
+                key = (model, kind)
+                self.tokens[key] = self.tokens.get(key, 0) + (usage.get(f"{kind}_tokens") or 0)
+
+    def snapshot(self):
+        """Returns {stage: {"count", "errors", "p50", "p95", "p99", "max", "mean"}} in seconds"""
+        with self.lock:
+            return {
+                stage: {
+                    "count": h.count,
+                    "errors": self.errors.get(stage, 0),
+                    "p50": h.quantile(0.50),
+                    "p95": h.quantile(0.95),
+                    "p99": h.quantile(0.99),
+                    "max": h.max,
+                    "mean": h.sum / h.count if h.count else 0.0,
+                }
+                for stage, h in sorted(self.histograms.items())
+            }
+
+    def summary(self):
+        """Short plain text report for chat"""
+        lines = [f"Up {(time.time() - self.started) / 3600:.1f}h. Stage: count p50/p95/p99 ms"]
+        for stage, s in self.snapshot().items():
+            errors = f" ({s['errors']} failed)" if s["errors"] else ""
+            lines.append(
+                f"{stage}: {s['count']} {s['p50'] * 1000:.1f}/{s['p95'] * 1000:.1f}/"
+                f"{s['p99'] * 1000:.1f}{errors}"
+            )
+        with self.lock:
+            tokens = sorted(self.tokens.items())
+        for (model, kind), count in tokens:
+            lines.append(f"{model} {kind} tokens: {count}")
+        return "\n".join(lines)
+
+    def prometheus(self):
+        """Metrics in the Prometheus text exposition format"""
+        lines = [
+            "# HELP fractal_stage_seconds Time spent in each stage of handling a message",
+            "# TYPE fractal_stage_seconds histogram",
+        ]
+        with self.lock:
+            for stage, h in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, n in zip(self.buckets, h.counts):
+                    cumulative += n
+                    lines.append(f'fractal_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'fractal_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {h.count}')
+                lines.append(f'fractal_stage_seconds_sum{{stage="{stage}"}} {h.sum}')
+                lines.append(f'fractal_stage_seconds_count{{stage="{stage}"}} {h.count}')
+            lines.append("# HELP fractal_stage_errors_total Stages that raised")
+            lines.append("# TYPE fractal_stage_errors_total counter")
+            for stage, count in sorted(self.errors.items()):
+                lines.append(f'fractal_stage_errors_total{{stage="{stage}"}} {count}')
+            lines.append("# HELP fractal_tokens_total Tokens reported by completion responses")
+            lines.append("# TYPE fractal_tokens_total counter")
+            for (model, kind), count in sorted(self.tokens.items()):
+                lines.append(f'fractal_tokens_total{{model="{model}",kind="{kind}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """Serves metrics.prometheus() at /metrics from a background thread"""
+
+    def __init__(self, metrics, host="127.0.0.1", port=9464):
+        owner = metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                data = owner.prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,66 @@
+import os
+import threading
+from collections import OrderedDict
+
+
+class PromptCache:
+    """Caches parsed prompt files and rendered prompt sections.
+
+    Files are re-read only when their mtime or size changes. Rendered sections
+    are stored with the stamp they were built from (eg. the mtimes of the
+    system prompt and character card) and rebuilt when the stamp differs or
+    the entry was invalidated after an edit.
+    """
+
+    def __init__(self, maxRendered=10000):
+        self.files = {}  # path -> (stamp, parsed)
+        self.rendered = OrderedDict()  # key -> (stamp, value)
+        self.maxRendered = maxRendered
+        self.lock = threading.Lock()
+
+    def fileStamp(self, path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def loadFile(self, path, parse=None, encoding="utf-8"):
+        """Returns the file's text, or parse(text), re-reading only after it changed"""
+        stamp = self.fileStamp(path)
+        cached = self.files.get(path)
+        if cached is not None and stamp is not None and cached[0] == stamp:
+            return cached[1]
+        with open(path, "r", encoding=encoding) as f:
+            content = f.read()
+        parsed = parse(content) if parse else content
+        self.files[path] = (stamp, parsed)
+        return parsed
+
+    def getRendered(self, key, stamp, build):
+        """Returns the value stored for key if it was built from stamp, otherwise build()s it"""
+        with self.lock:
+            cached = self.rendered.get(key)
+            if cached is not None and cached[0] == stamp:
+                self.rendered.move_to_end(key)
+                return cached[1]
+        value = build()
+        with self.lock:
+            self.rendered[key] = (stamp, value)
+            self.rendered.move_to_end(key)
+            while len(self.rendered) > self.maxRendered:
+                self.rendered.popitem(last=False)
+        return value
+
+    def invalidate(self, userID=None, character=None):
+        """Drops rendered sections for a user and/or character (all if neither
+        is given). Keys are expected to start with (userID, character)"""
+        with self.lock:
+            for key in list(self.rendered):
+                if userID is not None and key[0] != userID:
+                    continue
+                if character is not None and key[1] != character:
+                    continue
+                del self.rendered[key]
+            if userID is None and character is None:
+                self.files.clear()
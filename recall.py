@@ -0,0 +1,309 @@
+import hashlib
+import json
+import os
+import re
+import threading
+
+import numpy as np
+
+wordPattern = re.compile(r"[a-z0-9']+")
+# Item kinds that come from the user data rather than the chat
+factKinds = ("task", "value", "interest")
+
+
+class HashEmbedder:
+    """Deterministic local embedder (feature hashing of words and word pairs).
+    Needs no network, so it is used for tests and offline runs"""
+
+    name = "hash"
+    # Lexical overlap scores much lower than semantic similarity
+    minScore = 0.1
+
+    def __init__(self, dim=256):
+        self.dim = dim
+
+    def features(self, text):
+        words = [w for w in wordPattern.findall(text.lower()) if len(w) > 2]
+        return words + [a + " " + b for a, b in zip(words, words[1:])]
+
+    def embedOne(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for feature in self.features(text):
+            digest = hashlib.blake2b(feature.encode(), digest_size=8).digest()
+            value = int.from_bytes(digest, "little")
+            vector[value % self.dim] += 1.0 if (value >> 63) & 1 else -1.0
+        return vector
+
+    async def embed(self, texts):
+        return np.stack([self.embedOne(t) for t in texts]) if texts else np.zeros((0, self.dim), np.float32)
+
+
+class OpenAIEmbedder:
+    """Embeddings from the OpenAI embeddings endpoint"""
+
+    name = "openai"
+    minScore = 0.3
+
+    def __init__(self, client, model="text-embedding-3-small", dim=1536):
+        self.client = client
+        self.model = model
+        self.dim = dim
+
+    async def embed(self, texts):
+        if not texts:
+            return np.zeros((0, self.dim), np.float32)
+        response = await self.client.embeddings.create(model=self.model, input=texts)
+        return np.array([item.embedding for item in response.data], dtype=np.float32)
+
+
+class VectorStore:
+    """Per-user embedding matrix kept on disk and memory mapped for search.
+
+    Data/{userID}/Recall/vectors.f32 is a raw float32 matrix that only ever
+    grows by appending rows, items.jsonl holds one metadata line per row and
+    meta.json records which embedder produced the vectors. Rows are stored
+    L2-normalized, so cosine similarity is a single matrix-vector product.
+    Rows, items and checked meta.json files are cached for up to maxUsers
+    users, the oldest loaded user is dropped past that.
+    """
+
+    def __init__(self, root="Data", embedderName="hash", dim=256, maxUsers=1000):
+        self.root = root
+        self.embedderName = embedderName
+        self.dim = dim
+        self.maxUsers = maxUsers
+        self.matrices = {}  # userID -> (rows, memmap)
+        self.items = {}  # userID -> list of item dicts
+        self.known = {}  # userID -> set of item keys already stored
+        self.checked = {}  # userID -> True once meta.json matched the embedder
+        self.lock = threading.Lock()
+
+    def meta(self):
+        return {"embedder": self.embedderName, "dim": self.dim}
+
+    def cacheUser(self, cache, userID, value):
+        """Stores a per-user cache entry, forgetting the oldest user past maxUsers"""
+        if userID not in cache and len(cache) >= self.maxUsers:
+            self.forget(next(iter(cache)))
+        cache[userID] = value
+
+    def forget(self, userID):
+        self.matrices.pop(userID, None)
+        self.items.pop(userID, None)
+        self.known.pop(userID, None)
+        self.checked.pop(userID, None)
+
+    def userDir(self, userID):
+        return f"{self.root}/{userID}/Recall"
+
+    def prepare(self, userID):
+        """Makes sure the user's store exists and matches the embedder,
+        starting it over if it was built with a different one"""
+        directory = self.userDir(userID)
+        if userID in self.checked:
+            return directory
+        metaPath = f"{directory}/meta.json"
+        meta = self.meta()
+        if os.path.exists(metaPath):
+            with open(metaPath, "r", encoding="utf-8") as f:
+                if json.load(f) == meta:
+                    self.cacheUser(self.checked, userID, True)
+                    return directory
+            print(f"Recall store for {userID} was built with another embedder, starting over")
+        os.makedirs(directory, exist_ok=True)
+        for name in ("vectors.f32", "items.jsonl"):
+            with open(f"{directory}/{name}", "wb"):
+                pass
+        with open(metaPath, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        self.forget(userID)
+        self.cacheUser(self.checked, userID, True)
+        return directory
+
+    def loadItems(self, userID):
+        if userID not in self.items:
+            items = []
+            path = f"{self.userDir(userID)}/items.jsonl"
+            if os.path.exists(path):
+                with open(path, "r", encoding="utf-8") as f:
+                    items = [json.loads(line) for line in f if line.strip()]
+            self.cacheUser(self.items, userID, items)
+            self.known[userID] = {item["key"] for item in items}
+        return self.items[userID]
+
+    def has(self, userID, key):
+        self.loadItems(userID)
+        return key in self.known[userID]
+
+    def append(self, userID, vectors, items):
+        """Appends normalized rows and their metadata"""
+        if not items:
+            return
+        with self.lock:
+            directory = self.prepare(userID)
+            self.loadItems(userID)
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            vectors = (vectors / np.maximum(norms, 1e-12)).astype(np.float32)
+            with open(f"{directory}/vectors.f32", "ab") as f:
+                f.write(vectors.tobytes())
+            with open(f"{directory}/items.jsonl", "a", encoding="utf-8") as f:
+                for item in items:
+                    f.write(json.dumps(item, ensure_ascii=False) + "\n")
+            self.items[userID].extend(items)
+            self.known[userID].update(item["key"] for item in items)
+
+    def release(self, userID):
+        """Drops the user's cached rows and items, they're read again on next use"""
+        with self.lock:
+            self.forget(userID)
+
+    def remove(self, userID, where):
+        """Rewrites the store without the items matching where(item). Rare, eg. on /clear"""
+        with self.lock:
+            matrix = self.matrix(userID)
+            if matrix is None:
+                return 0
+            items = self.loadItems(userID)[: matrix.shape[0]]
+            keep = [i for i, item in enumerate(items) if not where(item)]
+            removed = len(items) - len(keep)
+            if removed == 0:
+                return 0
+            vectors = np.array(matrix[keep], dtype=np.float32)
+            items = [items[i] for i in keep]
+            self.matrices.pop(userID, None)
+            directory = self.userDir(userID)
+            with open(f"{directory}/vectors.f32", "wb") as f:
+                f.write(vectors.tobytes())
+            with open(f"{directory}/items.jsonl", "w", encoding="utf-8") as f:
+                for item in items:
+                    f.write(json.dumps(item, ensure_ascii=False) + "\n")
+            self.items[userID] = items
+            self.known[userID] = {item["key"] for item in items}
+            return removed
+
+    def matrix(self, userID):
+        """Returns the user's vectors as a read-only memmap, remapped only when rows were added"""
+        path = f"{self.userDir(userID)}/vectors.f32"
+        if not os.path.exists(path):
+            return None
+        rows = os.path.getsize(path) // (4 * self.dim)
+        cached = self.matrices.get(userID)
+        if cached is not None and cached[0] == rows:
+            return cached[1]
+        if rows == 0:
+            return None
+        matrix = np.memmap(path, dtype=np.float32, mode="r", shape=(rows, self.dim))
+        self.cacheUser(self.matrices, userID, (rows, matrix))
+        return matrix
+
+    def search(self, userID, query, k=5, where=None):
+        """Returns up to k (score, item) pairs by cosine similarity, best first.
+        where(item) can filter candidates"""
+        if userID not in self.checked:
+            metaPath = f"{self.userDir(userID)}/meta.json"
+            if not os.path.exists(metaPath):
+                return []
+            with open(metaPath, "r", encoding="utf-8") as f:
+                if json.load(f) != self.meta():
+                    return []
+            self.cacheUser(self.checked, userID, True)
+        matrix = self.matrix(userID)
+        if matrix is None:
+            return []
+        items = self.loadItems(userID)
+        rows = min(len(items), matrix.shape[0])
+        query = query / max(np.linalg.norm(query), 1e-12)
+        scores = np.asarray(matrix[:rows] @ query)
+        if where is not None:
+            mask = np.array([where(item) for item in items[:rows]], dtype=bool)
+            scores = np.where(mask, scores, -np.inf)
+        k = min(k, rows)
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), items[i]) for i in top if np.isfinite(scores[i])]
+
+
+class RecallIndex:
+    """Semantic recall over a user's past messages and facts from their user data"""
+
+    def __init__(self, embedder, root="Data", minScore=None, maxUsers=1000):
+        self.embedder = embedder
+        self.store = VectorStore(root, embedder.name, embedder.dim, maxUsers)
+        self.minScore = embedder.minScore if minScore is None else minScore
+        self.factRevisions = {}  # userID -> revision of the user data last indexed
+
+    def itemKey(self, kind, text, character=None):
+        return hashlib.sha1(f"{kind}|{character}|{text}".encode()).hexdigest()
+
+    async def remember(self, userID, entries):
+        """Indexes entries, dicts with "text", "kind" and optional "character".
+        Entries already indexed are skipped"""
+        new = []
+        for entry in entries:
+            text = (entry.get("text") or "").strip()
+            if not text:
+                continue
+            key = self.itemKey(entry["kind"], text, entry.get("character"))
+            if self.store.has(userID, key) or any(item["key"] == key for item in new):
+                continue
+            new.append(dict(entry, text=text, key=key))
+        if new:
+            vectors = await self.embedder.embed([item["text"] for item in new])
+            self.store.append(userID, vectors, new)
+        return len(new)
+
+    def factsIndexed(self, userID, revision):
+        return revision is not None and self.factRevisions.get(userID) == revision
+
+    async def rememberUserData(self, userID, data, revision=None):
+        """Indexes open tasks, values and interests from User.json and drops
+        the ones no longer there, eg. completed tasks. Does nothing while
+        revision is the one indexed last"""
+        if self.factsIndexed(userID, revision):
+            return 0
+        entries = []
+        for task in (data or {}).get("tasks", []):
+            text = f"Task: {task.get('name', '')}. {task.get('description', '')}"
+            entries.append({"kind": "task", "text": text})
+        for value in (data or {}).get("values", []):
+            entries.append({"kind": "value", "text": f"Value: {value}"})
+        for interest in (data or {}).get("interests", []):
+            entries.append({"kind": "interest", "text": f"Interest: {interest}"})
+        added = await self.remember(userID, entries)
+        current = {self.itemKey(entry["kind"], entry["text"].strip()) for entry in entries}
+        self.store.remove(
+            userID, lambda item: item["kind"] in factKinds and item["key"] not in current
+        )
+        if revision is not None:
+            if userID not in self.factRevisions and len(self.factRevisions) >= self.store.maxUsers:
+                del self.factRevisions[next(iter(self.factRevisions))]
+            self.factRevisions[userID] = revision
+        return added
+
+    def forget(self, userID, character):
+        """Drops a character's indexed messages, keeping the user's facts"""
+        return self.store.remove(
+            userID, lambda item: item["kind"] == "message" and item.get("character") == character
+        )
+
+    def release(self, userID):
+        self.factRevisions.pop(userID, None)
+        self.store.release(userID)
+
+    async def recall(self, userID, query, character=None, k=5, exclude=()):
+        """Returns the texts of the k most similar memories for this character
+        (plus the user's facts), skipping any text in exclude"""
+        if not query:
+            return []
+        vector = (await self.embedder.embed([query]))[0]
+        exclude = set(exclude)
+
+        def where(item):
+            if item["text"] in exclude:
+                return False
+            return item.get("character") in (None, character)
+
+        results = self.store.search(userID, vector, k, where)
+        return [item["text"] for score, item in results if score >= self.minScore]
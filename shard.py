@@ -0,0 +1,362 @@
+import asyncio
+import bisect
+import hashlib
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import threading
+from collections import deque
+
+# Runs the bot as one dispatcher process and N worker processes, so CPU heavy
+# work (image decoding, json, prompt assembly) isn't limited to one core.
+#
+#   python shard.py [workers]
+#
+# The dispatcher receives updates (polling, or a webhook when
+# FRACTAL_WEBHOOK_URL is set) and sends each chat's updates to the same worker,
+# picked by consistent hashing of the chat id. Each worker runs the normal
+# handlers, so per-chat ordering and per-user caches work as in a single
+# process.
+#
+# Signals to the dispatcher:
+#   SIGHUP   restart the workers one at a time, eg. after a code change
+#   SIGUSR1  add a worker
+#   SIGUSR2  remove a worker
+#   SIGINT / SIGTERM  finish in-flight updates and stop
+#
+# With FRACTAL_METRICS_PORT set, worker i serves its metrics on port + i.
+
+
+class HashRing:
+    """Consistent hash ring over nodes with several points per node. Adding or
+    removing one of n nodes only moves about 1/n of the keys"""
+
+    def __init__(self, nodes, replicas=64):
+        self.points = sorted(
+            (self.hash(f"{node}:{replica}"), node) for node in nodes for replica in range(replicas)
+        )
+        self.keys = [point[0] for point in self.points]
+
+    @staticmethod
+    def hash(value):
+        return int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), "big")
+
+    def nodeFor(self, key):
+        i = bisect.bisect(self.keys, self.hash(key)) % len(self.keys)
+        return self.points[i][1]
+
+
+def runWorker(index, generation, inbox, outbox, env):
+    """Worker process entry point"""
+    # Ctrl+C reaches the whole process group, but only the dispatcher decides
+    # when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    os.environ.update(env)
+    asyncio.run(workerMain(index, generation, inbox, outbox))
+
+
+async def workerMain(index, generation, inbox, outbox):
+    import fractal
+    from telegram import Update
+
+    fractal.loadConfig()
+    app = fractal.buildApp(withUpdater=False)
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    loop = asyncio.get_running_loop()
+    parent = multiprocessing.parent_process()
+    running = set()
+
+    async def handle(update, chatID):
+        # Same path as an update fetched by the Application itself
+        try:
+            await app.update_processor.process_update(update, app.process_update(update))
+        except Exception as e:
+            print(f"Worker {index}: update {update.update_id} failed: {e}")
+        finally:
+            outbox.put(("done", index, generation, chatID))
+
+    print(f"Worker {index} ready (pid {os.getpid()})")
+    outbox.put(("ready", index, generation))
+    while True:
+        try:
+            message = await loop.run_in_executor(None, inbox.get, True, 1.0)
+        except queue.Empty:
+            if parent is not None and not parent.is_alive():
+                print(f"Worker {index}: dispatcher is gone, stopping")
+                break
+            continue
+        kind = message[0]
+        if kind == "update":
+            task = asyncio.create_task(handle(Update.de_json(message[1], app.bot), message[2]))
+            running.add(task)
+            task.add_done_callback(running.discard)
+        elif kind == "rebalance":
+            # Users that move to another worker are written out and forgotten
+            ring = HashRing(range(message[1]))
+            for userID in fractal.cachedUsers():
+                if ring.nodeFor(userID) != index:
+                    await fractal.releaseUser(userID)
+            outbox.put(("rebalanced", index, generation))
+        elif kind == "stop":
+            break
+
+    await asyncio.gather(*running, return_exceptions=True)
+    await app.stop()
+    await app.post_shutdown(app)
+    await app.shutdown()
+    fractal.runtimeCache.close()
+    outbox.put(("stopped", index, generation))
+
+
+class WorkerHandle:
+    """The dispatcher's view of one worker slot. A restarted worker keeps its
+    index and gets a new generation, so messages from the old process are ignored"""
+
+    def __init__(self, index):
+        self.index = index
+        self.generation = 0
+        self.process = None
+        self.inbox = None
+        self.pending = 0  # updates sent but not finished yet
+        self.held = None  # updates kept back while the worker restarts
+        self.stopping = False
+        self.drained = asyncio.Event()
+        self.ready = asyncio.Event()
+        self.rebalanced = asyncio.Event()
+
+
+class ShardDispatcher:
+    def __init__(self, workers, startTimeout=60):
+        self.context = multiprocessing.get_context("spawn")
+        self.outbox = self.context.Queue()
+        self.workers = [WorkerHandle(i) for i in range(workers)]
+        self.ring = HashRing(range(workers))
+        self.paused = None  # updates kept back while rebalancing
+        self.control = asyncio.Lock()  # one restart or resize at a time
+        self.startTimeout = startTimeout
+        self.loop = None
+        self.updates = None
+
+    def workerEnv(self, index):
+        env = {}
+        metricsPort = os.environ.get("FRACTAL_METRICS_PORT")
+        if metricsPort:
+            env["FRACTAL_METRICS_PORT"] = str(int(metricsPort) + index)
+        return env
+
+    # Routing
+
+    def route(self, update):
+        if self.paused is not None:
+            self.paused.append(update)
+            return
+        chatID = update.effective_chat.id if update.effective_chat else None
+        key = chatID if chatID is not None else f"update:{update.update_id}"
+        worker = self.workers[self.ring.nodeFor(key)]
+        if worker.held is not None:
+            worker.held.append(update)
+            return
+        worker.pending += 1
+        worker.drained.clear()
+        worker.inbox.put(("update", update.to_dict(), chatID))
+
+    def readOutbox(self):
+        """Runs in a thread, handing worker messages to the event loop"""
+        while True:
+            message = self.outbox.get()
+            if message is None:
+                return
+            self.loop.call_soon_threadsafe(self.onMessage, message)
+
+    def onMessage(self, message):
+        kind, index, generation = message[:3]
+        if index >= len(self.workers) or self.workers[index].generation != generation:
+            return
+        worker = self.workers[index]
+        if kind == "ready":
+            worker.ready.set()
+        elif kind == "done":
+            worker.pending -= 1
+            if worker.pending <= 0:
+                worker.pending = 0
+                worker.drained.set()
+        elif kind == "rebalanced":
+            worker.rebalanced.set()
+
+    # Worker lifecycle
+
+    async def startWorker(self, worker):
+        worker.generation += 1
+        worker.inbox = self.context.Queue()
+        worker.pending = 0
+        worker.stopping = False
+        worker.drained.set()
+        worker.ready.clear()
+        worker.process = self.context.Process(
+            target=runWorker,
+            args=(worker.index, worker.generation, worker.inbox, self.outbox, self.workerEnv(worker.index)),
+            name=f"fractal-worker-{worker.index}",
+        )
+        worker.process.start()
+        try:
+            await asyncio.wait_for(worker.ready.wait(), self.startTimeout)
+        except asyncio.TimeoutError:
+            print(f"Worker {worker.index} didn't start in {self.startTimeout}s")
+
+    async def stopWorker(self, worker):
+        """Waits for the worker's in-flight updates, then stops it"""
+        worker.stopping = True
+        await worker.drained.wait()
+        worker.inbox.put(("stop",))
+        await asyncio.to_thread(worker.process.join, 30)
+        if worker.process.is_alive():
+            print(f"Worker {worker.index} didn't stop, killing it")
+            worker.process.kill()
+
+    async def restartWorker(self, worker):
+        """Restarts one worker. Its chats wait and nobody else's are affected"""
+        worker.held = deque()
+        await self.stopWorker(worker)
+        await self.startWorker(worker)
+        held, worker.held = worker.held, None
+        for update in held:
+            self.route(update)
+
+    async def restartAll(self):
+        async with self.control:
+            print("Restarting workers")
+            for worker in list(self.workers):
+                await self.restartWorker(worker)
+            print("Workers restarted")
+
+    async def resize(self, count):
+        """Changes the number of workers. Updates are held back until every
+        worker is idle, users that change worker are released from their old
+        one, then routing resumes on the new ring"""
+        async with self.control:
+            if count < 1 or count == len(self.workers):
+                return
+            print(f"Rebalancing from {len(self.workers)} to {count} workers")
+            self.paused = []
+            await asyncio.gather(*(worker.drained.wait() for worker in self.workers))
+            for worker in self.workers:
+                worker.rebalanced.clear()
+                worker.inbox.put(("rebalance", count))
+            await asyncio.gather(*(worker.rebalanced.wait() for worker in self.workers))
+            while len(self.workers) > count:
+                await self.stopWorker(self.workers.pop())
+            while len(self.workers) < count:
+                worker = WorkerHandle(len(self.workers))
+                self.workers.append(worker)
+                await self.startWorker(worker)
+            self.ring = HashRing(range(count))
+            paused, self.paused = self.paused, None
+            for update in paused:
+                self.route(update)
+            print(f"Running {count} workers")
+
+    async def monitor(self):
+        """Restarts workers that died. Their in-flight updates are lost"""
+        while True:
+            await asyncio.sleep(1)
+            if self.control.locked():
+                continue
+            for worker in self.workers:
+                if worker.process and not worker.process.is_alive() and not worker.stopping:
+                    print(
+                        f"Worker {worker.index} exited ({worker.process.exitcode}), "
+                        f"{worker.pending} updates lost, restarting"
+                    )
+                    worker.pending = 0
+                    worker.drained.set()
+                    async with self.control:
+                        await self.restartWorker(worker)
+
+    # Dispatcher
+
+    def buildUpdater(self):
+        import fractal
+        from telegram import Bot
+        from telegram.ext import Updater
+
+        if fractal.TELEGRAM_BASE_URL:
+            bot = Bot(
+                fractal.TOKEN,
+                base_url=fractal.TELEGRAM_BASE_URL,
+                base_file_url=fractal.TELEGRAM_BASE_URL,
+            )
+        else:
+            bot = Bot(fractal.TOKEN)
+        self.updates = asyncio.Queue()
+        return Updater(bot, self.updates)
+
+    def stop(self):
+        self.updates.put_nowait(None)
+
+    async def run(self):
+        import fractal
+
+        self.loop = asyncio.get_running_loop()
+        reader = threading.Thread(target=self.readOutbox, name="ShardOutbox", daemon=True)
+        reader.start()
+        await asyncio.gather(*(self.startWorker(worker) for worker in self.workers))
+        monitor = asyncio.create_task(self.monitor())
+
+        updater = self.buildUpdater()
+        for signum, action in (
+            ("SIGINT", self.stop),
+            ("SIGTERM", self.stop),
+            ("SIGHUP", lambda: asyncio.create_task(self.restartAll())),
+            ("SIGUSR1", lambda: asyncio.create_task(self.resize(len(self.workers) + 1))),
+            ("SIGUSR2", lambda: asyncio.create_task(self.resize(len(self.workers) - 1))),
+        ):
+            if hasattr(signal, signum):
+                self.loop.add_signal_handler(getattr(signal, signum), action)
+
+        async with updater:
+            if fractal.WEBHOOK_URL:
+                print(f"Dispatching webhooks from {fractal.WEBHOOK_LISTEN}:{fractal.WEBHOOK_PORT} to {len(self.workers)} workers...")
+                await updater.start_webhook(
+                    listen=fractal.WEBHOOK_LISTEN,
+                    port=fractal.WEBHOOK_PORT,
+                    url_path=fractal.urlparse(fractal.WEBHOOK_URL).path.lstrip("/"),
+                    webhook_url=fractal.WEBHOOK_URL,
+                    secret_token=fractal.WEBHOOK_SECRET,
+                    max_connections=fractal.WEBHOOK_MAX_CONNECTIONS,
+                )
+            else:
+                print(f"Polling for {len(self.workers)} workers...")
+                await updater.start_polling(poll_interval=0)
+            while True:
+                update = await self.updates.get()
+                if update is None:
+                    break
+                self.route(update)
+            await updater.stop()
+
+        print("Stopping workers...")
+        monitor.cancel()
+        async with self.control:
+            await asyncio.gather(*(self.stopWorker(worker) for worker in self.workers))
+        self.outbox.put(None)
+
+
+def main():
+    import fractal
+    import history
+
+    fractal.loadConfig()
+    # Done once here rather than racing in every worker
+    migrated = history.migrateAll()
+    if migrated:
+        print(f"Migrated {migrated} messages to History.jsonl")
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count() or 1
+    asyncio.run(ShardDispatcher(workers).run())
+
+
+if __name__ == "__main__":
+    main()
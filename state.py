@@ -0,0 +1,170 @@
+import atexit
+import itertools
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+def writeJsonAtomic(path, data, **kwargs):
+    """Writes json to a temp file next to path then renames it over path, so
+    readers never see a half written file"""
+    tmpPath = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmpPath, "w", encoding="utf-8") as f:
+        json.dump(data, f, **kwargs)
+    os.replace(tmpPath, path)
+
+
+class UserStateCache:
+    """Process-wide write-behind cache of small per-user json documents.
+
+    Reads are served from memory after the first load. Writes mark the entry
+    dirty and are flushed together by a background thread every flushInterval
+    seconds, so a burst of updates for one user turns into a single disk write.
+    Users that have been idle for idleTimeout seconds, or the least recently
+    used ones past maxUsers, are flushed and dropped from memory.
+
+    Every change gets a version from one counter, and write() skips a snapshot
+    older than what was already stored for the key. A flush that snapshotted
+    an entry just before it was changed and evicted can't overwrite the newer
+    data evicting wrote. Keys with a flush write in flight aren't reloaded
+    until it lands, so a user dropped meanwhile doesn't come back stale.
+    """
+
+    def __init__(self, load, store, flushInterval=2.0, idleTimeout=900, maxUsers=5000):
+        self.load = load
+        self.store = store
+        self.flushInterval = flushInterval
+        self.idleTimeout = idleTimeout
+        self.maxUsers = maxUsers
+        self.entries = OrderedDict()  # key -> [data, lastUsed, version]
+        self.dirty = set()
+        self.lock = threading.RLock()
+        self.writing = {}  # key -> flush writes in flight
+        self.written = threading.Condition(self.lock)
+        self.versions = itertools.count(1)
+        self.stored = {}  # key -> version last written
+        # Taken after lock when both are needed, never the other way round
+        self.storeLock = threading.Lock()
+        self.flusher = None
+        self.stopped = threading.Event()
+        atexit.register(self.close)
+
+    def get(self, key):
+        """Returns a copy of key's data, loading it on first use"""
+        with self.lock:
+            return dict(self.entry(key)[0])
+
+    def update(self, key, data):
+        """Merges data into key's entry and schedules it for writing"""
+        with self.lock:
+            entry = self.entry(key)
+            entry[0].update(data)
+            self.markDirty(key)
+
+    def put(self, key, data):
+        """Replaces key's entry and schedules it for writing"""
+        with self.lock:
+            self.entries[key] = [dict(data), time.monotonic(), 0]
+            self.entries.move_to_end(key)
+            self.markDirty(key)
+            self.evictOverflow()
+
+    def discard(self, key):
+        """Forgets key without writing it, eg. after the file was replaced directly"""
+        with self.lock:
+            self.entries.pop(key, None)
+            self.dirty.discard(key)
+
+    def entry(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            while key in self.writing:
+                self.written.wait()
+                if key in self.entries:
+                    return self.entry(key)
+            entry = [self.load(key), time.monotonic(), 0]
+            self.entries[key] = entry
+            self.evictOverflow()
+        else:
+            entry[1] = time.monotonic()
+        self.entries.move_to_end(key)
+        return entry
+
+    def markDirty(self, key):
+        self.entries[key][2] = next(self.versions)
+        self.dirty.add(key)
+        if self.flusher is None and not self.stopped.is_set():
+            self.flusher = threading.Thread(
+                target=self.run, name="UserStateCache", daemon=True
+            )
+            self.flusher.start()
+
+    def flush(self):
+        """Writes every dirty entry. Returns the number of entries written"""
+        with self.lock:
+            pending = [
+                (key, dict(self.entries[key][0]), self.entries[key][2]) for key in self.dirty
+            ]
+            self.dirty.clear()
+            for key, _, _ in pending:
+                self.writing[key] = self.writing.get(key, 0) + 1
+        for key, data, version in pending:
+            failed = False
+            try:
+                self.write(key, data, version)
+            except Exception as e:
+                print(f"Could not write state for {key}: {e}")
+                failed = True
+            with self.lock:
+                if failed:
+                    # Dropped meanwhile: nothing could reload it, so the snapshot is current
+                    self.entries.setdefault(key, [data, time.monotonic(), version])
+                    self.dirty.add(key)
+                self.writing[key] -= 1
+                if not self.writing[key]:
+                    del self.writing[key]
+                self.written.notify_all()
+        with self.storeLock:
+            # Versions are only needed while the entry is in memory
+            for key in [key for key in self.stored if key not in self.entries]:
+                del self.stored[key]
+        return len(pending)
+
+    def write(self, key, data, version):
+        """Stores data unless a newer version of key was already stored"""
+        with self.storeLock:
+            if self.stored.get(key, 0) >= version:
+                return
+            self.store(key, data)
+            self.stored[key] = version
+
+    def evictIdle(self):
+        """Flushes and drops users that haven't been touched for idleTimeout seconds"""
+        cutoff = time.monotonic() - self.idleTimeout
+        with self.lock:
+            idle = [key for key, entry in self.entries.items() if entry[1] < cutoff]
+        self.drop(idle)
+
+    def evictOverflow(self):
+        overflow = len(self.entries) - self.maxUsers
+        if overflow > 0:
+            self.drop(list(self.entries)[:overflow])
+
+    def drop(self, keys):
+        with self.lock:
+            for key in keys:
+                entry = self.entries.pop(key, None)
+                if entry is not None and key in self.dirty:
+                    self.dirty.discard(key)
+                    self.write(key, entry[0], entry[2])
+
+    def run(self):
+        while not self.stopped.wait(self.flushInterval):
+            self.flush()
+            self.evictIdle()
+
+    def close(self):
+        self.stopped.set()
+        self.flush()
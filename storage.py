@@ -0,0 +1,493 @@
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import history
+from state import writeJsonAtomic
+
+
+class Storage:
+    """Interface every storage backend implements. Missing documents are
+    returned as None so callers can decide on defaults"""
+
+    def loadRuntime(self, userID):
+        raise NotImplementedError
+
+    def storeRuntime(self, userID, data):
+        raise NotImplementedError
+
+    def getUser(self, userID):
+        raise NotImplementedError
+
+    def setUser(self, userID, data):
+        raise NotImplementedError
+
+    def getCard(self, userID, character):
+        raise NotImplementedError
+
+    def setCard(self, userID, character, card):
+        raise NotImplementedError
+
+    def cardStamp(self, userID, character):
+        """Returns a value that changes whenever the character card is rewritten"""
+        raise NotImplementedError
+
+    def getDiffusion(self, userID, character):
+        raise NotImplementedError
+
+    def setDiffusion(self, userID, character, data):
+        raise NotImplementedError
+
+    def diffusionStamp(self, userID, character):
+        """Returns a value that changes whenever the diffusion prompts are rewritten"""
+        raise NotImplementedError
+
+    def getMemory(self, userID, character):
+        raise NotImplementedError
+
+    def setMemory(self, userID, character, memory):
+        raise NotImplementedError
+
+    def appendHistory(self, userID, character, record):
+        raise NotImplementedError
+
+    def readHistory(self, userID, character, start=0, end=None):
+        raise NotImplementedError
+
+    def countHistory(self, userID, character):
+        raise NotImplementedError
+
+    def readHistoryBackwards(self, userID, character, first=0, chunk=32):
+        """Yields records newest first, down to record first, reading chunk
+        records at a time so stopping early never loads the whole chat"""
+        end = self.countHistory(userID, character)
+        while end > first:
+            start = max(first, end - chunk)
+            yield from reversed(self.readHistory(userID, character, start, end))
+            end = start
+
+    def clearHistory(self, userID, character):
+        raise NotImplementedError
+
+    def userExists(self, userID):
+        raise NotImplementedError
+
+    def listUsers(self):
+        raise NotImplementedError
+
+    def listCharacters(self, userID):
+        raise NotImplementedError
+
+
+class JsonStorage(Storage):
+    """The original Data/{userID}/... tree of json files"""
+
+    def __init__(self, root="Data"):
+        self.root = root
+
+    def userDir(self, userID):
+        return f"{self.root}/{userID}"
+
+    def characterDir(self, userID, character):
+        return f"{self.root}/{userID}/Characters/{character}"
+
+    def readJson(self, path):
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            content = f.read()
+        return json.loads(content) if content.strip() else None
+
+    def writeJson(self, path, data, **kwargs):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        writeJsonAtomic(path, data, **kwargs)
+
+    def loadRuntime(self, userID):
+        return self.readJson(f"{self.userDir(userID)}/Runtime.json")
+
+    def storeRuntime(self, userID, data):
+        self.writeJson(f"{self.userDir(userID)}/Runtime.json", data)
+
+    def getUser(self, userID):
+        return self.readJson(f"{self.userDir(userID)}/User.json")
+
+    def setUser(self, userID, data):
+        self.writeJson(f"{self.userDir(userID)}/User.json", data, indent=4)
+
+    def getCard(self, userID, character):
+        return self.readJson(f"{self.characterDir(userID, character)}/CharacterCard.json")
+
+    def setCard(self, userID, character, card):
+        self.writeJson(f"{self.characterDir(userID, character)}/CharacterCard.json", card)
+
+    def cardStamp(self, userID, character):
+        try:
+            return os.stat(f"{self.characterDir(userID, character)}/CharacterCard.json").st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def getDiffusion(self, userID, character):
+        return self.readJson(f"{self.characterDir(userID, character)}/Diffusion.json")
+
+    def setDiffusion(self, userID, character, data):
+        self.writeJson(f"{self.characterDir(userID, character)}/Diffusion.json", data, indent=4)
+
+    def diffusionStamp(self, userID, character):
+        try:
+            stat = os.stat(f"{self.characterDir(userID, character)}/Diffusion.json")
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def getMemory(self, userID, character):
+        return self.readJson(f"{self.characterDir(userID, character)}/Memory.json")
+
+    def setMemory(self, userID, character, memory):
+        self.writeJson(f"{self.characterDir(userID, character)}/Memory.json", memory, indent=4)
+
+    def appendHistory(self, userID, character, record):
+        directory = self.characterDir(userID, character)
+        os.makedirs(directory, exist_ok=True)
+        history.appendRecord(directory, record)
+
+    def readHistory(self, userID, character, start=0, end=None):
+        return history.readRecords(self.characterDir(userID, character), start, end)
+
+    def countHistory(self, userID, character):
+        return history.countRecords(self.characterDir(userID, character))
+
+    def clearHistory(self, userID, character):
+        history.clearRecords(self.characterDir(userID, character))
+
+    def userExists(self, userID):
+        return os.path.exists(self.userDir(userID))
+
+    def listUsers(self):
+        if not os.path.exists(self.root):
+            return []
+        return [u for u in os.listdir(self.root) if os.path.isdir(self.userDir(u))]
+
+    def listCharacters(self, userID):
+        charactersDir = f"{self.userDir(userID)}/Characters"
+        if not os.path.exists(charactersDir):
+            return []
+        return [c for c in os.listdir(charactersDir) if os.path.isdir(f"{charactersDir}/{c}")]
+
+
+class SQLiteStorage(Storage):
+    """All user state in one WAL mode SQLite file. Tasks are split out of the
+    user document into their own table, one row per position, so saving a user
+    only rewrites the tasks that changed. TaskStore indexes them in memory"""
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS runtime (
+        user TEXT PRIMARY KEY,
+        data TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS users (
+        user TEXT PRIMARY KEY,
+        data TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS tasks (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user TEXT NOT NULL,
+        position INTEGER NOT NULL,
+        status TEXT,
+        due TEXT,
+        data TEXT NOT NULL
+    );
+    DROP INDEX IF EXISTS tasks_user_status;
+    DROP INDEX IF EXISTS tasks_user_due;
+    CREATE UNIQUE INDEX IF NOT EXISTS tasks_user_position ON tasks (user, position);
+    CREATE TABLE IF NOT EXISTS history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user TEXT NOT NULL,
+        character TEXT NOT NULL,
+        timestamp REAL NOT NULL,
+        data TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS history_user_character_time ON history (user, character, timestamp);
+    CREATE INDEX IF NOT EXISTS history_user_character_id ON history (user, character, id);
+    CREATE TABLE IF NOT EXISTS cards (
+        user TEXT NOT NULL,
+        character TEXT NOT NULL,
+        data TEXT NOT NULL,
+        updated REAL NOT NULL,
+        PRIMARY KEY (user, character)
+    );
+    CREATE TABLE IF NOT EXISTS diffusion (
+        user TEXT NOT NULL,
+        character TEXT NOT NULL,
+        data TEXT NOT NULL,
+        PRIMARY KEY (user, character)
+    );
+    CREATE TABLE IF NOT EXISTS memory (
+        user TEXT NOT NULL,
+        character TEXT NOT NULL,
+        data TEXT NOT NULL,
+        PRIMARY KEY (user, character)
+    );
+    """
+
+    def __init__(self, path="Data/fractal.db"):
+        # The file is created on first use, so opening a storage is free
+        self.path = path
+        self.local = threading.local()
+        self.created = False
+
+    def connection(self):
+        """One connection per thread, as sqlite3 connections can't be shared"""
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            if not self.created and os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            if not self.created:
+                conn.executescript(self.schema)
+                self.created = True
+            self.local.conn = conn
+        return conn
+
+    def fetchJson(self, query, params):
+        row = self.connection().execute(query, params).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def loadRuntime(self, userID):
+        return self.fetchJson("SELECT data FROM runtime WHERE user = ?", (str(userID),))
+
+    def storeRuntime(self, userID, data):
+        with self.connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO runtime (user, data) VALUES (?, ?)",
+                (str(userID), json.dumps(data)),
+            )
+
+    def getUser(self, userID):
+        user = self.fetchJson("SELECT data FROM users WHERE user = ?", (str(userID),))
+        if user is None:
+            return None
+        rows = self.connection().execute(
+            "SELECT data FROM tasks WHERE user = ? ORDER BY position", (str(userID),)
+        )
+        user["tasks"] = [json.loads(row[0]) for row in rows]
+        return user
+
+    def setUser(self, userID, data):
+        data = dict(data)
+        tasks = data.pop("tasks", [])
+        with self.connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO users (user, data) VALUES (?, ?)",
+                (str(userID), json.dumps(data)),
+            )
+            stored = dict(
+                conn.execute("SELECT position, data FROM tasks WHERE user = ?", (str(userID),))
+            )
+            changed = []
+            for i, task in enumerate(tasks):
+                encoded = json.dumps(task)
+                if stored.get(i) != encoded:
+                    changed.append(
+                        (str(userID), i, task.get("status"), dueKey(task.get("due")), encoded)
+                    )
+            conn.executemany(
+                "INSERT INTO tasks (user, position, status, due, data) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (user, position) DO UPDATE SET "
+                "status = excluded.status, due = excluded.due, data = excluded.data",
+                changed,
+            )
+            if len(stored) > len(tasks):
+                conn.execute(
+                    "DELETE FROM tasks WHERE user = ? AND position >= ?", (str(userID), len(tasks))
+                )
+
+    def getCard(self, userID, character):
+        return self.fetchJson(
+            "SELECT data FROM cards WHERE user = ? AND character = ?", (str(userID), character)
+        )
+
+    def setCard(self, userID, character, card):
+        with self.connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO cards (user, character, data, updated) VALUES (?, ?, ?, ?)",
+                (str(userID), character, json.dumps(card), time.time()),
+            )
+
+    def cardStamp(self, userID, character):
+        row = self.connection().execute(
+            "SELECT updated FROM cards WHERE user = ? AND character = ?", (str(userID), character)
+        ).fetchone()
+        return row[0] if row else None
+
+    def getDiffusion(self, userID, character):
+        return self.fetchJson(
+            "SELECT data FROM diffusion WHERE user = ? AND character = ?", (str(userID), character)
+        )
+
+    def setDiffusion(self, userID, character, data):
+        with self.connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO diffusion (user, character, data) VALUES (?, ?, ?)",
+                (str(userID), character, json.dumps(data)),
+            )
+
+    def diffusionStamp(self, userID, character):
+        # REPLACE deletes and reinserts the row, so its rowid changes on every write
+        row = self.connection().execute(
+            "SELECT rowid FROM diffusion WHERE user = ? AND character = ?", (str(userID), character)
+        ).fetchone()
+        return row[0] if row else None
+
+    def getMemory(self, userID, character):
+        return self.fetchJson(
+            "SELECT data FROM memory WHERE user = ? AND character = ?", (str(userID), character)
+        )
+
+    def setMemory(self, userID, character, memory):
+        with self.connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO memory (user, character, data) VALUES (?, ?, ?)",
+                (str(userID), character, json.dumps(memory)),
+            )
+
+    def appendHistory(self, userID, character, record):
+        with self.connection() as conn:
+            conn.execute(
+                "INSERT INTO history (user, character, timestamp, data) VALUES (?, ?, ?, ?)",
+                (str(userID), character, time.time(), json.dumps(record, ensure_ascii=False)),
+            )
+
+    def readHistory(self, userID, character, start=0, end=None):
+        # Records are in insertion (id) order, wall clock timestamps can go
+        # backwards. Only negative positions need the count
+        if start < 0 or (end is not None and end < 0):
+            start, end, _ = slice(start, end).indices(self.countHistory(userID, character))
+        if end is not None and end <= start:
+            return []
+        limit = -1 if end is None else end - start
+        rows = self.connection().execute(
+            "SELECT data FROM history WHERE user = ? AND character = ? "
+            "ORDER BY id LIMIT ? OFFSET ?",
+            (str(userID), character, limit, start),
+        )
+        return [json.loads(row[0]) for row in rows]
+
+    def readHistoryBackwards(self, userID, character, first=0, chunk=32):
+        # Keyset paging on id, each chunk is an index range scan whatever the
+        # chat's length. The count is only needed to stop at record first
+        remaining = self.countHistory(userID, character) - first if first else None
+        lastID = None
+        while remaining is None or remaining > 0:
+            limit = chunk if remaining is None else min(chunk, remaining)
+            if lastID is None:
+                rows = self.connection().execute(
+                    "SELECT id, data FROM history WHERE user = ? AND character = ? "
+                    "ORDER BY id DESC LIMIT ?",
+                    (str(userID), character, limit),
+                ).fetchall()
+            else:
+                rows = self.connection().execute(
+                    "SELECT id, data FROM history WHERE user = ? AND character = ? AND id < ? "
+                    "ORDER BY id DESC LIMIT ?",
+                    (str(userID), character, lastID, limit),
+                ).fetchall()
+            if not rows:
+                return
+            for _, data in rows:
+                yield json.loads(data)
+            lastID = rows[-1][0]
+            if remaining is not None:
+                remaining -= len(rows)
+
+    def countHistory(self, userID, character):
+        return self.connection().execute(
+            "SELECT COUNT(*) FROM history WHERE user = ? AND character = ?",
+            (str(userID), character),
+        ).fetchone()[0]
+
+    def clearHistory(self, userID, character):
+        with self.connection() as conn:
+            conn.execute(
+                "DELETE FROM history WHERE user = ? AND character = ?", (str(userID), character)
+            )
+
+    def userExists(self, userID):
+        return self.loadRuntime(userID) is not None or self.getUser(userID) is not None
+
+    def listUsers(self):
+        rows = self.connection().execute("SELECT user FROM runtime UNION SELECT user FROM users")
+        return [row[0] for row in rows]
+
+    def listCharacters(self, userID):
+        rows = self.connection().execute(
+            "SELECT character FROM cards WHERE user = ? UNION "
+            "SELECT DISTINCT character FROM history WHERE user = ?",
+            (str(userID), str(userID)),
+        )
+        return [row[0] for row in rows]
+
+
+def dueKey(due):
+    """Normalizes a task's due date to a sortable ISO string for indexing"""
+    if not due:
+        return None
+    for fmt in ("%m-%d-%Y %H:%M", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return time.strftime("%Y-%m-%dT%H:%M", time.strptime(due, fmt))
+        except ValueError:
+            continue
+    return due
+
+
+def migrate(source: Storage, target: Storage):
+    """Copies every user, character card, diffusion prompt, memory and history from
+    source into target. Returns the number of users copied"""
+    users = source.listUsers()
+    for userID in users:
+        runtime = source.loadRuntime(userID)
+        if runtime is not None:
+            target.storeRuntime(userID, runtime)
+        user = source.getUser(userID)
+        if user is not None:
+            target.setUser(userID, user)
+        for character in source.listCharacters(userID):
+            card = source.getCard(userID, character)
+            if card is not None:
+                target.setCard(userID, character, card)
+            diffusion = source.getDiffusion(userID, character)
+            if diffusion is not None:
+                target.setDiffusion(userID, character, diffusion)
+            memory = source.getMemory(userID, character)
+            if memory is not None:
+                target.setMemory(userID, character, memory)
+            if isinstance(source, JsonStorage):
+                history.migrateHistoryJson(source.characterDir(userID, character))
+            target.clearHistory(userID, character)
+            for record in source.readHistory(userID, character):
+                target.appendHistory(userID, character, record)
+    return len(users)
+
+
+def openStorage():
+    """Picks the backend from FRACTAL_STORAGE ("json" or "sqlite").
+    FRACTAL_DB sets the SQLite file path"""
+    backend = os.environ.get("FRACTAL_STORAGE", "json").lower()
+    if backend == "sqlite":
+        return SQLiteStorage(os.environ.get("FRACTAL_DB", "Data/fractal.db"))
+    return JsonStorage()
+
+
+if __name__ == "__main__":
+    # python storage.py migrate [Data] [Data/fractal.db]
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate":
+        root = sys.argv[2] if len(sys.argv) > 2 else "Data"
+        db = sys.argv[3] if len(sys.argv) > 3 else f"{root}/fractal.db"
+        count = migrate(JsonStorage(root), SQLiteStorage(db))
+        print(f"Imported {count} users into {db}")
+    else:
+        print("Usage: python storage.py migrate [Data] [Data/fractal.db]")
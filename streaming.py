@@ -0,0 +1,73 @@
+import asyncio
+import time
+
+from telegram.error import BadRequest, RetryAfter
+
+# Telegram rejects messages over 4096 characters
+maxMessageLength = 4096
+
+
+class StreamingReply:
+    """A Telegram reply that grows as the model streams tokens.
+
+    start() sends a placeholder, update(text) edits it with the reply so far
+    at most once every minInterval seconds (and only once minChars new
+    characters arrived), and finish(text) makes the last edit right away.
+    Flood control (RetryAfter) pushes the next edit, including the last one,
+    back instead of failing the reply.
+    """
+
+    def __init__(self, message, placeholder="...", minInterval=1.0, minChars=15):
+        self.message = message
+        self.placeholder = placeholder
+        self.minInterval = minInterval
+        self.minChars = minChars
+        self.sent = None
+        self.shown = ""
+        self.nextEdit = 0.0  # throttles update() only
+        self.retryAt = 0.0  # set by flood control, every edit waits for it
+
+    async def start(self):
+        self.sent = await self.message.reply_text(self.placeholder)
+        self.nextEdit = time.monotonic() + self.minInterval
+
+    async def update(self, text):
+        if time.monotonic() < max(self.nextEdit, self.retryAt):
+            return
+        # A reply that starts over (eg. after a function call) is shown right away
+        if text.startswith(self.shown) and len(text) - len(self.shown) < self.minChars:
+            return
+        await self.edit(text)
+
+    async def finish(self, text):
+        text = text or self.placeholder
+        if text == self.shown:
+            return
+        for attempt in range(3):
+            delay = self.retryAt - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if await self.edit(text):
+                return
+        # Still throttled after waiting, send the full reply on its own
+        await self.message.reply_text(text[:maxMessageLength])
+
+    async def edit(self, text):
+        text = text[:maxMessageLength].strip()
+        if not text or text == self.shown:
+            return True
+        try:
+            await self.sent.edit_text(text)
+        except RetryAfter as e:
+            retryAfter = e.retry_after
+            if not isinstance(retryAfter, (int, float)):
+                retryAfter = retryAfter.total_seconds()
+            self.retryAt = time.monotonic() + retryAfter
+            return False
+        except BadRequest as e:
+            # Raised when the text didn't change after Telegram's own cleanup
+            if "not modified" not in str(e).lower():
+                raise
+        self.shown = text
+        self.nextEdit = time.monotonic() + self.minInterval
+        return True
@@ -0,0 +1,205 @@
+import itertools
+import threading
+from bisect import insort
+from datetime import datetime
+
+from storage import dueKey
+
+# Statuses from the AddNewTask schema. Older data used "complete"
+openStatuses = ("unstarted", "in-progress")
+doneStatus = "completed"
+
+
+class TaskIndex:
+    """One user's open tasks with secondary indexes by status and due date.
+    Completed tasks live in a separate archive and are never scanned here"""
+
+    def __init__(self, tasks):
+        self.byID = {}
+        self.byStatus = {}
+        self.byDue = []  # sorted (dueKey, id), tasks without a due date sort last
+        for task in tasks:
+            self.insert(task)
+
+    def insert(self, task):
+        self.byID[task["id"]] = task
+        self.byStatus.setdefault(task.get("status"), set()).add(task["id"])
+        insort(self.byDue, (dueKey(task.get("due")) or "~", task["id"]))
+
+    def remove(self, taskID):
+        task = self.byID.pop(taskID)
+        self.byStatus.get(task.get("status"), set()).discard(taskID)
+        self.byDue.remove((dueKey(task.get("due")) or "~", taskID))
+        return task
+
+    def query(self, status=None, dueBefore=None):
+        """Open tasks ordered by due date, optionally filtered by status and by
+        being due before a datetime or "%m-%d-%Y %H:%M" string"""
+        ids = self.byStatus.get(status, set()) if status else None
+        limit = dueKey(dueBefore.strftime("%m-%d-%Y %H:%M") if isinstance(dueBefore, datetime) else dueBefore)
+        result = []
+        for key, taskID in self.byDue:
+            if limit and key >= limit:
+                break
+            if ids is None or taskID in ids:
+                result.append(self.byID[taskID])
+        return result
+
+
+class TaskStore:
+    """Tasks kept in the user document with stable ids.
+
+    User data holds open tasks under "tasks" and completed ones under
+    "archive" (trimmed to maxArchived), plus a "nextTaskID" counter. The
+    user data and a TaskIndex over it are loaded once per user (for up to
+    maxUsers users) and kept in step with every change made through this
+    class. Call invalidate() after writing user data some other way.
+
+    Reads and writes hold one of lockStripes locks picked by user, so disk
+    I/O for one user doesn't wait on other users. self.lock only guards the
+    loaded dict and is never held during I/O.
+
+    Every load and save gets a new revision from one counter, so callers
+    that derive something from the user data (the recall index) can tell
+    when to redo it.
+    """
+
+    def __init__(self, getUser, setUser, maxArchived=200, maxUsers=1000, lockStripes=64):
+        self.getUser = getUser
+        self.setUser = setUser
+        self.maxArchived = maxArchived
+        self.maxUsers = maxUsers
+        self.loaded = {}  # userID -> (data, index)
+        self.revisions = {}  # userID -> revision of the loaded data
+        self.counter = itertools.count(1)
+        self.lock = threading.Lock()
+        self.userLocks = [threading.RLock() for _ in range(lockStripes)]
+
+    def userLock(self, userID):
+        return self.userLocks[hash(str(userID)) % len(self.userLocks)]
+
+    def invalidate(self, userID):
+        with self.userLock(userID), self.lock:
+            self.loaded.pop(userID, None)
+            self.revisions.pop(userID, None)
+
+    def load(self, userID):
+        """Returns (user data, index), upgrading old task lists on the way.
+        Called with userID's lock held"""
+        with self.lock:
+            cached = self.loaded.get(userID)
+        if cached is not None:
+            return cached
+        data = self.getUser(userID) or {"tasks": [], "values": [], "interests": []}
+        if self.upgrade(data):
+            self.setUser(userID, data)
+        loaded = (data, TaskIndex(data["tasks"]))
+        with self.lock:
+            if len(self.loaded) >= self.maxUsers:
+                oldest = next(iter(self.loaded))
+                del self.loaded[oldest]
+                self.revisions.pop(oldest, None)
+            self.loaded[userID] = loaded
+            self.revisions[userID] = next(self.counter)
+        return loaded
+
+    def upgrade(self, data):
+        """Gives every task an id and moves completed tasks to the archive.
+        Returns True if data was changed"""
+        changed = False
+        data.setdefault("tasks", [])
+        data.setdefault("archive", [])
+        nextID = data.get("nextTaskID", 1)
+        for task in data["tasks"] + data["archive"]:
+            if "id" not in task:
+                task["id"] = nextID
+                nextID += 1
+                changed = True
+            if task.get("status") == "complete":
+                task["status"] = doneStatus
+                changed = True
+        done = [task for task in data["tasks"] if task.get("status") == doneStatus]
+        if done:
+            data["tasks"] = [task for task in data["tasks"] if task.get("status") != doneStatus]
+            data["archive"].extend(done)
+            changed = True
+        if data.get("nextTaskID") != nextID:
+            data["nextTaskID"] = nextID
+            changed = True
+        return changed
+
+    def add(self, userID, task):
+        """Stores a new task and returns it with its id"""
+        with self.userLock(userID):
+            data, index = self.load(userID)
+            task = dict(task, id=data["nextTaskID"])
+            data["nextTaskID"] += 1
+            if task.get("status") == doneStatus:
+                data["archive"].append(task)
+            else:
+                data["tasks"].append(task)
+                index.insert(task)
+            self.save(userID, data)
+            return task
+
+    def openTasks(self, userID):
+        with self.userLock(userID):
+            return list(self.load(userID)[0]["tasks"])
+
+    def revision(self, userID):
+        """Revision of the user's cached data, None if it isn't loaded. Never
+        waits on disk I/O"""
+        with self.lock:
+            return self.revisions.get(userID)
+
+    def facts(self, userID):
+        """Returns (revision, {"tasks", "values", "interests"}) from the
+        cached user data, with tasks holding only open ones"""
+        with self.userLock(userID):
+            data = self.load(userID)[0]
+            with self.lock:
+                revision = self.revisions.get(userID)
+            return revision, {
+                key: list(data.get(key) or []) for key in ("tasks", "values", "interests")
+            }
+
+    def query(self, userID, status=None, dueBefore=None, page=1, pageSize=10):
+        """Returns a page of open tasks ordered by due date:
+        {"tasks", "page", "pages", "total"}"""
+        with self.userLock(userID):
+            matches = self.load(userID)[1].query(status, dueBefore)
+        pages = max(1, -(-len(matches) // pageSize))
+        page = min(max(1, page), pages)
+        start = (page - 1) * pageSize
+        return {
+            "tasks": matches[start : start + pageSize],
+            "page": page,
+            "pages": pages,
+            "total": len(matches),
+        }
+
+    def setStatus(self, userID, taskID, status):
+        """Updates an open task's status, archiving it once completed.
+        Returns the task or None if there's no open task with that id"""
+        with self.userLock(userID):
+            data, index = self.load(userID)
+            if taskID not in index.byID:
+                return None
+            task = index.remove(taskID)
+            task["status"] = status
+            if status == doneStatus:
+                data["tasks"] = [t for t in data["tasks"] if t["id"] != taskID]
+                task["completedAt"] = datetime.now().strftime("%m-%d-%Y %H:%M")
+                data["archive"].append(task)
+            else:
+                index.insert(task)
+            self.save(userID, data)
+            return task
+
+    def save(self, userID, data):
+        if len(data["archive"]) > self.maxArchived:
+            data["archive"] = data["archive"][-self.maxArchived :]
+        self.setUser(userID, data)
+        with self.lock:
+            if userID in self.loaded:
+                self.revisions[userID] = next(self.counter)
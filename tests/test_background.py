@@ -0,0 +1,23 @@
+import asyncio
+
+import fractal
+
+
+def testWaitForBackgroundPerUser():
+    async def run():
+        finished = []
+
+        async def work(name, delay):
+            await asyncio.sleep(delay)
+            finished.append(name)
+
+        fractal.runInBackground(1, work("one", 0.05))
+        fractal.runInBackground(2, work("two", 0.3))
+        await fractal.waitForBackground(1)
+        assert finished == ["one"]
+        assert 1 not in fractal.backgroundTasks
+        await fractal.waitForBackground()
+        assert finished == ["one", "two"]
+        assert fractal.backgroundTasks == {}
+
+    asyncio.run(run())
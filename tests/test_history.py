@@ -0,0 +1,106 @@
+import json
+import os
+
+import history
+
+
+def records(n):
+    return [{"role": "user", "msg": f"message {i}"} for i in range(n)]
+
+
+def fill(directory, n):
+    for record in records(n):
+        history.appendRecord(directory, record)
+
+
+def testSliceReads(tmp_path):
+    fill(tmp_path, 10)
+    expected = records(10)
+    assert history.countRecords(tmp_path) == 10
+    assert history.readRecords(tmp_path) == expected
+    assert history.readRecords(tmp_path, 3, 6) == expected[3:6]
+    assert history.readRecords(tmp_path, -4) == expected[-4:]
+    assert history.readRecords(tmp_path, -4, -1) == expected[-4:-1]
+    assert history.readRecords(tmp_path, 8, 3) == []
+
+
+def testEmptyLog(tmp_path):
+    assert history.countRecords(tmp_path) == 0
+    assert history.readRecords(tmp_path) == []
+
+
+def testMigrateHistoryJson(tmp_path):
+    (tmp_path / "History.json").write_text(json.dumps(records(5)), encoding="utf-8")
+    assert history.migrateHistoryJson(tmp_path) == 5
+    assert history.readRecords(tmp_path) == records(5)
+    assert not (tmp_path / "History.json").exists()
+    assert (tmp_path / "History.json.bak").exists()
+    # Already migrated
+    assert history.migrateHistoryJson(tmp_path) == 0
+
+
+def testMigrateKeepsExistingLog(tmp_path):
+    fill(tmp_path, 2)
+    (tmp_path / "History.json").write_text(json.dumps(records(5)), encoding="utf-8")
+    assert history.migrateHistoryJson(tmp_path) == 0
+    assert history.readRecords(tmp_path) == records(2)
+
+
+def testMigrateAll(tmp_path):
+    directory = tmp_path / "1" / "Characters" / "Kamelle"
+    directory.mkdir(parents=True)
+    (directory / "History.json").write_text(json.dumps(records(3)), encoding="utf-8")
+    assert history.migrateAll(str(tmp_path)) == 3
+    assert history.readRecords(directory) == records(3)
+
+
+def testTornAppendIsCutOff(tmp_path):
+    fill(tmp_path, 3)
+    logPath = tmp_path / history.logName
+    with open(logPath, "ab") as log:
+        log.write(b'{"role": "user", "ms')  # interrupted before the index write
+    assert history.readRecords(tmp_path) == records(3)
+
+    history.appendRecord(tmp_path, {"role": "user", "msg": "after"})
+    assert history.readRecords(tmp_path) == records(3) + [{"role": "user", "msg": "after"}]
+    assert logPath.read_bytes().endswith(b"\n")
+
+
+def testUnindexedLineIsIndexed(tmp_path):
+    fill(tmp_path, 2)
+    with open(tmp_path / history.logName, "ab") as log:
+        log.write(b'{"role": "user", "msg": "lost index"}\n')
+    assert history.readRecords(tmp_path) == records(2)
+
+    history.appendRecord(tmp_path, {"role": "user", "msg": "after"})
+    assert history.readRecords(tmp_path)[-2:] == [
+        {"role": "user", "msg": "lost index"},
+        {"role": "user", "msg": "after"},
+    ]
+
+
+def testTornFirstRecord(tmp_path):
+    with open(tmp_path / history.logName, "wb") as log:
+        log.write(b'{"role": "us')
+    history.appendRecord(tmp_path, {"role": "user", "msg": "first"})
+    assert history.readRecords(tmp_path) == [{"role": "user", "msg": "first"}]
+
+
+def testUnreadableLineIsSkipped(tmp_path):
+    fill(tmp_path, 2)
+    # What an older version left behind: a torn record glued to the next one
+    with open(tmp_path / history.logName, "ab") as log:
+        log.write(b'{"role": "us{"role": "user", "msg": "glued"}\n')
+    history.rebuildIndex(tmp_path)
+    history.appendRecord(tmp_path, {"role": "user", "msg": "after"})
+    assert history.readRecords(tmp_path) == records(2) + [{"role": "user", "msg": "after"}]
+
+
+def testRebuildIndexSkipsTornLine(tmp_path):
+    fill(tmp_path, 3)
+    with open(tmp_path / history.logName, "ab") as log:
+        log.write(b'{"role"')
+    os.remove(tmp_path / history.indexName)
+    history.rebuildIndex(tmp_path)
+    assert history.countRecords(tmp_path) == 3
+    assert history.readRecords(tmp_path) == records(3)
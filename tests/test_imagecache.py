@@ -0,0 +1,35 @@
+from imagecache import ImageCache, payloadKey
+
+
+def testKeyIgnoresSeedAndSpelling():
+    assert payloadKey({"prompt": "A,  smiling ,cafe", "seed": 1}) == payloadKey(
+        {"prompt": "a, smiling, cafe", "seed": 5, "batch_size": 2}
+    )
+    assert payloadKey({"prompt": "a", "width": 512}) != payloadKey({"prompt": "a", "width": 640})
+
+
+def testVariantsThenReuse(tmp_path):
+    cache = ImageCache(str(tmp_path), variants=2)
+    assert cache.pick("k") is None
+    cache.put("k", b"one")
+    assert cache.pick("k") is None
+    cache.put("k", b"two")
+    assert cache.pick("k") in (f"{tmp_path}/k-0.png", f"{tmp_path}/k-1.png")
+
+
+def testEvictsLeastRecentlyUsed(tmp_path):
+    cache = ImageCache(str(tmp_path), maxBytes=250, variants=1)
+    for key in "abc":
+        cache.put(key, b"x" * 100)
+    assert cache.pick("a") is None
+    assert cache.pick("c") is not None
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["b-0.png", "c-0.png"]
+    # A new instance indexes what is on disk
+    assert ImageCache(str(tmp_path), variants=1).pick("b") is not None
+
+
+def testNoVariantsNeverStores(tmp_path):
+    cache = ImageCache(str(tmp_path), variants=0)
+    cache.put("k", b"png")
+    assert cache.pick("k") is None
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,38 @@
+import asyncio
+import os
+
+import fractal
+from llmcache import ResponseCache
+
+
+def testPruneDropsExpiredEntries(tmp_path):
+    cache = ResponseCache(ttl=60, directory=str(tmp_path))
+    cache.put("old", {"text": "old"})
+    cache.put("new", {"text": "new"})
+    # Age one entry past its ttl in memory and on disk
+    cache.entries["old"] = (0, {"text": "old"})
+    with open(cache.diskPath("old"), "w", encoding="utf-8") as f:
+        f.write('{"expires": 0, "value": {"text": "old"}}')
+    assert cache.prune() == 1
+    assert list(cache.entries) == ["new"]
+    assert sorted(os.listdir(tmp_path)) == ["new.json"]
+    assert cache.get("new") == {"text": "new"}
+
+
+def testPrunedOnATimer(tmp_path, monkeypatch):
+    cache = ResponseCache(ttl=60, directory=str(tmp_path))
+    cache.put("old", {"text": "old"})
+    cache.entries["old"] = (0, {"text": "old"})
+    monkeypatch.setattr(fractal, "helperCache", cache)
+    monkeypatch.setattr(fractal, "helperCachePruneInterval", 0.01)
+
+    async def run():
+        pruner = asyncio.create_task(fractal.pruneHelperCache())
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if not cache.entries:
+                break
+        pruner.cancel()
+
+    asyncio.run(run())
+    assert not cache.entries
@@ -0,0 +1,45 @@
+import pytest
+
+from matcher import matchName
+
+tasks = ["Pay electricity bill", "Rent a car", "Clean the garage", "Wash dishes", "Walk the dog", "Call mom"]
+
+
+@pytest.mark.parametrize(
+    "query, names, expected",
+    [
+        ("washed the dishes", tasks, "Wash dishes"),
+        ("I walked the dog", tasks, "Walk the dog"),
+        ("paid the electricity bill", tasks, "Pay electricity bill"),
+        ("called mom", tasks, "Call mom"),
+        ("walked the dog", ["Walk the dog"], "Walk the dog"),
+    ],
+)
+def testConfidentMatch(query, names, expected):
+    index, shortlist = matchName(query, names)
+    assert index is not None
+    assert names[index] == expected
+    assert shortlist == [index]
+
+
+@pytest.mark.parametrize(
+    "query, names",
+    [
+        # One shared word isn't enough to complete a task without asking
+        ("paid rent", ["Pay electricity bill", "Rent a car"]),
+        ("cleaned my room", ["Clean the garage", "Buy milk"]),
+        ("cleaned my room", ["Clean the garage"]),
+        ("washed the car", ["Wash dishes", "Call mom"]),
+        ("washed the car", ["Wash dishes"]),
+    ],
+)
+def testAmbiguousGoesToModel(query, names):
+    index, shortlist = matchName(query, names)
+    assert index is None
+    assert shortlist
+
+
+def testShortlistFallsBackToEveryName():
+    index, shortlist = matchName("xyzzy", ["Buy milk", "Call mom"])
+    assert index is None
+    assert shortlist == [0, 1]
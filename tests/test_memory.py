@@ -0,0 +1,53 @@
+import asyncio
+
+from memory import MemoryCompactor
+from storage import JsonStorage
+
+
+class CountingStorage(JsonStorage):
+    def __init__(self, root):
+        super().__init__(root)
+        self.reads = 0
+
+    def getMemory(self, userID, character):
+        self.reads += 1
+        return super().getMemory(userID, character)
+
+    def countHistory(self, userID, character):
+        self.reads += 1
+        return super().countHistory(userID, character)
+
+
+def append(storage, compactor, count):
+    for i in range(count):
+        storage.appendHistory(1, "Bot", {"role": "user", "msg": f"message {i}"})
+        compactor.appended(1, "Bot")
+
+
+def testChecksUseCachedCounts(tmp_path):
+    storage = CountingStorage(str(tmp_path))
+    summaries = []
+
+    async def summarize(summary, records):
+        summaries.append(len(records))
+        return summary + f"{len(records)} messages. "
+
+    compactor = MemoryCompactor(storage, summarize, compactThreshold=4, segmentSize=2, keepRecent=2)
+    append(storage, compactor, 1)
+    assert not compactor.needsCompaction(1, "Bot")
+    reads = storage.reads
+    append(storage, compactor, 5)
+    for _ in range(3):
+        compactor.getMemory(1, "Bot")
+    assert storage.reads == reads
+
+    async def run():
+        await compactor.schedule(1, "Bot")
+
+    asyncio.run(run())
+    assert summaries == [2]
+    assert compactor.getMemory(1, "Bot")["covered"] == 2
+    assert storage.getMemory(1, "Bot")["covered"] == 2
+    compactor.release(1)
+    assert compactor.getMemory(1, "Bot")["covered"] == 2
+    assert compactor.countHistory(1, "Bot") == 6
@@ -0,0 +1,39 @@
+import asyncio
+
+from recall import HashEmbedder, RecallIndex
+from tasks import TaskStore
+
+
+def facts(index, userID):
+    return sorted(item["text"] for item in index.store.loadItems(userID) if item["kind"] != "message")
+
+
+def reindex(index, store, userID):
+    revision, data = store.facts(userID)
+    return asyncio.run(index.rememberUserData(userID, data, revision))
+
+
+def testCompletedTasksLeaveTheIndex(tmp_path):
+    users = {1: {"tasks": [], "values": ["honesty"], "interests": []}}
+    store = TaskStore(users.get, users.__setitem__)
+    index = RecallIndex(HashEmbedder(), root=str(tmp_path))
+    task = store.add(1, {"name": "dishes", "description": "after dinner"})
+    assert reindex(index, store, 1) == 2
+    assert facts(index, 1) == ["Task: dishes. after dinner", "Value: honesty"]
+    # Nothing changed, nothing is rebuilt
+    assert reindex(index, store, 1) == 0
+    store.setStatus(1, task["id"], "completed")
+    reindex(index, store, 1)
+    assert facts(index, 1) == ["Value: honesty"]
+
+
+def testCachesAreBoundedByUsers(tmp_path):
+    index = RecallIndex(HashEmbedder(), root=str(tmp_path), maxUsers=2)
+    for userID in range(4):
+        asyncio.run(index.remember(userID, [{"kind": "message", "text": f"hello from {userID}"}]))
+        asyncio.run(index.recall(userID, "hello"))
+    assert set(index.store.items) == {2, 3}
+    assert set(index.store.matrices) <= {2, 3}
+    assert set(index.store.checked) <= {2, 3}
+    # Forgotten users are read back from disk
+    assert index.store.search(0, index.embedder.embedOne("hello from 0"), k=1)[0][1]["text"] == "hello from 0"
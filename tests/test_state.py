@@ -0,0 +1,115 @@
+import threading
+
+from state import UserStateCache
+
+
+class Disk:
+    def __init__(self):
+        self.data = {}
+        self.writes = []
+
+    def load(self, key):
+        return dict(self.data.get(key, {}))
+
+    def store(self, key, data):
+        self.writes.append((key, dict(data)))
+        self.data[key] = dict(data)
+
+
+def makeCache(disk, **kwargs):
+    cache = UserStateCache(disk.load, disk.store, flushInterval=3600, **kwargs)
+    cache.stopped.set()  # no background flusher, the tests flush by hand
+    return cache
+
+
+def testWritesAreBatched():
+    disk = Disk()
+    cache = makeCache(disk)
+    for i in range(5):
+        cache.update(1, {"count": i})
+    assert cache.flush() == 1
+    assert disk.data[1] == {"count": 4}
+    assert cache.flush() == 0
+
+
+def testStaleSnapshotDoesNotOverwriteEviction():
+    disk = Disk()
+    cache = makeCache(disk)
+    cache.update(1, {"name": "old"})
+    # What flush() holds between its snapshot and its write
+    with cache.lock:
+        stale = (dict(cache.entries[1][0]), cache.entries[1][2])
+    cache.update(1, {"name": "new"})
+    cache.drop([1])
+    assert disk.data[1] == {"name": "new"}
+    cache.write(1, *stale)
+    assert disk.data[1] == {"name": "new"}
+    assert cache.get(1) == {"name": "new"}
+
+
+def testFlushRacingEviction():
+    disk = Disk()
+    started, release = threading.Event(), threading.Event()
+    store = disk.store
+
+    def slowStore(key, data):
+        if not started.is_set():
+            started.set()
+            release.wait(5)
+        store(key, data)
+
+    cache = makeCache(disk)
+    cache.store = slowStore
+    cache.update(1, {"name": "old"})
+    flusher = threading.Thread(target=cache.flush)
+    flusher.start()
+    started.wait(5)
+    cache.update(1, {"name": "new"})
+    dropper = threading.Thread(target=cache.drop, args=([1],))
+    dropper.start()
+    release.set()
+    flusher.join(5)
+    dropper.join(5)
+    assert disk.data[1] == {"name": "new"}
+    assert cache.get(1) == {"name": "new"}
+
+
+def testOverflowEvictionWritesDirtyEntries():
+    disk = Disk()
+    cache = makeCache(disk, maxUsers=2)
+    for key in range(4):
+        cache.put(key, {"key": key})
+    assert list(cache.entries) == [2, 3]
+    assert disk.data[0] == {"key": 0} and disk.data[1] == {"key": 1}
+
+
+def testReloadWaitsForFlushInFlight():
+    disk = Disk()
+    started, release = threading.Event(), threading.Event()
+    store = disk.store
+
+    def slowStore(key, data):
+        started.set()
+        release.wait(5)
+        store(key, data)
+
+    cache = makeCache(disk)
+    cache.store = slowStore
+    cache.update(1, {"name": "flushed"})
+    flusher = threading.Thread(target=cache.flush)
+    flusher.start()
+    started.wait(5)
+    # Not dirty any more, so dropping it doesn't write
+    cache.drop([1])
+    result = {}
+    getter = threading.Thread(target=lambda: result.update(cache.get(1)))
+    getter.start()
+    getter.join(0.2)
+    assert getter.is_alive()
+    release.set()
+    flusher.join(5)
+    getter.join(5)
+    assert result == {"name": "flushed"}
+    cache.update(1, {"count": 1})
+    cache.flush()
+    assert disk.data[1] == {"name": "flushed", "count": 1}
@@ -0,0 +1,54 @@
+import pytest
+
+from storage import JsonStorage, SQLiteStorage
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def storage(request, tmp_path):
+    if request.param == "sqlite":
+        return SQLiteStorage(str(tmp_path / "fractal.db"))
+    return JsonStorage(str(tmp_path / "Data"))
+
+
+def fill(storage, n):
+    records = [{"role": "user", "msg": f"message {i}"} for i in range(n)]
+    for record in records:
+        storage.appendHistory(1, "Kamelle", record)
+    return records
+
+
+@pytest.mark.parametrize(
+    "start, end", [(0, None), (3, 7), (-4, None), (-5, -2), (2, -1), (7, 3), (4, 5), (40, None)]
+)
+def testReadHistorySlices(storage, start, end):
+    records = fill(storage, 10)
+    assert storage.readHistory(1, "Kamelle", start, end) == records[start:end]
+
+
+@pytest.mark.parametrize("first, chunk", [(0, 3), (0, 32), (4, 3), (10, 3), (12, 3)])
+def testReadHistoryBackwards(storage, first, chunk):
+    records = fill(storage, 10)
+    assert list(storage.readHistoryBackwards(1, "Kamelle", first, chunk)) == records[first:][::-1]
+
+
+def testReadHistoryBackwardsStopsEarly(storage):
+    records = fill(storage, 100)
+    newest = []
+    for record in storage.readHistoryBackwards(1, "Kamelle", chunk=8):
+        newest.append(record)
+        if len(newest) == 5:
+            break
+    assert newest == records[-5:][::-1]
+
+
+def testSetUserRewritesOnlyChangedTasks(tmp_path):
+    storage = SQLiteStorage(str(tmp_path / "fractal.db"))
+    tasks = [{"id": i, "name": f"task {i}", "status": "unstarted"} for i in range(4)]
+    storage.setUser(1, {"tasks": tasks, "values": []})
+    rowIDs = dict(storage.connection().execute("SELECT position, id FROM tasks"))
+    tasks = [tasks[0], dict(tasks[1], status="in-progress"), tasks[3]]
+    storage.setUser(1, {"tasks": tasks, "values": ["honesty"]})
+    assert storage.getUser(1) == {"tasks": tasks, "values": ["honesty"]}
+    after = dict(storage.connection().execute("SELECT position, id FROM tasks"))
+    assert after[0] == rowIDs[0]
+    assert len(after) == 3
@@ -0,0 +1,104 @@
+import asyncio
+import time
+
+from telegram.error import RetryAfter
+
+from streaming import StreamingReply
+
+
+class FakeSent:
+    def __init__(self, failures=()):
+        self.edits = []
+        self.failures = list(failures)
+
+    async def edit_text(self, text):
+        if self.failures:
+            raise self.failures.pop(0)
+        self.edits.append((time.monotonic(), text))
+
+
+class FakeMessage:
+    def __init__(self, sent):
+        self.sent = sent
+        self.replies = []
+
+    async def reply_text(self, text):
+        self.replies.append(text)
+        return self.sent
+
+
+def testFinishEditsRightAway():
+    async def run():
+        sent = FakeSent()
+        reply = StreamingReply(FakeMessage(sent), minInterval=1.0)
+        await reply.start()
+        await reply.update("Hello there, how are you today?")  # throttled
+        started = time.monotonic()
+        await reply.finish("Hello there, how are you today? Good!")
+        return sent.edits, time.monotonic() - started
+
+    edits, elapsed = asyncio.run(run())
+    assert [text for _, text in edits] == ["Hello there, how are you today? Good!"]
+    assert elapsed < 0.1
+
+
+def testUpdatesAreThrottled():
+    async def run():
+        sent = FakeSent()
+        reply = StreamingReply(FakeMessage(sent), minInterval=0.2, minChars=1)
+        await reply.start()
+        await asyncio.sleep(0.25)
+        await reply.update("one two")
+        await reply.update("one two three")  # within minInterval of the last edit
+        await reply.finish("one two three four")
+        return [text for _, text in sent.edits]
+
+    assert asyncio.run(run()) == ["one two", "one two three four"]
+
+
+def testFinishWaitsForFloodControl():
+    async def run():
+        sent = FakeSent([RetryAfter(0.2)])
+        reply = StreamingReply(FakeMessage(sent), minInterval=1.0)
+        await reply.start()
+        started = time.monotonic()
+        await reply.finish("done")
+        return sent.edits, time.monotonic() - started
+
+    edits, elapsed = asyncio.run(run())
+    assert [text for _, text in edits] == ["done"]
+    assert 0.15 < elapsed < 1.0
+
+
+def testSlowEditsAreNotTimedAsTheCompletion(monkeypatch):
+    from types import SimpleNamespace
+
+    import fractal
+    from metrics import Metrics
+
+    def chunk(text):
+        delta = SimpleNamespace(content=text, tool_calls=None)
+        return SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=delta)])
+
+    async def stream():
+        for word in ["Hello", " there", " friend"]:
+            await asyncio.sleep(0.01)
+            yield chunk(word)
+
+    async def create(**kwargs):
+        return stream()
+
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    monkeypatch.setattr(fractal, "getClient", lambda: client)
+    monkeypatch.setattr(fractal, "metrics", Metrics())
+    shown = []
+
+    async def onText(text):
+        await asyncio.sleep(0.2)  # a slow Telegram edit
+        shown.append(text)
+
+    result = asyncio.run(fractal.getCompletion([], "Bot", onText, span="completion.test"))
+    assert result["content"] == "Hello there friend"
+    # Edits are coalesced to the newest text, and the last one lands before returning
+    assert shown == ["Hello", "Hello there friend"]
+    assert fractal.metrics.snapshot()["completion.test"]["max"] < 0.15
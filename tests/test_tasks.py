@@ -0,0 +1,30 @@
+import threading
+
+from tasks import TaskStore
+
+
+def testSlowLoadDoesNotBlockOtherUsers():
+    release = threading.Event()
+    users = {1: {"tasks": [], "values": [], "interests": []}, 2: {"tasks": [], "values": [], "interests": []}}
+
+    def getUser(userID):
+        if userID == 1:
+            release.wait(5)
+        return users[userID]
+
+    store = TaskStore(getUser, lambda userID, data: None)
+    # Make sure the two users land on different stripes
+    while store.userLock(1) is store.userLock(2):
+        store = TaskStore(getUser, lambda userID, data: None, lockStripes=len(store.userLocks) + 1)
+    slow = threading.Thread(target=store.openTasks, args=(1,))
+    slow.start()
+    try:
+        fast = threading.Thread(target=store.add, args=(2, {"name": "dishes"}))
+        fast.start()
+        fast.join(2)
+        assert not fast.is_alive()
+        assert [task["name"] for task in store.openTasks(2)] == ["dishes"]
+    finally:
+        release.set()
+        slow.join()
+    assert store.openTasks(1) == []
@@ -0,0 +1,57 @@
+import pytest
+
+import fractal
+import toolbox
+
+
+class FakeTaskStore:
+    def __init__(self, tasks):
+        self.tasks = tasks
+
+    def openTasks(self, userID):
+        return list(self.tasks)
+
+
+def offered(text, tasks=(), userID=1, allowed=None):
+    registry = toolbox.ToolRegistry(toolbox.registeredTools)
+    original = fractal.taskStore
+    fractal.taskStore = FakeTaskStore(tasks)
+    try:
+        schemas = registry.select(text, allowed, userID)
+    finally:
+        fractal.taskStore = original
+    return {schema["function"]["name"] for schema in schemas}
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("send me a selfie", {"AddNewTask", "SendSelfie"}),
+        ("any new pics?", {"AddNewTask", "SendSelfie"}),
+        ("what's on my list", {"AddNewTask", "SummarizeTasks"}),
+        ("I finished it", {"AddNewTask", "CompleteTask"}),
+        ("add milk to my shopping list", {"AddNewTask", "SummarizeTasks"}),
+    ],
+)
+def testKeywordsMatchWords(text, expected):
+    assert offered(text) == expected
+
+
+@pytest.mark.parametrize("text", ["let's change the topic", "an epic picnic", "listen to this"])
+def testKeywordsDontMatchInsideWords(text):
+    assert offered(text) == {"AddNewTask"}
+
+
+@pytest.mark.parametrize("text", ["I walked the dog", "I washed the dishes finally"])
+def testOpenTasksOfferTaskTools(text):
+    assert offered(text) == {"AddNewTask"}
+    assert offered(text, tasks=[{"name": "Walk the dog"}]) == {
+        "AddNewTask",
+        "CompleteTask",
+        "SummarizeTasks",
+    }
+
+
+def testCharacterAllowList():
+    assert offered("send me a selfie", allowed=["SendSelfie"]) == {"SendSelfie"}
+    assert offered("send me a selfie", allowed=[]) == set()
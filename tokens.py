@@ -0,0 +1,38 @@
+try:
+    import tiktoken
+except ImportError:  # Optional, falls back to an estimate
+    tiktoken = None
+
+# Chat format overhead per message (role, separators) as documented by OpenAI
+messageOverhead = 4
+encoders = {}
+
+
+def getEncoder(model):
+    if tiktoken is None:
+        return None
+    if model not in encoders:
+        try:
+            encoders[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encoders[model] = tiktoken.get_encoding("cl100k_base")
+    return encoders[model]
+
+
+def countTokens(text, model="gpt-3.5-turbo"):
+    """Returns the number of tokens in text. Uses tiktoken when installed,
+    otherwise estimates roughly four characters per token"""
+    if not text:
+        return 0
+    encoder = getEncoder(model)
+    if encoder is None:
+        return len(text) // 4 + 1
+    return len(encoder.encode(text))
+
+
+def countMessageTokens(message, model="gpt-3.5-turbo"):
+    """Tokens used by a chat message dict ({"role", "content"}) or a history record ({"msg"})"""
+    if message.get("tokens") is not None:
+        return message["tokens"] + messageOverhead
+    content = message.get("content", message.get("msg"))
+    return countTokens(content if isinstance(content, str) else "", model) + messageOverhead
@@ -1,8 +1,11 @@
-import openai
+import asyncio
+import inspect
 import json
+import re
 from datetime import datetime
 from datetime import timedelta
 import fractal
+from matcher import matchName
 
 registeredTools = []
 registeredMicroTools = []
@@ -22,6 +25,12 @@ def MicroTool(cls):
 
 @Tool
 class AddNewTask:
+    writesUserData = True
+    # Anything can become a task ("add milk to my shopping list"), too many
+    # phrasings for keywords
+    alwaysOffer = True
+    keywords = ["task", "todo", "to do", "remind", "need to", "have to", "gotta", "schedule", "deadline"]
+
     def __init__(self):
         self.needID = True
         self.func = self.addNewTask
@@ -76,9 +85,8 @@ class AddNewTask:
         task = Task(**args)
         old = []
         prioritized = {}
-        canWrite = False
         response = {"header": ""}
-        old = fractal.getUserData(userID)
+        old = fractal.getUserData(userID) or {}
 
         new = {
             "name": task.name,
@@ -97,25 +105,23 @@ class AddNewTask:
             pass
 
         if prioritized:
-            canWrite = True
-            old["tasks"].append(prioritized)
             response["header"] = "Task added and prioritized"
-            response = prioritized
+            response["content"] = fractal.taskStore.add(userID, prioritized)
         else:
-            canWrite = True
-            old["tasks"].append(new)
             response["header"] = "Task added"
-            response["content"] = prioritized
-
-        if canWrite:
-            with open(f"Data/{userID}/User.json", "w", encoding="utf-8") as f:
-                json.dump(old, f, indent=4)
+            response["content"] = fractal.taskStore.add(userID, new)
 
         return response
 
 
 @Tool
 class SummarizeTasks:
+    keywords = ["task", "todo", "to do", "chore", "list", "remind", "forgot", "what do i"]
+
+    @staticmethod
+    def isRelevant(userID):
+        return bool(fractal.taskStore.openTasks(userID))
+
     def __init__(self):
         self.needID = True
         self.func = self.summarizeTasks
@@ -129,18 +135,32 @@ class SummarizeTasks:
                         "type": "string",
                         "description": "Instructions on how the tasks should be organized",
                     },
+                    "status": {
+                        "type": "string",
+                        "description": "Only list tasks with this status",
+                        "enum": ["unstarted", "in-progress"],
+                    },
+                    "page": {
+                        "type": "integer",
+                        "description": "Page of results to return, starting at 1. Open tasks are listed by due date",
+                    },
                 },
             },
         }
 
-    def summarizeTasks(self, userID, prompt):
-        tasks = fractal.getUserData(userID).get("tasks")
-        tasks = [task for task in tasks if task["status"] != "complete"]
-        return tasks
+    def summarizeTasks(self, userID, args):
+        args = args if isinstance(args, dict) else {}
+        page = args.get("page") if isinstance(args.get("page"), int) else 1
+        result = fractal.taskStore.query(userID, status=args.get("status"), page=page)
+        # Leave out empty fields to keep the reply short
+        result["tasks"] = [{k: v for k, v in task.items() if v not in (None, "", [])} for task in result["tasks"]]
+        return result
 
 
 @Tool
 class SendSelfie:
+    keywords = ["selfie", "pic", "photo", "picture", "see you", "look like", "show me", "send me"]
+
     def __init__(self):
         self.needID = True
         self.func = self.sendSelfie
@@ -175,21 +195,36 @@ class SendSelfie:
             "required": ["emotion", "verb", "place", "condition"],
         }
 
-    def sendSelfie(self, userID, args):
-        valList = list(args.values())
+    async def sendSelfie(self, userID, args):
+        # In schema order and lowercase, so the same selfie always builds the
+        # same payload and can come from fractal.selfieCache
+        valList = [
+            str(args[name]).strip().lower()
+            for name in ("emotion", "verb", "place", "condition")
+            if args.get(name)
+        ]
 
         if args.get("nsfw", False):
             pl = fractal.buildSDPayload(userID, valList, "decrepit")
         else:
             pl = fractal.buildSDPayload(userID, valList)
 
-        path = fractal.getImage(pl)
-        fractal.sendPhoto(path, userID)
-        return "Selfie sent."
+        # Rendered in the background, the photo arrives after the reply
+        if fractal.queueImage(userID, pl, cached=True) is None:
+            return "Too many selfies pending, try again later."
+        return "Selfie is being taken and will arrive shortly."
 
 
 @Tool
 class CompleteTask:
+    writesUserData = True
+    keywords = ["done", "did", "finish", "complete", "task", "chore", "checked off"]
+
+    @staticmethod
+    def isRelevant(userID):
+        # "I walked the dog" names no keyword, so any open task is enough
+        return bool(fractal.taskStore.openTasks(userID))
+
     def __init__(self):
         self.needID = True
         self.func = self.markTaskComplete
@@ -208,20 +243,31 @@ class CompleteTask:
             "required": ["task_name"],
         }
 
-    def markTaskComplete(self, userID, generalTaskName):
-        tasks = fractal.getUserData(userID).get("tasks")
-        tasks = [task for task in tasks if task["status"] != "complete"]
+    async def markTaskComplete(self, userID, args):
+        generalTaskName = args.get("task_name", "") if isinstance(args, dict) else str(args)
+        openTasks = await asyncio.to_thread(fractal.taskStore.openTasks, userID)
+        if not openTasks:
+            return "Task not found"
 
-        agent = Agent()
-        agent.Load([SelectChoice])
-        response = agent.Do(
-            prompt=f"Select the choice that is the closest in meaning to '{generalTaskName}'",
-            data=self.toEnglish(tasks),
+        # Most names can be matched locally, the model is only asked when it's ambiguous
+        choice, shortlist = matchName(
+            generalTaskName, [task["name"] for task in openTasks]
+        )
+        if choice is None:
+            agent = Agent()
+            agent.Load([SelectChoice])
+            response = await agent.Do(
+                prompt=f"Select the choice that is the closest in meaning to '{generalTaskName}'",
+                data=self.toEnglish([openTasks[i] for i in shortlist]),
+            )
+            index = str(response.get("index", "")) if isinstance(response, dict) else ""
+            if not index.isdigit() or not 1 <= int(index) <= len(shortlist):
+                return "Task not found"
+            choice = shortlist[int(index) - 1]
+
+        return await asyncio.to_thread(
+            self.setTaskStatus, userID, openTasks[choice]["id"], "completed"
         )
-        if response["index"].isdigit:
-            return self.setTaskStatus(userID, int(response.get("index")), "complete")
-        else:
-            return "Task not found"
 
     def toEnglish(self, tasks):
         taskString = ""
@@ -231,11 +277,10 @@ class CompleteTask:
             i += 1
         return taskString
 
-    def setTaskStatus(self, userID, index, status):
-        data = fractal.getUserData(userID)
-        data["tasks"][index - 1]["status"] = status
-        fractal.setUserData(userID, data)
-        return "Task set completed"
+    def setTaskStatus(self, userID, taskID, status):
+        if fractal.taskStore.setStatus(userID, taskID, status) is None:
+            return "Task not found"
+        return f"Task set {status}"
 
 
 # user: hey I did that one task! ai: *detects user completed task* -> markTaskComplete(1349, that one task) -> loadAgent("")
@@ -271,8 +316,7 @@ class Agent:
         self.useAvailable = False
         self.loadedTools = []
 
-    def Do(self, prompt, data):
-        openai.api_key = fractal.OPENAI_API_KEY
+    async def Do(self, prompt, data):
         messages = []
         messages.append(
             {
@@ -283,33 +327,31 @@ class Agent:
         messages.append({"role": "user", "content": str(data)})
         functions = None
         response = None
+        registry = getMicroToolRegistry()
         if self.loadedTools:
-            toolInstances = {tool.__name__: tool() for tool in self.loadedTools}
-            toolSchemas = [instance.schema for instance in toolInstances.values()]
-            functions = toolSchemas
+            functions = registry.schemasFor(tool.__name__ for tool in self.loadedTools)
         elif self.useAvailable and self.availableTools:
-            toolInstances = {tool.__name__: tool() for tool in self.availableTools}
-            toolSchemas = [instance.schema for instance in toolInstances.values()]
-            functions = toolSchemas
+            functions = registry.schemasFor(tool.__name__ for tool in self.availableTools)
         if functions:
-            response = openai.ChatCompletion.create(
+            response = await fractal.getCachedCompletion(
                 model="gpt-3.5-turbo-0613",
                 messages=messages,
-                functions=functions,
-                function_call="auto",
+                tools=functions,
+                tool_choice="auto",
             )
-            responseMsg = response["choices"][0]["message"]
+            responseMsg = response.choices[0].message
 
-            if responseMsg.get("function_call"):
-                chosenTool = toolInstances.get(responseMsg["function_call"]["name"])
+            if responseMsg.tool_calls:
+                toolCall = responseMsg.tool_calls[0].function
+                chosenTool = registry.get(toolCall.name)
                 functionToCall = chosenTool.func
 
-                functionJsonArgs = json.loads(responseMsg["function_call"]["arguments"])
+                functionJsonArgs = json.loads(toolCall.arguments)
 
                 return functionToCall(functionJsonArgs)
 
         else:
-            response = openai.ChatCompletion.create(
+            response = await fractal.getCachedCompletion(
                 model="gpt-3.5-turbo-0613", messages=messages
             )
 
@@ -350,18 +392,147 @@ def getAvailableTools():
     return registeredTools
 
 
+class ToolRegistry:
+    """Tool instances and their schemas, built once instead of on every message.
+
+    select() picks the tools worth sending for a turn from cheap local signals:
+    a tool is offered if one of its class level keywords appears as a word in
+    the user's message (plurals and -ed/-ing forms included), if it's marked
+    alwaysOffer, or if its optional isRelevant(userID) says so from the user's
+    state. Only tools the character allows (the optional "tools" list in its
+    card) are offered.
+    """
+
+    def __init__(self, tools):
+        self.size = len(tools)
+        self.instances = {tool.__name__: tool() for tool in tools}
+        # Stored in the tools API format ({"type": "function", "function": schema})
+        self.schemas = {
+            name: {"type": "function", "function": tool.schema}
+            for name, tool in self.instances.items()
+        }
+        self.keywords = {
+            tool.__name__: keywordPattern(getattr(tool, "keywords", []))
+            for tool in tools
+        }
+        self.relevance = {
+            tool.__name__: tool.isRelevant for tool in tools if hasattr(tool, "isRelevant")
+        }
+        self.alwaysOffer = {
+            tool.__name__ for tool in tools if getattr(tool, "alwaysOffer", False)
+        }
+
+    def get(self, name):
+        return self.instances.get(name)
+
+    def schemasFor(self, names):
+        return [self.schemas[name] for name in names if name in self.schemas]
+
+    def select(self, text, allowed=None, userID=None):
+        """Returns the schemas relevant to text (and userID's state when
+        given), limited to the allowed tool names"""
+        text = (text or "").lower()
+        chosen = []
+        for name in self.instances:
+            if allowed is not None and name not in allowed:
+                continue
+            pattern = self.keywords[name]
+            if (
+                name in self.alwaysOffer
+                or (pattern is not None and pattern.search(text))
+                or (userID is not None and name in self.relevance and self.relevance[name](userID))
+            ):
+                chosen.append(self.schemas[name])
+        return chosen
+
+
+def keywordPattern(keywords):
+    """One regex matching any of keywords as whole words, so "pic" finds
+    "pics" but not "topic" or "picnic". None without keywords"""
+    if not keywords:
+        return None
+    alternatives = "|".join(
+        r"\s+".join(re.escape(word) for word in keyword.lower().split()) for keyword in keywords
+    )
+    return re.compile(rf"\b(?:{alternatives})(?:s|es|d|ed|ing)?\b")
+
+
+toolRegistry = None
+microToolRegistry = None
+
+
+def getToolRegistry():
+    global toolRegistry
+    if toolRegistry is None or toolRegistry.size != len(registeredTools):
+        toolRegistry = ToolRegistry(registeredTools)
+    return toolRegistry
+
+
+def getMicroToolRegistry():
+    global microToolRegistry
+    if microToolRegistry is None or microToolRegistry.size != len(registeredMicroTools):
+        microToolRegistry = ToolRegistry(registeredMicroTools)
+    return microToolRegistry
+
+
+async def callTool(tool, userID, args):
+    """Runs a tool instance's func with the right arguments. Blocking tools
+    (file or SD work) run in a worker thread so the event loop stays free"""
+    callArgs = (userID, args) if tool.needID else (args,)
+    with fractal.metrics.span("tool." + type(tool).__name__):
+        if inspect.iscoroutinefunction(tool.func):
+            return await tool.func(*callArgs)
+        return await asyncio.to_thread(tool.func, *callArgs)
+
+
+async def callTools(registry, userID, toolCalls):
+    """Runs a round of tool calls ({"id", "function": {"name", "arguments"}})
+    concurrently and returns their results in the same order. Tools that
+    rewrite the user's data (writesUserData) run one after another, in order,
+    so they can't overwrite each other's changes. Failures become error strings
+    for the model instead of aborting the turn"""
+    results = [None] * len(toolCalls)
+
+    async def run(i):
+        call = toolCalls[i]["function"]
+        tool = registry.get(call["name"])
+        if tool is None:
+            results[i] = f"Unknown tool {call['name']}"
+            return
+        try:
+            args = json.loads(call["arguments"] or "{}")
+            results[i] = await callTool(tool, userID, args)
+        except Exception as e:
+            print(f"Tool {call['name']} failed: {e}")
+            results[i] = f"Error: {e}"
+
+    async def runInOrder(indexes):
+        for i in indexes:
+            await run(i)
+
+    writers = []
+    independent = []
+    for i, call in enumerate(toolCalls):
+        tool = registry.get(call["function"]["name"])
+        if getattr(tool, "writesUserData", False):
+            writers.append(i)
+        else:
+            independent.append(run(i))
+    await asyncio.gather(runInOrder(writers), *independent)
+    return results
+
+
 def genSchema(obj):
     pass
 
 
-def evalTask(task, values=None, interests=None):
+async def evalTask(task, values=None, interests=None):
     """Given a list of values and interests, an agent will evaluate the
     importance and priority of a task and make changes to a task"""
     if not values or not interests:
         return None
 
-    openai.api_key = fractal.OPENAI_API_KEY
-    response = openai.ChatCompletion.create(
+    response = await fractal.getCachedCompletion(
         model="gpt-3.5-turbo-0613",
         messages=[
             # {"role": "system", "content": "Given the user's interests or values, rate the priority and importance accurately"},
@@ -371,60 +542,66 @@ def evalTask(task, values=None, interests=None):
                 + str({"task": task, "values": values, "interests": interests}),
             }
         ],
-        functions=[
+        tools=[
             {
-                "name": "evaluateTask",
-                "description": "Given the user's interests or values, evaluate each field accurately, reflecting truth",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        # "start": {
-                        #     "type": "string",
-                        #     "format": "date-time",
-                        #     "description": "The start time of the task"
-                        # },
-                        # "due": {
-                        #     "type": "string",
-                        #     "format": "date-time",
-                        #     "description": "The due time of the task"
-                        # },
-                        # "status": {
-                        #     "type": "string",
-                        #     "description": "The status of the task",
-                        #     "enum": ["unstarted", "in-progress", "completed"]
-                        # },
-                        "priority": {
-                            "type": "integer",
-                            "description": "The priority of the task 0 - 10",
-                        },
-                        "importance": {
-                            "type": "integer",
-                            "description": "The importance of the task 0 - 10",
-                        },
-                        "comments": {
-                            "type": "array",
-                            "items": {"type": "string"},
-                            "description": "Comments related to the task",
-                        },
-                        "reasoning": {
-                            "type": "string",
-                            "description": "The logic and reasoning behind the priority and importance values",
+                "type": "function",
+                "function": {
+                    "name": "evaluateTask",
+                    "description": "Given the user's interests or values, evaluate each field accurately, reflecting truth",
+                    "parameters": {
+                        "type": "object",
+                        "properties": {
+                            # "start": {
+                            #     "type": "string",
+                            #     "format": "date-time",
+                            #     "description": "The start time of the task"
+                            # },
+                            # "due": {
+                            #     "type": "string",
+                            #     "format": "date-time",
+                            #     "description": "The due time of the task"
+                            # },
+                            # "status": {
+                            #     "type": "string",
+                            #     "description": "The status of the task",
+                            #     "enum": ["unstarted", "in-progress", "completed"]
+                            # },
+                            "priority": {
+                                "type": "integer",
+                                "description": "The priority of the task 0 - 10",
+                            },
+                            "importance": {
+                                "type": "integer",
+                                "description": "The importance of the task 0 - 10",
+                            },
+                            "comments": {
+                                "type": "array",
+                                "items": {"type": "string"},
+                                "description": "Comments related to the task",
+                            },
+                            "reasoning": {
+                                "type": "string",
+                                "description": "The logic and reasoning behind the priority and importance values",
+                            },
                         },
+                        "required": ["priority", "importance", "comments", "reasoning"],
                     },
-                    "required": ["priority", "importance", "comments", "reasoning"],
                 },
             }
         ],
-        function_call={"name": "evaluateTask"},
+        tool_choice={"type": "function", "function": {"name": "evaluateTask"}},
     )
 
-    print(response)
+    toolCalls = response.choices[0].message.tool_calls
+    if not toolCalls:
+        return None
+    return json.loads(toolCalls[0].function.arguments)
 
 
 if __name__ == "__main__":
     # print(CompleteTask().markTaskComplete(
     #     fractal.ADMIN_ID, "Clayton made some type of ramen"))
-    # CompleteTask().setTaskStatus(fractal.ADMIN_ID, 4, "complete")
+    # CompleteTask().setTaskStatus(fractal.ADMIN_ID, 4, "completed")
     # pass  # Testing goes here
     # sendSelfie_instance = SendSelfie()
     # sendSelfie_instance.sendSelfie(